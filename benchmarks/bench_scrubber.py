@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Benchmarks for the Scrubber and scrub functions.
+
+Runs each benchmark over small, medium, and huge events and reports time per
+event in nanoseconds and bytes allocated per event. Allocated bytes are the
+``tracemalloc`` peak during each call, so they include temporary copies that
+were freed again.
+
+Usage::
+
+    # Run all the benchmarks
+    python benchmarks/bench_scrubber.py
+
+    # Run benchmarks with "cookies" in the name
+    python benchmarks/bench_scrubber.py -k cookies
+
+    # Save results as a baseline and then compare against it later
+    python benchmarks/bench_scrubber.py --save baseline.json
+    python benchmarks/bench_scrubber.py --compare baseline.json
+
+"""
+
+import argparse
+import copy
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import fillmore
+from fillmore.scrubber import (
+    _get_target_dicts,
+    build_scrub_cookies,
+    build_scrub_query_string,
+    Rule,
+    Scrubber,
+)
+from fillmore.test import EventGenerator
+
+
+FRAMES_PATH = "exception.values.[].stacktrace.frames.[].vars"
+
+
+SIZES = {
+    "small": EventGenerator(
+        frames=5,
+        vars_per_frame=5,
+        headers=5,
+        cookies=3,
+        query_params=3,
+        breadcrumbs=5,
+        value_size=10,
+    ),
+    "medium": EventGenerator(
+        frames=30,
+        vars_per_frame=20,
+        headers=20,
+        cookies=20,
+        query_params=20,
+        breadcrumbs=50,
+        value_size=50,
+    ),
+    "huge": EventGenerator(
+        frames=200,
+        vars_per_frame=100,
+        headers=50,
+        cookies=200,
+        query_params=200,
+        breadcrumbs=100,
+        value_size=500,
+    ),
+}
+
+
+def build_rules(count: int) -> List[Rule]:
+    """Builds count rules; the first few match things in the events"""
+    rules = [
+        Rule(path=FRAMES_PATH, keys=["password", "token"], scrub="scrub"),
+        Rule(
+            path="request",
+            keys=["cookies"],
+            scrub=build_scrub_cookies(params=["sessionid", "csrftoken"]),
+        ),
+        Rule(
+            path="request",
+            keys=["query_string"],
+            scrub=build_scrub_query_string(params=["code", "state"]),
+        ),
+        Rule(path="request.headers", keys=["Auth-Token"], scrub="scrub"),
+    ]
+    paths = [FRAMES_PATH, "request.headers", "request.data", "contexts.app", "extra"]
+    for i in range(len(rules), count):
+        rules.append(Rule(path=paths[i % len(paths)], keys=[f"key{i}"], scrub="scrub"))
+    return rules[:count]
+
+
+def measure(fun: Callable, make_args: Callable, iterations: int) -> Tuple[float, float]:
+    """Runs fun and returns ns/call and allocated bytes/call
+
+    Arguments for each call are made before timing so making them isn't
+    measured. Memory is measured in a separate pass because tracing slows
+    things down.
+
+    Allocated bytes is the most memory the call had allocated at one time, so
+    it covers things that were freed before the call returned. Python doesn't
+    count allocations that are freed again, so a net count of blocks would
+    be 0 for most calls.
+
+    """
+    args_list = [make_args() for _ in range(iterations)]
+    start = time.perf_counter_ns()
+    for args in args_list:
+        fun(*args)
+    ns_per_call = (time.perf_counter_ns() - start) / iterations
+
+    args_list = [make_args() for _ in range(iterations)]
+    allocated_bytes = 0
+    tracemalloc.start()
+    try:
+        for args in args_list:
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            fun(*args)
+            _, peak = tracemalloc.get_traced_memory()
+            allocated_bytes += peak - current
+    finally:
+        tracemalloc.stop()
+
+    return ns_per_call, allocated_bytes / iterations
+
+
+def consume(iterable: Any) -> None:
+    for _ in iterable:
+        pass
+
+
+def build_benchmarks() -> Dict[str, Tuple[Callable, Callable, int]]:
+    """Returns name -> (fun, make_args, iterations)"""
+    benchmarks: Dict[str, Tuple[Callable, Callable, int]] = {}
+    for size_name, generator in SIZES.items():
+        event = generator.generate(0).event
+        iterations = {"small": 2000, "medium": 200, "huge": 10}[size_name]
+
+        for rule_count in (1, 100):
+            scrubber = Scrubber(rules=build_rules(rule_count))
+            benchmarks[f"scrubber_{rule_count}_rules_{size_name}"] = (
+                scrubber,
+                lambda event=event: (copy.deepcopy(event), {}),
+                iterations,
+            )
+
+        path = FRAMES_PATH.split(".")
+        benchmarks[f"get_target_dicts_{size_name}"] = (
+            lambda event, path: consume(_get_target_dicts(event, path)),
+            lambda event=event, path=path: (event, path),
+            iterations,
+        )
+
+        scrub_cookies = build_scrub_cookies(params=["sessionid", "csrftoken"])
+        cookies = event["request"]["cookies"]
+        benchmarks[f"scrub_cookies_{size_name}"] = (
+            scrub_cookies,
+            lambda cookies=cookies: (cookies,),
+            iterations,
+        )
+
+        scrub_query_string = build_scrub_query_string(params=["code", "state"])
+        query_string = event["request"]["query_string"]
+        benchmarks[f"scrub_query_string_{size_name}"] = (
+            scrub_query_string,
+            lambda query_string=query_string: (query_string,),
+            iterations,
+        )
+
+    return benchmarks
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", default="", help="only run benchmarks with this in name")
+    parser.add_argument("--save", help="save results as JSON to this file")
+    parser.add_argument("--compare", help="compare results to this saved JSON file")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)["results"]
+
+    print(f"fillmore {fillmore.__version__}, Python {platform.python_version()}")
+    print()
+    header = f"{'benchmark':<36} {'ns/event':>12} {'alloc bytes':>12}"
+    if baseline:
+        header += f" {'time vs base':>13} {'alloc vs base':>14}"
+    print(header)
+
+    results = {}
+    for name, (fun, make_args, iterations) in build_benchmarks().items():
+        if args.k not in name:
+            continue
+        ns, allocated_bytes = measure(fun, make_args, iterations)
+        results[name] = {
+            "ns_per_event": ns,
+            "allocated_bytes_per_event": allocated_bytes,
+        }
+        line = f"{name:<36} {ns:>12.0f} {allocated_bytes:>12.0f}"
+        if name in baseline:
+            ratio = ns / baseline[name]["ns_per_event"]
+            line += f" {ratio:>12.2f}x"
+            base_bytes = baseline[name].get("allocated_bytes_per_event")
+            if base_bytes:
+                line += f" {allocated_bytes / base_bytes:>13.2f}x"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(
+                {
+                    "fillmore": fillmore.__version__,
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                fp,
+                indent=2,
+            )
+        print()
+        print(f"Saved results to {args.save}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Measures how Scrubber throughput scales with the number of threads.
+
+All threads share one Scrubber. On a free-threaded Python build (for example,
+``python3.13t``), throughput should go up with the thread count. On a build
+with the GIL, it won't.
+
+Usage::
+
+    python benchmarks/bench_threads.py --threads 1,2,4,8 --events 2000
+
+"""
+
+import argparse
+import copy
+import sys
+import threading
+import time
+
+from fillmore.scrubber import build_scrub_cookies, Rule, Scrubber
+
+
+SCRUBBER = Scrubber(
+    rules=[
+        Rule(
+            path="request",
+            keys=["cookies"],
+            scrub=build_scrub_cookies(params=["code", "state"]),
+        ),
+        Rule(path="request.headers", keys=["Auth-Token"], scrub="scrub"),
+        Rule(
+            path="exception.values.[].stacktrace.frames.[].vars",
+            keys=["username", "password"],
+            scrub="scrub",
+        ),
+    ]
+)
+
+
+EVENT = {
+    "request": {
+        "cookies": "code=abc; state=def; other=ghi",
+        "headers": {"Auth-Token": "secret", "Host": "example.com"},
+    },
+    "exception": {
+        "values": [
+            {
+                "stacktrace": {
+                    "frames": [
+                        {
+                            "function": f"func{i}",
+                            "vars": {
+                                "username": "bob",
+                                "password": "pwd",
+                                "other": "x" * 20,
+                            },
+                        }
+                        for i in range(20)
+                    ]
+                }
+            }
+        ]
+    },
+}
+
+
+def run(thread_count: int, event_count: int) -> float:
+    """Scrubs event_count events in each thread and returns events/sec"""
+    # Copy events ahead of time so the copying isn't measured
+    events = [
+        [copy.deepcopy(EVENT) for _ in range(event_count)] for _ in range(thread_count)
+    ]
+    barrier = threading.Barrier(thread_count + 1)
+
+    def scrub_events(thread_events: list) -> None:
+        barrier.wait()
+        for event in thread_events:
+            SCRUBBER(event, {})
+
+    threads = [
+        threading.Thread(target=scrub_events, args=(thread_events,))
+        for thread_events in events
+    ]
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return (thread_count * event_count) / elapsed
+
+
+def main(argv: list) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--threads", default="1,2,4,8", help="comma-separated thread counts"
+    )
+    parser.add_argument(
+        "--events", type=int, default=2000, help="events scrubbed per thread"
+    )
+    args = parser.parse_args(argv)
+
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Python {sys.version}")
+    print(f"GIL enabled: {is_gil_enabled}")
+    print()
+    print(f"{'threads':>8} {'events/sec':>12} {'scaling':>8}")
+
+    baseline = None
+    for thread_count in [int(count) for count in args.threads.split(",")]:
+        rate = run(thread_count, args.events)
+        if baseline is None:
+            baseline = rate
+        print(f"{thread_count:>8} {rate:>12.0f} {rate / baseline:>7.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
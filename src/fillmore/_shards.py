@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Per-thread counters shared by the Scrubber and BeforeSendGuard."""
+
+import abc
+import itertools
+import threading
+from typing import Any, Callable, Dict, Generic, List, TypeVar
+import weakref
+
+
+class _Shard(abc.ABC):
+    """Counts for a single thread in a _ThreadShards"""
+
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def merge(self, other: Any) -> None:
+        """Adds the counts of another shard to this one"""
+
+
+_ShardT = TypeVar("_ShardT", bound=_Shard)
+
+
+class _ThreadToken:
+    """Kept in a thread's local storage so we know when the thread exits"""
+
+    __slots__ = ("__weakref__",)
+
+
+def _retire_shard(shards_ref: "weakref.ref[_ThreadShards]", key: int) -> None:
+    shards = shards_ref()
+    if shards is not None:
+        # This can run in any thread when the token is garbage collected, so
+        # only note the key; list.append is atomic
+        shards._retired_keys.append(key)
+
+
+class _ThreadShards(Generic[_ShardT]):
+    """Per-thread counters that don't need a lock to count
+
+    Each thread counts in its own shard and ``shards()`` returns all of them
+    for adding up. When a thread exits, its shard is merged into a shard for
+    exited threads, so thread-per-request servers don't collect a shard for
+    every thread that ever counted something.
+
+    :param factory: callable that returns a new empty shard
+
+    """
+
+    def __init__(self, factory: Callable[[], _ShardT]) -> None:
+        self._factory = factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: Dict[int, _ShardT] = {}
+        self._exited = factory()
+        self._retired_keys: List[int] = []
+        self._next_key = itertools.count()
+
+    def _merge_retired(self) -> None:
+        # Call with the lock held
+        while self._retired_keys:
+            shard = self._shards.pop(self._retired_keys.pop(), None)
+            if shard is not None:
+                self._exited.merge(shard)
+
+    def get(self) -> _ShardT:
+        """Returns the current thread's shard"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._factory()
+            token = _ThreadToken()
+            with self._lock:
+                self._merge_retired()
+                key = next(self._next_key)
+                self._shards[key] = shard
+            self._local.shard = shard
+            # The thread's local storage is released when the thread exits
+            # which lets the token go
+            self._local.token = token
+            weakref.finalize(token, _retire_shard, weakref.ref(self), key)
+            return shard
+
+    def shards(self) -> List[_ShardT]:
+        """Returns the shards of running threads and the shard of exited ones"""
+        with self._lock:
+            self._merge_retired()
+            return [self._exited] + list(self._shards.values())
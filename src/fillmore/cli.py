@@ -0,0 +1,593 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Command line tools for working with Scrubbers and saved events.
+
+Usage::
+
+    python -m fillmore coverage --rules myapp.sentry:scrubber events/
+    python -m fillmore scrub --rules myapp.sentry:scrubber -o scrubbed/ events/
+    python -m fillmore index events/
+    python -m fillmore find events/ "contexts.*.token" request.cookies
+    python -m fillmore compare --old myapp.old:scrubber --new myapp.sentry:scrubber events/
+
+Scrubbers are specified as ``module:name`` or ``module.name`` where ``name``
+is a :py:class:`fillmore.scrubber.Scrubber` in ``module``.
+
+"""
+
+import argparse
+from collections import Counter
+import hashlib
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import re
+import sys
+import time
+from typing import Any, Dict, List, Optional, Pattern, Tuple, Type
+
+from fillmore.corpus import (
+    CorpusIndex,
+    decompression_errors,
+    event_key_paths,
+    iter_event_files,
+    iter_file_events,
+    KeyPath,
+    open_event_file,
+    SENSITIVE_KEY_PATTERN,
+)
+from fillmore.scrubber import (
+    ALL_COOKIE_KEYS,
+    ALL_QUERY_STRING_KEYS,
+    load_scrubber as _load_scrubber,
+    Scrubber,
+)
+from fillmore.streaming import scrub_json_stream, StreamError
+
+
+class CommandError(Exception):
+    """Error that stops a command"""
+
+
+def load_scrubber(spec: str) -> Scrubber:
+    """Loads a Scrubber from a ``module:name`` or ``module.name`` spec
+
+    :raises CommandError: if the spec doesn't point to a Scrubber
+
+    """
+    try:
+        return _load_scrubber(spec)
+    except ValueError as exc:
+        raise CommandError(str(exc)) from exc
+
+
+def describe_rule(scrubber: Scrubber, index: int) -> str:
+    """Returns a short description of a Scrubber rule"""
+    rule = scrubber._compiled_rules[index]
+    return f"{'.'.join(rule.path)} {list(rule.keys)}"
+
+
+def _normalize_for_hash(value: Any) -> Any:
+    # Only use things that are the same in every process; reprs of functions
+    # and most objects include memory addresses
+    if value is ALL_COOKIE_KEYS:
+        return "ALL_COOKIE_KEYS"
+    if value is ALL_QUERY_STRING_KEYS:
+        return "ALL_QUERY_STRING_KEYS"
+    if value is None or isinstance(value, (str, int, float, bool, bytes)):
+        return repr(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(json.dumps(_normalize_for_hash(item)) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [_normalize_for_hash(item) for item in value]
+    if isinstance(value, dict):
+        return sorted(
+            [_normalize_for_hash(key), _normalize_for_hash(item)]
+            for key, item in value.items()
+        )
+    if callable(value):
+        name = getattr(value, "__qualname__", type(value).__qualname__)
+        return f"{getattr(value, '__module__', None)}.{name}"
+    return f"{type(value).__module__}.{type(value).__qualname__}"
+
+
+def rules_hash(scrubber: Scrubber) -> str:
+    """Returns a hash of the Scrubber's rules
+
+    The hash covers rule paths, keys, scrub function names, and the values
+    scrub functions like the ones from
+    :py:func:`fillmore.scrubber.build_scrub_cookies` were built with. It
+    doesn't cover the code of the scrub functions.
+
+    """
+    rules = []
+    for rule in scrubber._compiled_rules:
+        closure = [
+            _normalize_for_hash(cell.cell_contents)
+            for cell in getattr(rule.scrub, "__closure__", None) or ()
+        ]
+        rules.append(
+            [
+                list(rule.path),
+                list(rule.keys),
+                f"{rule.scrub.__module__}.{rule.scrub.__qualname__}",
+                closure,
+            ]
+        )
+    return hashlib.sha256(json.dumps(rules).encode("utf-8")).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """Returns the sha256 hash of a file's contents"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _chunksize(item_count: int, workers: int) -> int:
+    return max(1, item_count // (workers * 4))
+
+
+# Worker processes load the scrubber once and keep their state here
+_WORKER: Dict[str, Any] = {}
+
+
+def _init_coverage_worker(rules_spec: str, sensitive_pattern: Pattern) -> None:
+    scrubber = load_scrubber(rules_spec)
+    _WORKER["scrubber"] = scrubber
+    _WORKER["sensitive"] = sensitive_pattern
+    _WORKER["targets"] = {
+        rule.path + (key,) for rule in scrubber._compiled_rules for key in rule.keys
+    }
+    # Key paths repeat a lot between events, so cache whether they're covered
+    _WORKER["covered"] = {}
+
+
+def _is_covered(key_path: KeyPath) -> bool:
+    covered = _WORKER["covered"]
+    try:
+        return covered[key_path]
+    except KeyError:
+        targets = _WORKER["targets"]
+        # A key is covered if a rule scrubs it or something it's in
+        result = any(key_path[:i] in targets for i in range(1, len(key_path) + 1))
+        covered[key_path] = result
+        return result
+
+
+def _coverage_file(path: str) -> Tuple[int, List[int], Counter]:
+    """Returns (events, rule matches, uncovered key paths) for an event file"""
+    scrubber = _WORKER["scrubber"]
+    sensitive = _WORKER["sensitive"]
+
+    matches_before = scrubber.stats().rule_matches
+    uncovered: Counter = Counter()
+    events = 0
+    for event in iter_file_events(path):
+        events += 1
+        for key_path in event_key_paths(event):
+            if sensitive.search(key_path[-1]) and not _is_covered(key_path):
+                uncovered[key_path] += 1
+        scrubber(event, None)
+    matches_after = scrubber.stats().rule_matches
+
+    return (
+        events,
+        [after - before for before, after in zip(matches_before, matches_after)],
+        uncovered,
+    )
+
+
+def cmd_coverage(args: argparse.Namespace) -> int:
+    """Reports which rules match events in a corpus"""
+    scrubber = load_scrubber(args.rules)
+    sensitive = re.compile(args.sensitive, re.IGNORECASE)
+    files = [str(path) for path in iter_event_files(args.path)]
+
+    events = 0
+    matches = [0] * len(scrubber._compiled_rules)
+    uncovered: Counter = Counter()
+
+    def add_results(results: Tuple[int, List[int], Counter]) -> None:
+        nonlocal events
+        file_events, file_matches, file_uncovered = results
+        events += file_events
+        for i, count in enumerate(file_matches):
+            matches[i] += count
+        uncovered.update(file_uncovered)
+
+    if args.workers == 1:
+        _init_coverage_worker(args.rules, sensitive)
+        for path in files:
+            add_results(_coverage_file(path))
+    else:
+        with multiprocessing.Pool(
+            processes=args.workers,
+            initializer=_init_coverage_worker,
+            initargs=(args.rules, sensitive),
+        ) as pool:
+            for results in pool.imap_unordered(
+                _coverage_file, files, chunksize=_chunksize(len(files), args.workers)
+            ):
+                add_results(results)
+
+    print(f"Events: {events} in {len(files)} files")
+    print()
+    print("Rule matches:")
+    for i, count in enumerate(matches):
+        note = "  <- never matched" if count == 0 else ""
+        print(f"  {count:>10}  {describe_rule(scrubber, i)}{note}")
+
+    print()
+    if uncovered:
+        print("Sensitive-looking keys not covered by any rule:")
+        for key_path, count in sorted(uncovered.items(), key=lambda item: -item[1]):
+            print(f"  {count:>10}  {'.'.join(key_path)}")
+    else:
+        print("No sensitive-looking keys without rules.")
+
+    return 0
+
+
+SCRUB_MANIFEST = ".fillmore-scrub.json"
+
+
+# Invalid JSON, bad encodings, corrupt or truncated compressed files, and
+# compression that isn't available
+_SCRUB_FILE_ERRORS: Tuple[Type[Exception], ...] = (
+    StreamError,
+    ValueError,
+    EOFError,
+    OSError,
+    ImportError,
+)
+
+
+def _init_scrub_worker(rules_spec: str) -> None:
+    _WORKER["scrubber"] = load_scrubber(rules_spec)
+
+
+def _scrub_file(
+    task: Tuple[str, str, str, Optional[str]],
+) -> Tuple[str, str, int, int, bool, Optional[str]]:
+    """Scrubs an event file
+
+    :arg task: (input path, output path, manifest key, previous input hash)
+
+    :returns: (manifest key, input hash, input size, events, skipped, error)
+        where error is None or why the file couldn't be scrubbed
+
+    """
+    input_path, output_path, key, previous_hash = task
+    scrubber = _WORKER["scrubber"]
+
+    input_hash = file_hash(input_path)
+    if input_hash == previous_hash and os.path.exists(output_path):
+        return key, input_hash, 0, 0, True, None
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    events_before = scrubber.stats().events
+    # The temporary file keeps the output suffix so it gets the same compression
+    # as the input
+    directory, filename = os.path.split(output_path)
+    tmp_path = os.path.join(directory, f".tmp-{filename}")
+    try:
+        with open_event_file(input_path, "rb") as infp:
+            with open_event_file(tmp_path, "wb") as outfp:
+                scrub_json_stream(scrubber, infp, outfp)
+    except _SCRUB_FILE_ERRORS + decompression_errors() as exc:
+        # Don't leave partial output around
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return key, input_hash, 0, 0, False, f"{type(exc).__name__}: {exc}"
+    os.replace(tmp_path, output_path)
+
+    return (
+        key,
+        input_hash,
+        os.path.getsize(input_path),
+        scrubber.stats().events - events_before,
+        False,
+        None,
+    )
+
+
+def cmd_scrub(args: argparse.Namespace) -> int:
+    """Scrubs event files and writes the scrubbed events to an output directory"""
+    scrubber = load_scrubber(args.rules)
+    rules_digest = rules_hash(scrubber)
+    outputdir = Path(args.output)
+    manifest_path = outputdir / SCRUB_MANIFEST
+
+    # The manifest maps output paths (relative to the output directory) to the
+    # hashes of the input and rules that produced them so we can skip files
+    # that haven't changed
+    manifest: Dict[str, Dict[str, str]] = {}
+    if manifest_path.exists() and not args.force:
+        manifest = json.loads(manifest_path.read_text())
+
+    tasks = []
+    # Manifest key -> input path for finding inputs that have the same output
+    input_paths: Dict[str, Path] = {}
+    for input_arg in args.paths:
+        input_root = Path(input_arg)
+        for input_path in iter_event_files(input_root):
+            if input_root.is_dir():
+                relative_path = input_path.relative_to(input_root)
+            else:
+                relative_path = Path(input_path.name)
+            key = str(relative_path)
+            if key in input_paths:
+                if input_paths[key].resolve() == input_path.resolve():
+                    continue
+                raise CommandError(
+                    f"{input_paths[key]} and {input_path} would both be written "
+                    + f"to {outputdir / relative_path}; scrub them separately"
+                )
+            input_paths[key] = input_path
+            previous = manifest.get(key, {})
+            previous_hash = (
+                previous.get("input") if previous.get("rules") == rules_digest else None
+            )
+            tasks.append(
+                (str(input_path), str(outputdir / relative_path), key, previous_hash)
+            )
+
+    outputdir.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    scrubbed_files = 0
+    skipped_files = 0
+    total_bytes = 0
+    total_events = 0
+
+    failed_files = 0
+
+    def add_results(results: Tuple[str, str, int, int, bool, Optional[str]]) -> None:
+        nonlocal scrubbed_files, skipped_files, failed_files, total_bytes, total_events
+        key, input_hash, size, events, skipped, error = results
+        if error is not None:
+            # Leave it out of the manifest so the next run tries it again
+            manifest.pop(key, None)
+            failed_files += 1
+            print(f"fillmore scrub: error: {key}: {error}", file=sys.stderr)
+            return
+        manifest[key] = {"input": input_hash, "rules": rules_digest}
+        if skipped:
+            skipped_files += 1
+        else:
+            scrubbed_files += 1
+            total_bytes += size
+            total_events += events
+
+    try:
+        if args.workers == 1:
+            _init_scrub_worker(args.rules)
+            for task in tasks:
+                add_results(_scrub_file(task))
+        else:
+            with multiprocessing.Pool(
+                processes=args.workers,
+                initializer=_init_scrub_worker,
+                initargs=(args.rules,),
+            ) as pool:
+                for results in pool.imap_unordered(
+                    _scrub_file, tasks, chunksize=_chunksize(len(tasks), args.workers)
+                ):
+                    add_results(results)
+    finally:
+        # Save what we finished so a rerun can pick up where this left off
+        tmp_manifest_path = manifest_path.with_suffix(".tmp")
+        tmp_manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+        os.replace(tmp_manifest_path, manifest_path)
+
+    elapsed = time.perf_counter() - start
+    megabytes = total_bytes / (1024 * 1024)
+    print(
+        f"Scrubbed {scrubbed_files} files ({total_events} events, {megabytes:.1f} MB) "
+        + f"in {elapsed:.2f}s; skipped {skipped_files} unchanged files"
+    )
+    if elapsed > 0:
+        print(
+            f"Throughput: {total_events / elapsed:.0f} events/s, "
+            + f"{megabytes / elapsed:.1f} MB/s"
+        )
+    if failed_files:
+        print(f"Failed to scrub {failed_files} files")
+        return 1
+    return 0
+
+
+def cmd_index(args: argparse.Namespace) -> int:
+    """Builds or updates the index for a corpus"""
+    if not Path(args.path).is_dir():
+        raise CommandError(f"{args.path} is not a directory")
+
+    start = time.perf_counter()
+    with CorpusIndex(args.path, index_path=args.index) as index:
+        indexed, removed = index.update()
+        key_paths = len(index.key_paths())
+    elapsed = time.perf_counter() - start
+    print(
+        f"Indexed {indexed} new or changed files and removed {removed} deleted "
+        + f"files in {elapsed:.2f}s; {key_paths} key paths"
+    )
+    return 0
+
+
+def cmd_find(args: argparse.Namespace) -> int:
+    """Prints events in a corpus that have key paths matching patterns"""
+    if not Path(args.path).is_dir():
+        raise CommandError(f"{args.path} is not a directory")
+
+    with CorpusIndex(args.path, index_path=args.index) as index:
+        index.update()
+        found = set()
+        for pattern in args.patterns:
+            found.update(index.find(pattern))
+
+    for indexed_event in sorted(found, key=lambda item: (item.path, item.position)):
+        print(f"{indexed_event.path.relative_to(args.path)}:{indexed_event.position}")
+    return 0
+
+
+def cmd_compare(args: argparse.Namespace) -> int:
+    """Reports events two Scrubbers scrub differently"""
+    # Load them here so bad specs are reported before starting workers
+    load_scrubber(args.old)
+    load_scrubber(args.new)
+
+    # Imported here because fillmore.test imports a lot the other commands
+    # don't need
+    from fillmore.test import compare_scrubbers
+
+    root = Path(args.path)
+    unmasked_events = 0
+    newly_masked_events = 0
+    for difference in compare_scrubbers(args.old, args.new, root, workers=args.workers):
+        location = (
+            f"{difference.path.relative_to(root) if root.is_dir() else difference.path}"
+            + f":{difference.position}"
+        )
+        if difference.unmasked:
+            unmasked_events += 1
+            print(f"{location}: unmasked {', '.join(difference.unmasked)}")
+        if difference.newly_masked:
+            newly_masked_events += 1
+            print(f"{location}: newly masked {', '.join(difference.newly_masked)}")
+
+    print(
+        f"{unmasked_events} events with unmasked values, "
+        + f"{newly_masked_events} events with newly masked values"
+    )
+    return 1 if unmasked_events else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="fillmore", description="Tools for Sentry event scrubbing."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    coverage_parser = subparsers.add_parser(
+        "coverage",
+        help="report which rules match events in a corpus",
+        description=(
+            "Scrubs the events in a corpus and reports how many values each rule "
+            + "scrubbed, rules that never matched, and keys that look sensitive "
+            + "but aren't covered by a rule."
+        ),
+    )
+    coverage_parser.add_argument(
+        "--rules", required=True, help="Scrubber as module:name"
+    )
+    coverage_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes",
+    )
+    coverage_parser.add_argument(
+        "--sensitive",
+        default=SENSITIVE_KEY_PATTERN.pattern,
+        help="regular expression for keys that look sensitive",
+    )
+    coverage_parser.add_argument("path", help="event file or corpus directory")
+    coverage_parser.set_defaults(func=cmd_coverage)
+
+    scrub_parser = subparsers.add_parser(
+        "scrub",
+        help="scrub event files",
+        description=(
+            "Scrubs event files with a pool of worker processes and writes them "
+            + "to an output directory. Files that haven't changed since the last "
+            + "run with the same rules are skipped."
+        ),
+    )
+    scrub_parser.add_argument("--rules", required=True, help="Scrubber as module:name")
+    scrub_parser.add_argument(
+        "-o", "--output", required=True, help="directory to write scrubbed files to"
+    )
+    scrub_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes",
+    )
+    scrub_parser.add_argument(
+        "--force", action="store_true", help="scrub all files even if unchanged"
+    )
+    scrub_parser.add_argument(
+        "paths", nargs="+", help="event files or corpus directories"
+    )
+    scrub_parser.set_defaults(func=cmd_scrub)
+
+    index_parser = subparsers.add_parser(
+        "index",
+        help="build or update a corpus index",
+        description=(
+            "Indexes which events in a corpus have which key paths. Only files "
+            + "that changed since the last run are indexed."
+        ),
+    )
+    index_parser.add_argument(
+        "--index", help="path of the index; defaults to a file in the corpus"
+    )
+    index_parser.add_argument("path", help="corpus directory")
+    index_parser.set_defaults(func=cmd_index)
+
+    find_parser = subparsers.add_parser(
+        "find",
+        help="find events with key paths",
+        description=(
+            "Updates the corpus index and prints the file and position of "
+            + "events that have a key path matching any of the patterns. "
+            + "Patterns are dotted paths where * matches any key and [] is a list."
+        ),
+    )
+    find_parser.add_argument(
+        "--index", help="path of the index; defaults to a file in the corpus"
+    )
+    find_parser.add_argument("path", help="corpus directory")
+    find_parser.add_argument(
+        "patterns", nargs="+", help="key path patterns like contexts.*.token"
+    )
+    find_parser.set_defaults(func=cmd_find)
+
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="compare how two scrubbers scrub a corpus",
+        description=(
+            "Scrubs each event in a corpus with both scrubbers and prints events "
+            + "with values the old scrubber scrubbed and the new one doesn't "
+            + "(unmasked) and the reverse (newly masked). Exits with 1 if any "
+            + "values are unmasked."
+        ),
+    )
+    compare_parser.add_argument("--old", required=True, help="Scrubber as module:name")
+    compare_parser.add_argument("--new", required=True, help="Scrubber as module:name")
+    compare_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes",
+    )
+    compare_parser.add_argument("path", help="event file or corpus directory")
+    compare_parser.set_defaults(func=cmd_compare)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except CommandError as exc:
+        print(f"fillmore {args.command}: error: {exc}", file=sys.stderr)
+        return 1
@@ -0,0 +1,482 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Utilities for working with a corpus of saved Sentry events.
+
+A corpus is a directory of event files like the ones written by
+:py:class:`fillmore.test.SaveEvents`. Files are either ``.json`` files with
+one event each or ``.jsonl`` files with one event per line. ``.jsonl`` files
+can be compressed with gzip (``.jsonl.gz``) or zstd (``.jsonl.zst``).
+
+Reading and writing zstd files requires Python 3.14 or the ``zstandard``
+package.
+
+For large corpora, :py:class:`fillmore.corpus.CorpusIndex` keeps an index of
+which events have which key paths so you can find events without scanning
+every file.
+
+"""
+
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+import gzip
+import importlib
+import json
+from pathlib import Path
+import re
+import sqlite3
+import threading
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    IO,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+import attrs
+
+
+#: Path to a key in an event; traversing a list is denoted by ``[]`` like in
+#: :py:class:`fillmore.scrubber.Rule` paths
+KeyPath = Tuple[str, ...]
+
+
+#: Pattern for keys that look like they hold sensitive data
+SENSITIVE_KEY_PATTERN = re.compile(
+    r"pass|pwd|secret|token|auth|session|cookie|csrf|api[_-]?key|credential|"
+    + r"private|signature",
+    re.IGNORECASE,
+)
+
+
+EVENT_FILE_SUFFIXES = (".json", ".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+
+#: Compression name -> file suffix
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def is_event_file(path: Path) -> bool:
+    """Returns whether path has an event file suffix and isn't a hidden file"""
+    return path.name.endswith(EVENT_FILE_SUFFIXES) and not path.name.startswith(".")
+
+
+def iter_event_files(path: Union[str, Path]) -> Iterator[Path]:
+    """Yields event files in path in sorted order
+
+    :arg path: an event file or a directory to search recursively
+
+    """
+    path = Path(path)
+    if path.is_file():
+        yield path
+        return
+
+    for child in sorted(path.rglob("*")):
+        if child.is_file() and is_event_file(child):
+            yield child
+
+
+def _get_zstd_module() -> Any:
+    try:
+        # Python 3.14+
+        return importlib.import_module("compression.zstd")
+    except ImportError:
+        pass
+    try:
+        return importlib.import_module("zstandard")
+    except ImportError as exc:
+        raise ImportError(
+            "zstd compression requires Python 3.14 or the zstandard package"
+        ) from exc
+
+
+def decompression_errors() -> Tuple[Type[Exception], ...]:
+    """Returns the errors reading a corrupt compressed file can raise
+
+    These are in addition to ``OSError``, ``EOFError``, and ``ValueError``
+    which gzip raises.
+
+    """
+    try:
+        return (_get_zstd_module().ZstdError,)
+    except ImportError:
+        return ()
+
+
+def is_compression_available(compression: Optional[str]) -> bool:
+    """Returns whether the compression (None, "gzip", or "zstd") can be used"""
+    if compression == "zstd":
+        try:
+            _get_zstd_module()
+        except ImportError:
+            return False
+        return True
+    return compression is None or compression in COMPRESSION_SUFFIXES
+
+
+def open_compressed(
+    path: Union[str, Path], mode: str = "rb", compression: Optional[str] = None
+) -> IO:
+    """Opens a file that's compressed with the specified compression
+
+    :arg path: the path to the file
+    :arg mode: the mode to open the file in like ``open()``
+    :arg compression: None, ``"gzip"``, or ``"zstd"``
+
+    :raises ValueError: if the compression isn't supported
+    :raises ImportError: if the zstd module isn't available
+
+    """
+    if compression is None:
+        return open(path, mode)
+    if compression == "gzip":
+        return gzip.open(path, mode)  # type: ignore[return-value]
+    if compression == "zstd":
+        return _get_zstd_module().open(path, mode)
+    raise ValueError(f"compression {compression!r} is not supported")
+
+
+def open_event_file(path: Union[str, Path], mode: str = "rt") -> IO:
+    """Opens an event file using the compression denoted by its suffix"""
+    path = Path(path)
+    compression = None
+    for name, suffix in COMPRESSION_SUFFIXES.items():
+        if path.name.endswith(suffix):
+            compression = name
+    return open_compressed(path, mode, compression)
+
+
+def iter_file_events(path: Union[str, Path]) -> Iterator[Dict[str, Any]]:
+    """Lazily yields events in an event file
+
+    :arg path: path to a ``.json``, ``.jsonl``, ``.jsonl.gz``, or
+        ``.jsonl.zst`` file
+
+    """
+    path = Path(path)
+    with open_event_file(path, "rt") as fp:
+        if path.name.endswith(".json"):
+            yield json.load(fp)
+            return
+
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_events(path: Union[str, Path]) -> Iterator[Dict[str, Any]]:
+    """Lazily yields all the events in an event file or a corpus directory
+
+    :arg path: an event file or a directory to search recursively
+
+    """
+    for event_file in iter_event_files(path):
+        yield from iter_file_events(event_file)
+
+
+def iter_key_paths(event: Any) -> Iterator[KeyPath]:
+    """Yields the path of every key in every dict in the event
+
+    Paths can repeat when the event has lists of dicts.
+
+    """
+    stack: List[Tuple[KeyPath, Any]] = [((), event)]
+    while stack:
+        path, value = stack.pop()
+        if isinstance(value, dict):
+            for key, child in value.items():
+                child_path = path + (str(key),)
+                yield child_path
+                stack.append((child_path, child))
+        elif isinstance(value, list):
+            child_path = path + ("[]",)
+            for child in value:
+                stack.append((child_path, child))
+
+
+def event_key_paths(event: Any) -> Set[KeyPath]:
+    """Returns the set of key paths in the event"""
+    return set(iter_key_paths(event))
+
+
+#: Default file name for a corpus index in the corpus directory
+INDEX_FILENAME = ".fillmore-index.sqlite"
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_file_id ON events(file_id);
+CREATE TABLE IF NOT EXISTS key_paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS event_key_paths (
+    key_path_id INTEGER NOT NULL,
+    event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+    PRIMARY KEY (key_path_id, event_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS event_key_paths_event_id ON event_key_paths(event_id);
+"""
+
+
+def parse_key_path_pattern(pattern: str) -> KeyPath:
+    """Parses a dotted key path pattern like ``contexts.*.token``
+
+    Parts are separated by ``.`` and matched with :py:func:`fnmatch.fnmatchcase`
+    so ``*`` matches any single key. Lists are ``[]`` like in
+    :py:class:`fillmore.scrubber.Rule` paths.
+
+    """
+    return tuple(pattern.split("."))
+
+
+def key_path_matches(key_path: KeyPath, pattern: KeyPath) -> bool:
+    """Returns whether a key path matches a parsed key path pattern"""
+    if len(key_path) != len(pattern):
+        return False
+    return all(
+        part == pattern_part or fnmatchcase(part, pattern_part)
+        for part, pattern_part in zip(key_path, pattern)
+    )
+
+
+@attrs.frozen
+class IndexedEvent:
+    """An event in a :py:class:`fillmore.corpus.CorpusIndex`
+
+    :param path: the path of the event file
+    :param position: the position of the event in the file starting at 0
+
+    """
+
+    path: Path
+    position: int
+
+    def load(self) -> Dict[str, Any]:
+        """Reads the event from its file"""
+        for i, event in enumerate(iter_file_events(self.path)):
+            if i == self.position:
+                return event
+        raise IndexError(f"{self.path} has no event at position {self.position}")
+
+
+class CorpusIndex:
+    """Persistent index of which events in a corpus have which key paths
+
+    The index is a sqlite database. :py:meth:`update` indexes files that were
+    added or changed since the last update and removes files that were
+    deleted, so keeping the index up to date is cheap. Sinks like
+    :py:class:`fillmore.test.JSONLSink` can also add files to the index as
+    they write them.
+
+    Usage::
+
+        with CorpusIndex("events/") as index:
+            index.update()
+            for indexed_event in index.find("contexts.*.token"):
+                print(indexed_event.path, indexed_event.position)
+
+    Instances can be used from multiple threads.
+
+    :param corpus_dir: the corpus directory
+    :param index_path: the path of the index database; defaults to
+        ``.fillmore-index.sqlite`` in the corpus directory
+
+    """
+
+    def __init__(
+        self, corpus_dir: Union[str, Path], index_path: Union[str, Path, None] = None
+    ):
+        self.corpus_dir = Path(corpus_dir)
+        self.index_path = (
+            Path(index_path) if index_path else self.corpus_dir / INDEX_FILENAME
+        )
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.index_path), check_same_thread=False)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(_SCHEMA)
+        self._key_path_ids: Dict[KeyPath, int] = {}
+        self._load_key_path_ids()
+
+    def __enter__(self) -> "CorpusIndex":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the index database"""
+        with self._lock:
+            self._conn.close()
+
+    def _load_key_path_ids(self) -> None:
+        self._key_path_ids = {
+            tuple(json.loads(path)): key_path_id
+            for key_path_id, path in self._conn.execute(
+                "SELECT id, path FROM key_paths"
+            )
+        }
+
+    @contextmanager
+    def _transaction(self) -> Generator[None, None, None]:
+        with self._lock:
+            try:
+                with self._conn:
+                    yield
+            except Exception:
+                # Key paths added in the transaction were rolled back
+                self._load_key_path_ids()
+                raise
+
+    def _relative(self, path: Path) -> str:
+        return path.resolve().relative_to(self.corpus_dir.resolve()).as_posix()
+
+    def _get_key_path_id(self, key_path: KeyPath) -> int:
+        try:
+            return self._key_path_ids[key_path]
+        except KeyError:
+            # Another CorpusIndex, maybe in another process, might have added
+            # the key path since the cache was loaded
+            path = json.dumps(key_path)
+            self._conn.execute(
+                "INSERT OR IGNORE INTO key_paths (path) VALUES (?)", (path,)
+            )
+            (key_path_id,) = self._conn.execute(
+                "SELECT id FROM key_paths WHERE path = ?", (path,)
+            ).fetchone()
+            self._key_path_ids[key_path] = key_path_id
+            return key_path_id
+
+    def _index_file(self, path: Path) -> None:
+        stat = path.stat()
+        relative_path = self._relative(path)
+        self._conn.execute("DELETE FROM files WHERE path = ?", (relative_path,))
+        cursor = self._conn.execute(
+            "INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+            (relative_path, stat.st_mtime_ns, stat.st_size),
+        )
+        file_id = cursor.lastrowid
+        for position, event in enumerate(iter_file_events(path)):
+            cursor = self._conn.execute(
+                "INSERT INTO events (file_id, position) VALUES (?, ?)",
+                (file_id, position),
+            )
+            event_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO event_key_paths (key_path_id, event_id) VALUES (?, ?)",
+                [
+                    (self._get_key_path_id(key_path), event_id)
+                    for key_path in event_key_paths(event)
+                ],
+            )
+
+    def add_file(self, path: Union[str, Path]) -> None:
+        """Indexes an event file in the corpus, replacing any previous entry
+
+        :arg path: the path of the event file; it must be in the corpus directory
+
+        """
+        with self._transaction():
+            self._index_file(Path(path))
+
+    def update(self) -> Tuple[int, int]:
+        """Indexes new and changed files and removes deleted files
+
+        Files are considered changed if their size or modification time is
+        different than when they were indexed.
+
+        :returns: (number of files indexed, number of files removed)
+
+        """
+        with self._transaction():
+            indexed = {
+                path: (mtime_ns, size)
+                for path, mtime_ns, size in self._conn.execute(
+                    "SELECT path, mtime_ns, size FROM files"
+                )
+            }
+
+            added = 0
+            for path in iter_event_files(self.corpus_dir):
+                relative_path = self._relative(path)
+                stat = path.stat()
+                previous = indexed.pop(relative_path, None)
+                if previous != (stat.st_mtime_ns, stat.st_size):
+                    self._index_file(path)
+                    added += 1
+
+            self._conn.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(relative_path,) for relative_path in indexed],
+            )
+            return added, len(indexed)
+
+    def key_paths(self) -> Dict[KeyPath, int]:
+        """Returns key path -> number of events that have it"""
+        with self._lock:
+            return {
+                tuple(json.loads(path)): count
+                for path, count in self._conn.execute(
+                    "SELECT key_paths.path, COUNT(*) FROM key_paths "
+                    + "JOIN event_key_paths ON key_paths.id = event_key_paths.key_path_id "
+                    + "GROUP BY key_paths.id"
+                )
+            }
+
+    def find(self, pattern: str) -> List[IndexedEvent]:
+        """Returns events that have a key path that matches the pattern
+
+        :arg pattern: a dotted key path pattern like ``request.cookies`` or
+            ``contexts.*.token``; see
+            :py:func:`fillmore.corpus.parse_key_path_pattern`
+
+        :returns: matching events in file and position order
+
+        """
+        parsed = parse_key_path_pattern(pattern)
+        with self._lock:
+            # Pick up key paths other CorpusIndex instances added
+            self._load_key_path_ids()
+            key_path_ids = [
+                key_path_id
+                for key_path, key_path_id in self._key_path_ids.items()
+                if key_path_matches(key_path, parsed)
+            ]
+            rows: Set[Tuple[str, int]] = set()
+            # Query in batches to stay under sqlite's limit on variables
+            for i in range(0, len(key_path_ids), 500):
+                batch = key_path_ids[i : i + 500]
+                placeholders = ", ".join("?" * len(batch))
+                rows.update(
+                    self._conn.execute(
+                        "SELECT files.path, events.position FROM event_key_paths "
+                        + "JOIN events ON events.id = event_key_paths.event_id "
+                        + "JOIN files ON files.id = events.file_id "
+                        + f"WHERE event_key_paths.key_path_id IN ({placeholders})",
+                        batch,
+                    )
+                )
+
+        return [
+            IndexedEvent(path=self.corpus_dir / path, position=position)
+            for path, position in sorted(rows)
+        ]
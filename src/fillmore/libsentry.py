@@ -4,26 +4,327 @@
 
 """Utility functions for setting up Sentry."""
 
+import bisect
+import copy
 import logging
-from typing import Any, Callable, List, Optional
+import time
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 
+import attrs
 import sentry_sdk
 from sentry_sdk.integrations.logging import ignore_logger
 
 from fillmore import SCRUBBER_MODULE_NAME
+from fillmore._shards import _Shard, _ThreadShards
+from fillmore.scrubber import MASK_TEXT
 
 
 logger = logging.getLogger(__name__)
 
 
+#: Upper bounds in milliseconds of the before_send latency histogram buckets;
+#: there's one more bucket for latencies over the last bound
+LATENCY_BUCKETS_MS: Tuple[float, ...] = (
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+)
+
+#: What BeforeSendGuard can do with an event when before_send is too slow or
+#: raises an exception
+ON_TIMEOUT_ACTIONS = ("drop", "mask_all")
+
+
+#: Top-level event keys mask_all keeps because Sentry needs them to accept and
+#: process the event
+MASK_ALL_KEEP_KEYS = frozenset(
+    [
+        "event_id",
+        "timestamp",
+        "start_timestamp",
+        "type",
+        "level",
+        "platform",
+        "release",
+        "dist",
+        "environment",
+        "sdk",
+    ]
+)
+
+#: Keys in ``contexts.trace`` mask_all keeps so the event stays connected to
+#: its trace; sentry_sdk builds the envelope's trace header from the
+#: ``dynamic_sampling_context``
+MASK_ALL_KEEP_TRACE_KEYS = frozenset(
+    [
+        "trace_id",
+        "span_id",
+        "parent_span_id",
+        "op",
+        "status",
+        "origin",
+        "dynamic_sampling_context",
+    ]
+)
+
+#: Keys in ``exception.values`` items mask_all keeps so the event is grouped by
+#: exception type
+MASK_ALL_KEEP_EXCEPTION_KEYS = frozenset(["type", "mechanism"])
+
+
+def _mask_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: _mask_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_mask_value(item) for item in value]
+    if value is None or isinstance(value, bool):
+        return value
+    return MASK_TEXT
+
+
+def _mask_except(value: Any, keep_keys: FrozenSet[str]) -> Any:
+    if not isinstance(value, dict):
+        return _mask_value(value)
+    return {
+        key: copy.deepcopy(item) if key in keep_keys else _mask_value(item)
+        for key, item in value.items()
+    }
+
+
+def mask_all(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns a copy of the event with all of its content masked
+
+    Protocol and metadata fields Sentry needs to accept and process the event
+    are kept:
+
+    * :py:data:`fillmore.libsentry.MASK_ALL_KEEP_KEYS` like ``event_id``,
+      ``timestamp``, ``level``, ``release``, and ``sdk``
+    * :py:data:`fillmore.libsentry.MASK_ALL_KEEP_TRACE_KEYS` in
+      ``contexts.trace``
+    * :py:data:`fillmore.libsentry.MASK_ALL_KEEP_EXCEPTION_KEYS` in
+      ``exception.values`` items
+
+    Everything else is masked: dict keys and the structure of the event are
+    kept, but values other than None and bools are replaced with
+    ``"[Scrubbed]"``.
+
+    """
+    masked: Dict[str, Any] = {}
+    for key, value in event.items():
+        if key in MASK_ALL_KEEP_KEYS:
+            masked[key] = copy.deepcopy(value)
+        elif key == "contexts" and isinstance(value, dict):
+            masked[key] = {
+                name: _mask_except(context, MASK_ALL_KEEP_TRACE_KEYS)
+                if name == "trace"
+                else _mask_value(context)
+                for name, context in value.items()
+            }
+        elif (
+            key == "exception"
+            and isinstance(value, dict)
+            and isinstance(value.get("values"), list)
+        ):
+            masked[key] = {
+                name: [
+                    _mask_except(item, MASK_ALL_KEEP_EXCEPTION_KEYS)
+                    for item in value["values"]
+                ]
+                if name == "values"
+                else _mask_value(item)
+                for name, item in value.items()
+            }
+        else:
+            masked[key] = _mask_value(value)
+    return masked
+
+
+@attrs.frozen
+class BeforeSendStats:
+    """Latency of before_send calls made through a BeforeSendGuard
+
+    :param events: number of events
+    :param timeouts: number of events where before_send took longer than the
+        deadline
+    :param errors: number of events where before_send raised an exception
+    :param buckets: histogram of latencies; counts of events for each bound in
+        :py:data:`fillmore.libsentry.LATENCY_BUCKETS_MS` followed by the count
+        of events slower than the last bound
+    :param total_ms: total milliseconds spent in before_send
+    :param max_ms: longest before_send call in milliseconds
+
+    """
+
+    events: int
+    timeouts: int
+    errors: int
+    buckets: Tuple[int, ...]
+    total_ms: float
+    max_ms: float
+
+    def percentile(self, percent: float) -> float:
+        """Returns an upper bound in milliseconds for a latency percentile
+
+        This is the bound of the histogram bucket the percentile falls in or
+        ``max_ms`` if it's in the last bucket. It's 0 if there are no events.
+
+        """
+        if not self.events:
+            return 0.0
+        rank = max(1, round(percent / 100 * self.events))
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+
+class _LatencyShard(_Shard):
+    """Latencies for a single thread"""
+
+    __slots__ = ("events", "timeouts", "errors", "buckets", "total_ms", "max_ms")
+
+    def __init__(self) -> None:
+        self.events = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def merge(self, other: "_LatencyShard") -> None:
+        self.events += other.events
+        self.timeouts += other.timeouts
+        self.errors += other.errors
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+
+class BeforeSendGuard:
+    """Wraps a before_send callable with a deadline and an exception guard
+
+    If the before_send raises an exception, sentry_sdk sends the event as it
+    was when the exception was raised, which can leak data a scrubber hadn't
+    gotten to. This guard catches the exception and does ``on_timeout`` with
+    the event instead.
+
+    Python can't interrupt a callable that's running, so the deadline is
+    checked when the before_send returns. Events that took longer than the
+    deadline are dropped or masked rather than sent and counted as timeouts.
+    Use :py:meth:`stats` to keep track of how much time before_send adds to
+    error reporting.
+
+    :param before_send: the before_send callable to wrap
+    :param deadline_ms: maximum milliseconds before_send can take; None for no
+        deadline
+    :param on_timeout: ``"drop"`` to drop the event or ``"mask_all"`` to send
+        the event with its content masked by
+        :py:func:`fillmore.libsentry.mask_all`
+
+    """
+
+    def __init__(
+        self,
+        before_send: Callable,
+        deadline_ms: Optional[float] = None,
+        on_timeout: str = "drop",
+    ) -> None:
+        if on_timeout not in ON_TIMEOUT_ACTIONS:
+            raise ValueError(
+                f"on_timeout must be one of {', '.join(ON_TIMEOUT_ACTIONS)}"
+            )
+        self.before_send = before_send
+        self.deadline_ms = deadline_ms
+        self.on_timeout = on_timeout
+
+        # Each thread records latencies in its own shard so recording doesn't
+        # need a lock
+        self._shards = _ThreadShards(_LatencyShard)
+
+    def _get_shard(self) -> _LatencyShard:
+        return self._shards.get()
+
+    def _fail_closed(self, event: Any) -> Any:
+        if self.on_timeout == "mask_all" and event is not None:
+            return mask_all(event)
+        return None
+
+    def __call__(self, event: Any, hint: Any) -> Any:
+        start = time.perf_counter()
+        failed = False
+        try:
+            result = self.before_send(event, hint)
+        except Exception:
+            logger.exception("before_send error: doing %s", self.on_timeout)
+            failed = True
+            result = event
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        shard = self._get_shard()
+        shard.events += 1
+        shard.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        shard.total_ms += elapsed_ms
+        if elapsed_ms > shard.max_ms:
+            shard.max_ms = elapsed_ms
+
+        if failed:
+            shard.errors += 1
+            return self._fail_closed(result)
+
+        if self.deadline_ms is not None and elapsed_ms > self.deadline_ms:
+            shard.timeouts += 1
+            logger.warning(
+                "before_send took %.3f ms; deadline is %s ms: doing %s",
+                elapsed_ms,
+                self.deadline_ms,
+                self.on_timeout,
+            )
+            return self._fail_closed(result)
+
+        return result
+
+    def stats(self) -> BeforeSendStats:
+        """Returns before_send latencies across all threads"""
+        shards = self._shards.shards()
+
+        buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        for shard in shards:
+            for i, count in enumerate(shard.buckets):
+                buckets[i] += count
+
+        return BeforeSendStats(
+            events=sum(shard.events for shard in shards),
+            timeouts=sum(shard.timeouts for shard in shards),
+            errors=sum(shard.errors for shard in shards),
+            buckets=tuple(buckets),
+            total_ms=sum(shard.total_ms for shard in shards),
+            max_ms=max((shard.max_ms for shard in shards), default=0.0),
+        )
+
+
 def set_up_sentry(
     sentry_dsn: str,
     release: str,
     host_id: str,
     integrations: Optional[List[Any]] = None,
     before_send: Optional[Callable] = None,
+    scrub_deadline_ms: Optional[float] = None,
+    on_timeout: Optional[str] = None,
     **kwargs: Any,
-) -> None:
+) -> Optional[BeforeSendGuard]:
     """Set up Sentry
 
     By default, this will set up default integrations
@@ -42,11 +343,39 @@ def set_up_sentry(
 
         and then pass that as the ``before_send`` value.
 
+    :param scrub_deadline_ms: maximum milliseconds ``before_send`` can take;
+        events that take longer aren't sent as they are; None for no deadline
+    :param on_timeout: what to do with events that took too long or where
+        ``before_send`` raised an exception: ``"drop"`` drops them and
+        ``"mask_all"`` sends them with their content masked; defaults to
+        ``"drop"`` if there's a ``scrub_deadline_ms``
+
+        If ``scrub_deadline_ms`` or ``on_timeout`` is passed, ``before_send``
+        is wrapped in a :py:class:`fillmore.libsentry.BeforeSendGuard`.
+        Otherwise it's passed to sentry_sdk as it is.
+
     :param kwargs: any additional arguments to pass to sentry_sdk.init()
 
+    :returns: the BeforeSendGuard if ``before_send`` was wrapped in one; use
+        its ``stats()`` for before_send latencies
+
+    :raises ValueError: if ``on_timeout`` isn't valid
+
     """
+    if on_timeout is not None and on_timeout not in ON_TIMEOUT_ACTIONS:
+        raise ValueError(f"on_timeout must be one of {', '.join(ON_TIMEOUT_ACTIONS)}")
+
     if not sentry_dsn:
-        return
+        return None
+
+    guard = None
+    if before_send is not None and (
+        scrub_deadline_ms is not None or on_timeout is not None
+    ):
+        guard = BeforeSendGuard(
+            before_send, deadline_ms=scrub_deadline_ms, on_timeout=on_timeout or "drop"
+        )
+        before_send = guard
 
     sentry_sdk.init(
         dsn=sentry_dsn,
@@ -65,3 +394,7 @@ def set_up_sentry(
 
     # Ignore logging from this module
     ignore_logger(SCRUBBER_MODULE_NAME)
+    # Ignore logging from BeforeSendGuard which runs while handling events
+    ignore_logger(__name__)
+
+    return guard
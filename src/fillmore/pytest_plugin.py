@@ -2,9 +2,61 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+from contextlib import contextmanager
+import copy
+import heapq
+import json
+import logging
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
+
+import attrs
 import pytest
+import sentry_sdk
+
+from fillmore.scrubber import _CompiledRule, Scrubber
+from fillmore.test import (
+    diff_structure,
+    normalize_event,
+    SentryTestHelper,
+    SnapshotFile,
+)
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addini(
+        "fillmore_no_scrub_errors",
+        type="bool",
+        default=False,
+        help="fail every test where a Scrubber records an error",
+    )
+    group = parser.getgroup("fillmore")
+    group.addoption(
+        "--fillmore-profile",
+        action="store_true",
+        default=False,
+        help="time Scrubber calls and print a summary of the slowest scrubs and rules",
+    )
+    group.addoption(
+        "--update-snapshots",
+        action="store_true",
+        default=False,
+        help="create or update snapshots instead of comparing to them",
+    )
+
 
-from fillmore.test import SentryTestHelper
+def pytest_configure(config: pytest.Config) -> None:
+    config.addinivalue_line(
+        "markers",
+        "max_scrub_ms(ms): fail the test if scrubbing any event takes longer "
+        + "than ms milliseconds",
+    )
+    config.stash[_PROFILER_KEY] = ScrubProfiler(
+        enabled=config.getoption("fillmore_profile")
+    )
+    config.stash[_SNAPSHOT_FILES_KEY] = {}
 
 
 @pytest.fixture
@@ -15,3 +67,516 @@ def sentry_helper() -> SentryTestHelper:
 
     """
     return SentryTestHelper()
+
+
+@pytest.fixture(scope="session")
+def sentry_client_options() -> Dict[str, Any]:
+    """Arguments for the session's sentry_sdk client
+
+    Override this fixture in your ``conftest.py`` to configure the client that
+    the ``sentry_client`` fixture uses. Arguments are the same as to
+    ``sentry_sdk.Client``.
+
+    """
+    return {}
+
+
+@pytest.fixture(scope="session")
+def sentry_session_client(
+    sentry_client_options: Dict[str, Any],
+) -> Generator[sentry_sdk.Client, None, None]:
+    """sentry_sdk client shared by all the tests in the session"""
+    client = sentry_sdk.Client(**sentry_client_options)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def sentry_client(
+    sentry_session_client: sentry_sdk.Client,
+) -> Generator[SentryTestHelper, None, None]:
+    """SentryTestHelper using the session's sentry_sdk client
+
+    This is like ``SentryTestHelper().init()``, but it reuses one client for
+    all tests. Each test gets a new capture transport and cleared scopes.
+
+    """
+    helper = SentryTestHelper()
+    with helper.use_client(sentry_session_client) as client:
+        yield client
+
+
+class ScrubErrorRecorder(logging.Handler):
+    """Logging handler that records Scrubber errors
+
+    This only keeps the messages of ``ERROR`` and higher records from the
+    ``fillmore`` logger so it's cheap to leave on for every test. It can also
+    wrap Scrubber ``error_handler`` functions so errors are recorded even if
+    the ``fillmore`` logger is silenced.
+
+    """
+
+    def __init__(self) -> None:
+        super().__init__(level=logging.ERROR)
+        self.errors: List[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.errors.append(record.getMessage())
+
+    def wrap_error_handler(self, error_handler: Optional[Callable]) -> Callable:
+        """Returns an error_handler that records errors and calls error_handler"""
+
+        def recording_error_handler(msg: str) -> None:
+            # Scrubbers log errors before calling the error_handler, so skip
+            # errors the handler already recorded
+            if not self.errors or self.errors[-1] != msg:
+                self.errors.append(msg)
+            if error_handler is not None:
+                error_handler(msg)
+
+        return recording_error_handler
+
+
+@contextmanager
+def record_scrub_errors(
+    *scrubbers: Scrubber,
+) -> Generator[ScrubErrorRecorder, None, None]:
+    """Records Scrubber errors in the block
+
+    Errors logged to the ``fillmore`` logger are recorded. Errors from the
+    Scrubbers passed in are recorded through their ``error_handler`` as well.
+
+    :arg scrubbers: Scrubbers to record errors from through their
+        ``error_handler``
+
+    """
+    recorder = ScrubErrorRecorder()
+    logger = logging.getLogger("fillmore")
+    logger.addHandler(recorder)
+
+    error_handlers: Dict[Scrubber, Any] = {}
+    for scrubber in scrubbers:
+        error_handlers[scrubber] = scrubber.error_handler
+        scrubber.error_handler = recorder.wrap_error_handler(scrubber.error_handler)
+
+    try:
+        yield recorder
+    finally:
+        logger.removeHandler(recorder)
+        for scrubber, error_handler in error_handlers.items():
+            scrubber.error_handler = error_handler
+
+
+def _format_errors(errors: List[str]) -> str:
+    lines = [f"  {error}" for error in errors]
+    return f"{len(errors)} scrubber errors:\n" + "\n".join(lines)
+
+
+@contextmanager
+def assert_no_scrub_errors(
+    *scrubbers: Scrubber,
+) -> Generator[ScrubErrorRecorder, None, None]:
+    """Asserts no Scrubber errors are recorded in the block
+
+    Usage::
+
+        with assert_no_scrub_errors():
+            # Do things that send Sentry events
+            ...
+
+    :arg scrubbers: Scrubbers to record errors from through their
+        ``error_handler``
+
+    :raises AssertionError: if any errors were recorded
+
+    """
+    with record_scrub_errors(*scrubbers) as recorder:
+        yield recorder
+
+    if recorder.errors:
+        raise AssertionError(_format_errors(recorder.errors))
+
+
+@pytest.fixture
+def no_scrub_errors() -> Generator[ScrubErrorRecorder, None, None]:
+    """Fixture that fails the test if any Scrubber errors are logged
+
+    To use this for every test, set ``fillmore_no_scrub_errors = true`` in
+    your pytest configuration.
+
+    """
+    with record_scrub_errors() as recorder:
+        yield recorder
+
+    if recorder.errors:
+        pytest.fail(_format_errors(recorder.errors), pytrace=False)
+
+
+@pytest.fixture(autouse=True)
+def _fillmore_no_scrub_errors(request: pytest.FixtureRequest) -> None:
+    if request.config.getini("fillmore_no_scrub_errors"):
+        request.getfixturevalue("no_scrub_errors")
+
+
+@attrs.define
+class ScrubTestStats:
+    """Scrub timings for a test"""
+
+    nodeid: str
+    scrubs: int = 0
+    total_ns: int = 0
+    max_ns: int = 0
+    event_bytes: int = 0
+
+
+@attrs.frozen
+class ScrubTiming:
+    """Timing for scrubbing one event"""
+
+    nodeid: str
+    duration_ns: int
+    event_bytes: int
+
+
+@attrs.define
+class RuleStats:
+    """Timings for a rule across all scrubs"""
+
+    description: str
+    calls: int = 0
+    total_ns: int = 0
+
+
+def _describe_rule(rule: _CompiledRule) -> str:
+    return f"{'.'.join(rule.path)} {list(rule.keys)}"
+
+
+def _event_size(event: Any) -> int:
+    """Returns the size of the event as JSON or 0 if it can't be serialized"""
+    try:
+        return len(json.dumps(event, default=repr))
+    except (TypeError, ValueError, RecursionError):
+        return 0
+
+
+class ScrubProfiler:
+    """Times Scrubber calls and rules while tests run
+
+    While installed, ``Scrubber.__call__`` and ``Scrubber._apply_rule`` are
+    replaced with versions that time them, so every Scrubber instance is
+    profiled.
+
+    :param enabled: whether ``--fillmore-profile`` was passed; if not, the
+        profiler is only installed for tests with a ``max_scrub_ms`` marker
+    :param keep_slowest: number of slowest scrubs to keep
+
+    """
+
+    def __init__(self, enabled: bool, keep_slowest: int = 10):
+        self.enabled = enabled
+        self.keep_slowest = keep_slowest
+        self.tests: Dict[str, ScrubTestStats] = {}
+        self.rules: Dict[Tuple[int, int], RuleStats] = {}
+        # Min-heap of (duration, counter, timing) for the slowest scrubs
+        self._slowest: List[Tuple[int, int, ScrubTiming]] = []
+        self._counter = 0
+        self._current: Optional[ScrubTestStats] = None
+        self._lock = threading.Lock()
+        self._original: Optional[Tuple[Callable, Callable]] = None
+
+    def install(self) -> None:
+        """Patches Scrubber to time calls"""
+        if self._original is not None:
+            return
+
+        original_call = Scrubber.__call__
+        original_apply_rule = Scrubber._apply_rule
+        self._original = (original_call, original_apply_rule)
+        profiler = self
+
+        def timed_call(scrubber: Scrubber, event: dict, hint: Any) -> dict:
+            # Sizes are only reported in the summary, so skip the cost of
+            # serializing when only checking max_scrub_ms
+            event_bytes = _event_size(event) if profiler.enabled else 0
+            start = time.perf_counter_ns()
+            try:
+                return original_call(scrubber, event, hint)
+            finally:
+                profiler._record_scrub(time.perf_counter_ns() - start, event_bytes)
+
+        def timed_apply_rule(
+            scrubber: Scrubber, rule: _CompiledRule, event: dict
+        ) -> None:
+            start = time.perf_counter_ns()
+            try:
+                original_apply_rule(scrubber, rule, event)
+            finally:
+                profiler._record_rule(scrubber, rule, time.perf_counter_ns() - start)
+
+        Scrubber.__call__ = timed_call  # type: ignore[method-assign,assignment]
+        Scrubber._apply_rule = timed_apply_rule  # type: ignore[method-assign,assignment]
+
+    def uninstall(self) -> None:
+        """Restores Scrubber"""
+        if self._original is None:
+            return
+        original_call, original_apply_rule = self._original
+        Scrubber.__call__ = original_call  # type: ignore[method-assign,assignment]
+        Scrubber._apply_rule = original_apply_rule  # type: ignore[method-assign,assignment]
+        self._original = None
+
+    def _record_scrub(self, duration_ns: int, event_bytes: int) -> None:
+        with self._lock:
+            stats = self._current
+            if stats is None:
+                return
+            stats.scrubs += 1
+            stats.total_ns += duration_ns
+            stats.max_ns = max(stats.max_ns, duration_ns)
+            stats.event_bytes += event_bytes
+
+            if not self.enabled:
+                return
+            timing = ScrubTiming(
+                nodeid=stats.nodeid, duration_ns=duration_ns, event_bytes=event_bytes
+            )
+            self._counter += 1
+            item = (duration_ns, self._counter, timing)
+            if len(self._slowest) < self.keep_slowest:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heappushpop(self._slowest, item)
+
+    def _record_rule(
+        self, scrubber: Scrubber, rule: _CompiledRule, duration_ns: int
+    ) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            key = (id(scrubber), rule.index)
+            stats = self.rules.get(key)
+            if stats is None:
+                stats = self.rules[key] = RuleStats(description=_describe_rule(rule))
+            stats.calls += 1
+            stats.total_ns += duration_ns
+
+    @contextmanager
+    def profile_test(self, nodeid: str) -> Generator[ScrubTestStats, None, None]:
+        """Records scrubs in the block for the test"""
+        stats = ScrubTestStats(nodeid=nodeid)
+        self.install()
+        with self._lock:
+            self._current = stats
+        try:
+            yield stats
+        finally:
+            with self._lock:
+                self._current = None
+            if self.enabled:
+                if stats.scrubs:
+                    self.tests[nodeid] = stats
+            else:
+                self.uninstall()
+
+    def slowest_scrubs(self) -> List[ScrubTiming]:
+        """Returns the slowest scrubs, slowest first"""
+        return [timing for _, _, timing in sorted(self._slowest, reverse=True)]
+
+    def summary_lines(self, limit: int = 10) -> List[str]:
+        """Returns lines of a summary of the slowest tests, scrubs, and rules"""
+        scrubs = sum(stats.scrubs for stats in self.tests.values())
+        total_ms = sum(stats.total_ns for stats in self.tests.values()) / 1_000_000
+        event_bytes = sum(stats.event_bytes for stats in self.tests.values())
+        lines = [
+            f"{scrubs} scrubs in {len(self.tests)} tests took {total_ms:.2f} ms; "
+            + f"{event_bytes} event bytes"
+        ]
+        if not scrubs:
+            return lines
+
+        lines.append("")
+        lines.append("Slowest tests by total scrub time:")
+        tests = sorted(self.tests.values(), key=lambda stats: -stats.total_ns)
+        for stats in tests[:limit]:
+            lines.append(
+                f"  {stats.total_ns / 1_000_000:>10.3f} ms  {stats.scrubs:>6} scrubs  "
+                + stats.nodeid
+            )
+
+        lines.append("")
+        lines.append("Slowest scrubs:")
+        for timing in self.slowest_scrubs()[:limit]:
+            lines.append(
+                f"  {timing.duration_ns / 1_000_000:>10.3f} ms  "
+                + f"{timing.event_bytes:>8} bytes  {timing.nodeid}"
+            )
+
+        lines.append("")
+        lines.append("Slowest rules by total time:")
+        rules = sorted(self.rules.values(), key=lambda stats: -stats.total_ns)
+        for rule_stats in rules[:limit]:
+            lines.append(
+                f"  {rule_stats.total_ns / 1_000_000:>10.3f} ms  "
+                + f"{rule_stats.calls:>6} calls  {rule_stats.description}"
+            )
+        return lines
+
+
+_PROFILER_KEY = pytest.StashKey[ScrubProfiler]()
+
+
+#: Directory next to test files that snapshots are stored in
+SNAPSHOT_DIR = "__snapshots__"
+
+
+class Snapshot:
+    """Compares events to snapshots stored with the tests
+
+    Snapshots for a test module are stored in
+    ``__snapshots__/<module name>.jsonl`` next to the module. Use the
+    ``snapshot`` fixture rather than creating this directly.
+
+    """
+
+    def __init__(
+        self, snapshot_file: SnapshotFile, test_name: str, update: bool
+    ) -> None:
+        self.snapshot_file = snapshot_file
+        self.test_name = test_name
+        self.update = update
+        self._count = 0
+
+    def _next_name(self) -> str:
+        name = self.test_name if self._count == 0 else f"{self.test_name}-{self._count}"
+        self._count += 1
+        return name
+
+    def assert_match(
+        self,
+        event: Dict[str, Any],
+        scrubber: Optional[Scrubber] = None,
+        name: Optional[str] = None,
+    ) -> None:
+        """Scrubs and normalizes an event and compares it to the snapshot
+
+        With ``--update-snapshots``, this saves the event as the snapshot
+        instead.
+
+        :arg event: the event; it's not changed
+        :arg scrubber: Scrubber to scrub a copy of the event with first
+        :arg name: name of the snapshot; defaults to the test name followed by
+            ``-1``, ``-2``, etc for calls after the first one in a test
+
+        :raises AssertionError: if the snapshot is missing or different
+
+        """
+        if name is None:
+            name = self._next_name()
+
+        if scrubber is not None:
+            event = scrubber(copy.deepcopy(event), {})
+        # Round-trip through JSON so the event compares the same way as the
+        # stored snapshot
+        normalized = json.loads(json.dumps(normalize_event(event), default=str))
+
+        if self.update:
+            self.snapshot_file.set(name, normalized)
+            return
+
+        if name not in self.snapshot_file:
+            raise AssertionError(
+                f"no snapshot {name!r} in {self.snapshot_file.path}; run pytest "
+                + "with --update-snapshots to create it"
+            )
+
+        differences = diff_structure(
+            self.snapshot_file.get(name), normalized, max_differences=20, compact=True
+        )
+        if differences:
+            lines = [f"event doesn't match snapshot {name!r}:"]
+            for difference in differences:
+                lines.append(f"  {difference['path']}: {difference['msg']}")
+            lines.append("run pytest with --update-snapshots to update it")
+            raise AssertionError("\n".join(lines))
+
+
+_SNAPSHOT_FILES_KEY = pytest.StashKey[Dict[Path, SnapshotFile]]()
+
+
+@pytest.fixture
+def snapshot(request: pytest.FixtureRequest) -> Snapshot:
+    """Compares scrubbed events to snapshots stored with the tests
+
+    Usage::
+
+        def test_scrubbing(snapshot):
+            snapshot.assert_match(event, scrubber=scrubber)
+
+    Run pytest with ``--update-snapshots`` to create or update snapshots.
+
+    """
+    test_path = Path(request.node.path)
+    path = test_path.parent / SNAPSHOT_DIR / f"{test_path.stem}.jsonl"
+    # Each snapshot file is loaded once the first time a test in the module
+    # uses it
+    snapshot_files = request.config.stash[_SNAPSHOT_FILES_KEY]
+    if path not in snapshot_files:
+        snapshot_files[path] = SnapshotFile(path)
+
+    return Snapshot(
+        snapshot_file=snapshot_files[path],
+        # Test names without the module so tests in classes don't collide
+        test_name=request.node.nodeid.split("::", 1)[-1],
+        update=request.config.getoption("update_snapshots"),
+    )
+
+
+# This is an old-style hookwrapper so the plugin works with pytest<8
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item: pytest.Item) -> Generator[None, Any, None]:
+    profiler = item.config.stash[_PROFILER_KEY]
+    marker = item.get_closest_marker("max_scrub_ms")
+    if not profiler.enabled and marker is None:
+        yield
+        return
+
+    with profiler.profile_test(item.nodeid) as stats:
+        outcome = yield
+
+    # Don't hide the test's own failure
+    if marker is None or outcome.excinfo is not None:
+        return
+
+    max_ms = marker.args[0] if marker.args else marker.kwargs["ms"]
+    if stats.max_ns > max_ms * 1_000_000:
+        exc = pytest.fail.Exception(
+            f"scrubbing an event took {stats.max_ns / 1_000_000:.3f} ms; "
+            + f"max_scrub_ms is {max_ms}",
+            pytrace=False,
+        )
+        if hasattr(outcome, "force_exception"):
+            outcome.force_exception(exc)
+        else:
+            # pluggy<1.1 doesn't have force_exception
+            raise exc
+
+
+def pytest_terminal_summary(terminalreporter: Any, config: pytest.Config) -> None:
+    profiler = config.stash.get(_PROFILER_KEY, None)
+    if profiler is None or not profiler.enabled:
+        return
+
+    terminalreporter.section("fillmore scrub profile")
+    for line in profiler.summary_lines():
+        terminalreporter.write_line(line)
+
+
+def pytest_sessionfinish(session: pytest.Session) -> None:
+    for snapshot_file in session.config.stash.get(_SNAPSHOT_FILES_KEY, {}).values():
+        snapshot_file.save()
+
+
+def pytest_unconfigure(config: pytest.Config) -> None:
+    profiler = config.stash.get(_PROFILER_KEY, None)
+    if profiler is not None:
+        profiler.uninstall()
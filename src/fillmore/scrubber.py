@@ -5,10 +5,21 @@
 import importlib
 import logging
 from urllib.parse import parse_qsl, urlencode
-from typing import Any, Callable, Generator, List, Optional, Union
-
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 import attrs
 
+from fillmore._shards import _Shard, _ThreadShards
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -43,8 +54,11 @@ def build_scrub_cookies(params: List[str]) -> Callable:
 
     """
 
+    # Freeze the params so the scrub function doesn't share mutable state with
+    # the caller
+    to_scrub = params if params is ALL_COOKIE_KEYS else frozenset(params)
+
     def _scrub_cookies(value: Union[str, dict, list]) -> Union[str, dict, list]:
-        to_scrub = params
 
         if not value:
             return value
@@ -119,8 +133,11 @@ def build_scrub_query_string(params: List[str]) -> Callable:
 
     """
 
+    # Freeze the params so the scrub function doesn't share mutable state with
+    # the caller
+    to_scrub = params if params is ALL_QUERY_STRING_KEYS else frozenset(params)
+
     def _scrub_query_string(value: Union[str, list, dict]) -> Union[str, list, dict]:
-        to_scrub = params
         if not value:
             return value
 
@@ -252,11 +269,54 @@ SCRUB_RULES_DEFAULT: List[Rule] = [
 ]
 
 
+@attrs.frozen
+class _CompiledRule:
+    """Immutable form of a Rule used by the Scrubber"""
+
+    index: int
+    path: Tuple[str, ...]
+    keys: Tuple[str, ...]
+    scrub: Callable
+
+
+@attrs.frozen
+class ScrubberStats:
+    """Counts of what a Scrubber has done
+
+    :param events: number of events scrubbed
+    :param errors: number of errors reported
+    :param rule_matches: number of values scrubbed by each rule in the order
+        the rules were passed to the Scrubber
+
+    """
+
+    events: int
+    errors: int
+    rule_matches: Tuple[int, ...]
+
+
+class _StatsShard(_Shard):
+    """Stats for a single thread"""
+
+    __slots__ = ("events", "errors", "rule_matches")
+
+    def __init__(self, rule_count: int) -> None:
+        self.events = 0
+        self.errors = 0
+        self.rule_matches = [0] * rule_count
+
+    def merge(self, other: "_StatsShard") -> None:
+        self.events += other.events
+        self.errors += other.errors
+        for i, count in enumerate(other.rule_matches):
+            self.rule_matches[i] += count
+
+
 class RulePathError(Exception):
     """The rule path doesn't match the structure of the event"""
 
 
-def _get_target_dicts(event: dict, path: List[str]) -> Generator[dict, None, None]:
+def _get_target_dicts(event: dict, path: Sequence[str]) -> Generator[dict, None, None]:
     """Given a path, yields the target dicts.
 
     Keys should be dict keys. To traverse all the items in an array value, use ``[]``.
@@ -325,6 +385,13 @@ class Scrubber:
     If a scrub rule kicks up an error, then the configured ``error_handler`` is
     called.
 
+    Rules are compiled when the Scrubber is created and the Scrubber doesn't
+    change them, so a single Scrubber can be shared by all threads. Setting
+    ``rules`` compiles the new rules and resets the stats; don't do that while
+    other threads are using the Scrubber.
+
+    Copies and unpickled Scrubbers have their own stats starting at 0.
+
     """
 
     def __init__(
@@ -342,8 +409,62 @@ class Scrubber:
             By default, this logs an exception.
 
         """
-        self.rules = rules
         self.error_handler = error_handler
+        self.rules = rules
+
+    def _new_shards(self) -> _ThreadShards[_StatsShard]:
+        # Each thread counts things in its own shard so counting doesn't need a
+        # lock
+        rule_count = len(self._compiled_rules)
+        return _ThreadShards(lambda: _StatsShard(rule_count))
+
+    @property
+    def rules(self) -> Tuple[Rule, ...]:
+        """The Scrubber's rules"""
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules: Sequence[Rule]) -> None:
+        self._rules = tuple(rules)
+        self._compiled_rules = tuple(
+            _CompiledRule(
+                index=i,
+                path=tuple(rule.path),
+                keys=tuple(rule.keys),
+                scrub=rule.scrub,
+            )
+            for i, rule in enumerate(self._rules)
+        )
+        self._shards = self._new_shards()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Thread-local shards can't be copied or pickled and copies shouldn't
+        # share them, so copies get new ones
+        state = self.__dict__.copy()
+        del state["_shards"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._shards = self._new_shards()
+
+    def _get_shard(self) -> _StatsShard:
+        return self._shards.get()
+
+    def stats(self) -> ScrubberStats:
+        """Returns the counts of what this Scrubber has done across all threads"""
+        shards = self._shards.shards()
+
+        rule_matches = [0] * len(self._compiled_rules)
+        for shard in shards:
+            for i, count in enumerate(shard.rule_matches):
+                rule_matches[i] += count
+
+        return ScrubberStats(
+            events=sum(shard.events for shard in shards),
+            errors=sum(shard.errors for shard in shards),
+            rule_matches=tuple(rule_matches),
+        )
 
     def __call__(self, event: dict, hint: Any) -> dict:
         """Implements before_send function interface and scrubs Sentry event
@@ -355,44 +476,80 @@ class Scrubber:
         all be coming from the "fillmore.scrubber" logger.
 
         """
-        for rule in self.rules:
-            try:
-                for parent in _get_target_dicts(event, rule.path):
-                    if not parent:
-                        continue
-
-                    for key in rule.keys:
-                        if key not in parent:
-                            continue
-
-                        val = parent[key]
-
-                        try:
-                            filtered_val = rule.scrub(val)
-                        except Exception as inner_exc:
-                            msg = f"scrub fun error: {rule.scrub.__name__}, error: {inner_exc}"
-                            LOGGER.exception(msg)
-                            if self.error_handler is not None:
-                                try:
-                                    self.error_handler(msg)
-                                except Exception:
-                                    LOGGER.exception(
-                                        f"error in error_handler {self.error_handler.__name__}"
-                                    )
-
-                            filtered_val = "ERROR WHEN SCRUBBING"
-
-                        parent[key] = filtered_val
-
-            except Exception as outer_exc:
-                msg = f"scrubber error: error: {outer_exc}"
-                LOGGER.exception(msg)
-                if self.error_handler is not None:
-                    try:
-                        self.error_handler(msg)
-                    except Exception:
-                        LOGGER.exception(
-                            f"error in error_handler {self.error_handler.__name__}"
-                        )
+        self._get_shard().events += 1
+
+        for rule in self._compiled_rules:
+            self._apply_rule(rule, event)
 
         return event
+
+    def _apply_rule(self, rule: _CompiledRule, event: dict) -> None:
+        """Applies a single rule to the event"""
+        try:
+            for parent in _get_target_dicts(event, rule.path):
+                self._scrub_keys(rule, parent)
+
+        except Exception as outer_exc:
+            self._report_error(f"scrubber error: error: {outer_exc}")
+
+    def _scrub_keys(self, rule: _CompiledRule, parent: dict) -> None:
+        """Scrubs the values of the rule's keys in the target dict"""
+        if not parent:
+            return
+
+        for key in rule.keys:
+            if key not in parent:
+                continue
+
+            parent[key] = self._scrub_value(rule, parent[key])
+
+    def _scrub_value(self, rule: _CompiledRule, val: Any) -> Any:
+        """Runs the rule's scrub function on a value and returns the result"""
+        self._get_shard().rule_matches[rule.index] += 1
+        try:
+            return rule.scrub(val)
+        except Exception as inner_exc:
+            self._report_error(
+                f"scrub fun error: {rule.scrub.__name__}, error: {inner_exc}"
+            )
+            return "ERROR WHEN SCRUBBING"
+
+    def _report_error(self, msg: str) -> None:
+        """Logs the error and passes it to the error_handler if there is one
+
+        This must be called from an ``except`` block.
+
+        """
+        self._get_shard().errors += 1
+        LOGGER.exception(msg)
+        if self.error_handler is not None:
+            try:
+                self.error_handler(msg)
+            except Exception:
+                LOGGER.exception(
+                    f"error in error_handler {self.error_handler.__name__}"
+                )
+
+
+def load_scrubber(spec: str) -> Scrubber:
+    """Loads a Scrubber from a ``module:name`` or ``module.name`` spec
+
+    :raises ValueError: if the spec doesn't point to a Scrubber
+
+    """
+    if ":" in spec:
+        module_name, name = spec.split(":", 1)
+    elif "." in spec:
+        module_name, name = spec.rsplit(".", 1)
+    else:
+        raise ValueError(f"{spec!r} is not a module:name or module.name spec")
+
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as exc:
+        raise ValueError(f"cannot import {module_name!r}: {exc}") from exc
+
+    scrubber = getattr(module, name, None)
+    if not isinstance(scrubber, Scrubber):
+        raise ValueError(f"{spec!r} is not a Scrubber")
+    return scrubber
@@ -0,0 +1,391 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Scrubbing for serialized Sentry events.
+
+:py:class:`fillmore.scrubber.Scrubber` works on event dicts. For very large
+events, holding the whole dict, scrubbing it, and serializing it again takes a
+lot of memory. The functions here scrub serialized event JSON as a stream of
+tokens, so memory use depends on the size of the largest value that gets
+scrubbed (and the largest key) and not the size of the event. Values that
+aren't scrubbed are copied to the output as they're read.
+
+"""
+
+import codecs
+import io
+import json
+import re
+from typing import Any, Callable, IO, List, Set, Tuple
+
+import attrs
+
+from fillmore.scrubber import _get_target_dicts, RulePathError, Scrubber
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+
+# As much of a string as possible up to the closing quote: characters that
+# don't need escaping and valid escape sequences
+_STRING_PART_RE = re.compile(
+    r'[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*'
+)
+
+# The longest escape sequence is \uXXXX
+_MAX_ESCAPE_LENGTH = 6
+
+# Characters up to the next delimiter for a bare value
+_LITERAL_RE = re.compile(r'[^ \t\n\r{}\[\]:,"]*')
+
+# Bare values json.loads accepts, including the NaN and Infinity that
+# json.dumps writes by default
+_VALID_LITERAL_RE = re.compile(
+    r"true|false|null|NaN|-?Infinity"
+    + r"|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?"
+)
+
+
+# (rule index, index into rule path)
+_State = Tuple[int, int]
+
+
+class StreamError(Exception):
+    """The stream doesn't contain valid JSON"""
+
+
+class _TokenReader:
+    """Reads JSON from a file-like object one chunk at a time
+
+    The buffer only holds text that hasn't been consumed yet. Strings and bare
+    values are scanned from where the last scan stopped, so reading a value
+    that spans many chunks takes time proportional to its size.
+
+    """
+
+    def __init__(self, fp: IO, chunk_size: int) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> None:
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        if isinstance(data, bytes):
+            data = self.decoder.decode(data, final=self.eof)
+        # Drop the text we've already consumed
+        self.buf = self.buf[self.pos :] + data
+        self.pos = 0
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character or "" at the end"""
+        while True:
+            self.pos = _WHITESPACE_RE.match(self.buf, self.pos).end()  # type: ignore[union-attr]
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def advance(self) -> str:
+        """Consumes the next character and returns it"""
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def scan_string(self, emit: Callable[[str], None]) -> None:
+        """Passes the string starting at the next character to emit in parts
+
+        The parts include the quotes and escape sequences as they are in the
+        stream.
+
+        """
+        emit(self.advance())
+        while True:
+            end = _STRING_PART_RE.match(self.buf, self.pos).end()  # type: ignore[union-attr]
+            if end > self.pos:
+                emit(self.buf[self.pos : end])
+                self.pos = end
+
+            if self.pos < len(self.buf):
+                char = self.buf[self.pos]
+                if char == '"':
+                    emit(char)
+                    self.pos += 1
+                    return
+                # An escape sequence might continue in the next chunk
+                incomplete_escape = (
+                    char == "\\" and len(self.buf) - self.pos < _MAX_ESCAPE_LENGTH
+                )
+                if not incomplete_escape or self.eof:
+                    raise StreamError(
+                        f"invalid string at {self.buf[self.pos : self.pos + 20]!r}"
+                    )
+            elif self.eof:
+                raise StreamError("unexpected end of stream in string")
+
+            self._fill()
+
+    def read_string(self) -> str:
+        """Reads the string starting at the next character as JSON text"""
+        parts: List[str] = []
+        self.scan_string(parts.append)
+        return "".join(parts)
+
+    def read_literal(self) -> str:
+        """Reads the number, true, false, or null at the next character"""
+        parts = []
+        while True:
+            end = _LITERAL_RE.match(self.buf, self.pos).end()  # type: ignore[union-attr]
+            parts.append(self.buf[self.pos : end])
+            self.pos = end
+            if self.pos < len(self.buf) or self.eof:
+                break
+            self._fill()
+
+        literal = "".join(parts)
+        if not _VALID_LITERAL_RE.fullmatch(literal):
+            raise StreamError(f"invalid JSON value {literal[:20]!r}")
+        return literal
+
+    def read_value(self) -> Any:
+        """Reads the whole value at the next character and returns it decoded"""
+        parts: List[str] = []
+        depth = 0
+        while True:
+            char = self.peek()
+            if char == "":
+                raise StreamError("unexpected end of stream")
+            if char == '"':
+                self.scan_string(parts.append)
+            elif char in "{}[]:,":
+                parts.append(self.advance())
+                if char in "{[":
+                    depth += 1
+                elif char in "}]":
+                    depth -= 1
+            else:
+                parts.append(self.read_literal())
+            if depth <= 0:
+                break
+
+        try:
+            return json.loads("".join(parts))
+        except ValueError as exc:
+            raise StreamError(f"invalid JSON value: {exc}") from exc
+
+
+@attrs.define
+class _Container:
+    """A dict or list being read"""
+
+    is_dict: bool
+    # Rules that might apply to the container's values
+    states: Tuple[_State, ...]
+    # Number of items read so far
+    items: int = 0
+
+
+class _Writer:
+    """Buffers small writes to a text or binary file-like object"""
+
+    def __init__(self, fp: IO, chunk_size: int) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.binary = not isinstance(fp, io.TextIOBase)
+        self.parts: List[str] = []
+        self.size = 0
+
+    def write(self, text: str) -> None:
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        data = "".join(self.parts)
+        self.fp.write(data.encode("utf-8") if self.binary else data)
+        self.parts = []
+        self.size = 0
+
+
+def scrub_json_stream(
+    scrubber: Scrubber,
+    infp: IO,
+    outfp: IO,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> None:
+    """Scrubs serialized Sentry events from infp and writes them to outfp
+
+    This applies the rules of the scrubber to the events in the stream without
+    decoding the whole event. Only values that get scrubbed are decoded.
+
+    ``infp`` can hold a single JSON event, like files written by
+    :py:class:`fillmore.test.SaveEvents`, or a series of them, like a JSONL
+    file. Each event is written to ``outfp`` on its own line.
+
+    Errors in scrub functions and rule paths are handled the same way the
+    scrubber handles them.
+
+    :arg scrubber: the Scrubber with the rules to apply
+    :arg infp: binary or text file-like object to read events from
+    :arg outfp: binary or text file-like object to write scrubbed events to
+    :arg chunk_size: size of reads and writes
+
+    :raises StreamError: if the stream doesn't contain valid JSON
+
+    """
+    rules = scrubber._compiled_rules
+    root_states = tuple((i, 0) for i in range(len(rules)))
+    broken: Set[int] = set()
+
+    reader = _TokenReader(infp, chunk_size)
+    writer = _Writer(outfp, chunk_size)
+
+    # The containers we're in
+    stack: List[_Container] = []
+
+    def path_error(rule_index: int, path_index: int) -> None:
+        broken.add(rule_index)
+        partial_path = ".".join(rules[rule_index].path[0 : path_index + 1])
+        try:
+            raise RulePathError(f"path {partial_path!r} doesn't match event structure")
+        except RulePathError as exc:
+            scrubber._report_error(f"scrubber error: error: {exc}")
+
+    def start_value(states: Tuple[_State, ...]) -> None:
+        char = reader.peek()
+        if char == "":
+            raise StreamError("unexpected end of stream")
+        if char in "}]:,":
+            raise StreamError(f"expected value, got {char!r}")
+
+        child_states = []
+        for rule_index, path_index in states:
+            if rule_index in broken:
+                continue
+            path = rules[rule_index].path
+            if path_index < len(path) and path[path_index] == "[]":
+                if char == "[":
+                    child_states.append((rule_index, path_index + 1))
+                else:
+                    path_error(rule_index, path_index)
+            elif char == "{":
+                child_states.append((rule_index, path_index))
+
+        if char == "{" or char == "[":
+            stack.append(_Container(is_dict=char == "{", states=tuple(child_states)))
+            writer.write(reader.advance())
+        elif char == '"':
+            # Strings that aren't scrubbed go straight through without being
+            # held in memory
+            reader.scan_string(writer.write)
+        else:
+            writer.write(reader.read_literal())
+
+    def scrub_value(value: Any, exact: List[int], deeper: List[_State]) -> Any:
+        # Apply the rules in order so the result is the same as the scrubber's
+        path_indexes = dict(deeper)
+        for rule_index in sorted(set(exact) | set(path_indexes)):
+            rule = rules[rule_index]
+            if rule_index in path_indexes:
+                try:
+                    path = rule.path[path_indexes[rule_index] :]
+                    for parent in _get_target_dicts(value, path):
+                        scrubber._scrub_keys(rule, parent)
+                except Exception as exc:
+                    scrubber._report_error(f"scrubber error: error: {exc}")
+                continue
+
+            value = scrubber._scrub_value(rule, value)
+        return value
+
+    while True:
+        char = reader.peek()
+        if not stack:
+            if char == "":
+                break
+            scrubber._get_shard().events += 1
+            # A path error stops a rule for the rest of the event like it does
+            # in the scrubber, but not for the events after it
+            broken.clear()
+            start_value(root_states)
+
+        elif char == ("}" if stack[-1].is_dict else "]"):
+            stack.pop()
+            writer.write(reader.advance())
+
+        else:
+            container = stack[-1]
+            if container.items:
+                if char != ",":
+                    close = "}" if container.is_dict else "]"
+                    raise StreamError(f"expected ',' or {close!r}, got {char!r}")
+                writer.write(reader.advance())
+                char = reader.peek()
+            container.items += 1
+
+            if not container.is_dict:
+                start_value(container.states)
+
+            else:
+                # Dict key followed by a value
+                if char != '"':
+                    raise StreamError(f"expected key, got {char!r}")
+                key_text = reader.read_string()
+                if reader.peek() != ":":
+                    raise StreamError(f"expected ':' after key {key_text}")
+                reader.advance()
+                writer.write(key_text)
+                writer.write(":")
+
+                exact = []
+                deeper = []
+                if container.states:
+                    key = json.loads(key_text)
+                    for rule_index, path_index in container.states:
+                        if rule_index in broken:
+                            continue
+                        rule = rules[rule_index]
+                        if path_index == len(rule.path):
+                            if key in rule.keys:
+                                exact.append(rule_index)
+                        elif rule.path[path_index] == key:
+                            deeper.append((rule_index, path_index + 1))
+
+                if exact:
+                    value = scrub_value(reader.read_value(), exact, deeper)
+                    writer.write(json.dumps(value))
+                else:
+                    start_value(tuple(deeper))
+
+        if not stack:
+            # Finished an event
+            writer.write("\n")
+
+    if stack:
+        raise StreamError("unexpected end of stream")
+    writer.flush()
+
+
+def scrub_json_bytes(scrubber: Scrubber, data: bytes) -> bytes:
+    """Scrubs serialized Sentry event data and returns the scrubbed data
+
+    :arg scrubber: the Scrubber with the rules to apply
+    :arg data: the serialized event
+
+    :returns: the scrubbed serialized event
+
+    :raises StreamError: if the data isn't valid JSON
+
+    """
+    outfp = io.BytesIO()
+    scrub_json_stream(scrubber, io.BytesIO(data), outfp)
+    return outfp.getvalue()
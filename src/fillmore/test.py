@@ -2,22 +2,70 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from contextlib import contextmanager
-from itertools import zip_longest
+import abc
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import copy
+from datetime import datetime, timedelta, timezone
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib
+from itertools import islice, zip_longest
 import json
 import logging
+import multiprocessing
+from multiprocessing.pool import AsyncResult
+import os
 from pathlib import Path
-from typing import Any, Dict, Generator, List
+import queue
+import random
+import re
+import reprlib
+import string
+import sys
+import threading
+import time
+import tracemalloc
+from typing import (
+    Any,
+    AsyncGenerator,
+    Deque,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+    Union,
+)
 from unittest.mock import ANY, patch
-from urllib.parse import urlparse
+from urllib.parse import urlencode, urlparse
 import uuid
+import weakref
 
+import attrs
 import sentry_sdk
 
-from sentry_sdk.envelope import Envelope
+from sentry_sdk.envelope import Envelope, Item, PayloadRef
 from sentry_sdk.transport import Transport
+from sentry_sdk.utils import json_dumps
 
-from fillmore.scrubber import Scrubber
+from fillmore.corpus import (
+    COMPRESSION_SUFFIXES,
+    CorpusIndex,
+    event_key_paths,
+    is_compression_available,
+    iter_event_files,
+    iter_file_events,
+    open_compressed,
+)
+from fillmore.libsentry import set_up_sentry
+from fillmore.scrubber import load_scrubber, MASK_TEXT, Scrubber
 
 
 LOGGER = logging.getLogger(__name__)
@@ -49,32 +97,232 @@ def get_sentry_base_url(sentry_dsn: str) -> str:
     return f"{parsed_dsn.scheme}://{netloc}/"
 
 
+@attrs.frozen
+class CaptureStats:
+    """Running counts of what a SentryTestHelper captured
+
+    These count everything captured since the last reset, including envelopes
+    that were dropped from the ring buffer.
+
+    :param envelopes: number of envelopes captured
+    :param items_by_type: envelope item type -> number of items
+    :param bytes_by_type: envelope item type -> total size of item payloads in
+        bytes
+    :param dropped_envelopes: number of envelopes dropped from the ring buffer
+
+    """
+
+    envelopes: int
+    items_by_type: Dict[str, int]
+    bytes_by_type: Dict[str, int]
+    dropped_envelopes: int
+
+    @property
+    def bytes(self) -> int:
+        """Total size of item payloads in bytes"""
+        return sum(self.bytes_by_type.values())
+
+
+def _set_future_done(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+def _payload_size(payload: PayloadRef) -> int:
+    """Returns the size of a serialized envelope item payload
+
+    ``PayloadRef.get_bytes()`` keeps the bytes it serializes, which would
+    double the memory kept for each captured payload, so this doesn't use it.
+
+    """
+    if payload.bytes is not None:
+        return len(payload.bytes)
+    if payload.path is not None:
+        try:
+            return os.path.getsize(payload.path)
+        except OSError:
+            return 0
+    if payload.json is not None:
+        return len(json_dumps(payload.json))
+    return 0
+
+
 class _CaptureTransport(Transport):
-    """Sentry transport that captures emitted events."""
+    """Sentry transport that captures emitted events.
+
+    Payloads are pulled out of envelopes and indexed by item type and event id
+    as envelopes are captured so accessing them doesn't walk all the envelopes.
+
+    If max_envelopes is set, only the most recent max_envelopes envelopes and
+    their payloads are kept.
 
-    def __init__(self) -> None:
+    """
+
+    def __init__(self, max_envelopes: Optional[int] = None) -> None:
+        if max_envelopes is not None and max_envelopes < 1:
+            raise ValueError("max_envelopes must be at least 1")
         Transport.__init__(self)
         self._queue = None
+        self.max_envelopes = max_envelopes
 
-        self.envelopes: List[Envelope] = []
+        # Notified when envelopes are captured
+        self._condition = threading.Condition()
+        # (loop, future, item type, count) for wait_for_items calls
+        self._async_waiters: List[
+            Tuple[asyncio.AbstractEventLoop, asyncio.Future, str, int]
+        ] = []
+        self.reset()
 
     def capture_event(self, event: Any) -> None:
         pass
 
     def capture_envelope(self, envelope: Envelope) -> None:
-        self.envelopes.append(envelope)
+        with self._condition:
+            if (
+                self.max_envelopes is not None
+                and len(self.envelopes) >= self.max_envelopes
+            ):
+                self._drop_oldest()
+
+            self.envelopes.append(envelope)
+            self._captured += 1
+
+            items = []
+            for item in envelope.items:
+                item_type = item.type or "unknown"
+                self._items_by_type[item_type] = (
+                    self._items_by_type.get(item_type, 0) + 1
+                )
+                self._bytes_by_type[item_type] = self._bytes_by_type.get(
+                    item_type, 0
+                ) + _payload_size(item.payload)
+
+                payload = item.payload.json
+                if not payload:
+                    continue
+                items.append((item.type, payload))
+                self._payloads.append(payload)
+                self._payloads_by_type.setdefault(item.type, deque()).append(payload)
+                event_id = (
+                    payload.get("event_id") if isinstance(payload, dict) else None
+                )
+                if event_id:
+                    self._payloads_by_event_id.setdefault(event_id, deque()).append(
+                        payload
+                    )
+            self._envelope_items.append(items)
+            self._condition.notify_all()
+            self._wake_async_waiters()
+
+    def _drop_oldest(self) -> None:
+        # Envelopes and payloads are kept in capture order, so the oldest
+        # envelope's payloads are at the front of each deque
+        self.envelopes.popleft()  # type: ignore[union-attr]
+        self._dropped += 1
+        for item_type, payload in self._envelope_items.popleft():
+            self._payloads.popleft()
+            self._payloads_by_type[item_type].popleft()
+            event_id = payload.get("event_id") if isinstance(payload, dict) else None
+            if event_id:
+                # Payloads with an event id are in capture order, too
+                same_id = self._payloads_by_event_id[event_id]
+                same_id.popleft()
+                if not same_id:
+                    del self._payloads_by_event_id[event_id]
 
     def envelope_payloads(self) -> List[dict]:
         """Returns a list of payloads from captured envelopes"""
-        payloads = []
-        for envelope in self.envelopes:
-            payloads.extend(
-                [item.payload.json for item in envelope.items if item.payload.json]
+        with self._condition:
+            return list(self._payloads)
+
+    def payloads_by_type(self, item_type: str) -> List[dict]:
+        """Returns a list of payloads from envelope items of the given type"""
+        with self._condition:
+            return list(self._payloads_by_type.get(item_type, []))
+
+    def find(self, event_id: str) -> Optional[dict]:
+        """Returns the first kept payload with the event id or None"""
+        with self._condition:
+            same_id = self._payloads_by_event_id.get(event_id)
+            return same_id[0] if same_id else None
+
+    def stats(self) -> CaptureStats:
+        """Returns running counts of what was captured"""
+        with self._condition:
+            return CaptureStats(
+                envelopes=self._captured,
+                items_by_type=dict(self._items_by_type),
+                bytes_by_type=dict(self._bytes_by_type),
+                dropped_envelopes=self._dropped,
             )
-        return payloads
+
+    def wait_for(self, count: int, timeout: Optional[float]) -> bool:
+        """Waits until at least count envelopes have been captured
+
+        Envelopes dropped from the ring buffer count.
+
+        :returns: True if they were captured or False if it timed out
+
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._captured >= count, timeout=timeout
+            )
+
+    def _wake_async_waiters(self) -> None:
+        waiters = []
+        for waiter in self._async_waiters:
+            loop, future, item_type, count = waiter
+            if self._items_by_type.get(item_type, 0) >= count:
+                # Envelopes can be captured in any thread, so set the result in
+                # the future's event loop
+                loop.call_soon_threadsafe(_set_future_done, future)
+            else:
+                waiters.append(waiter)
+        self._async_waiters = waiters
+
+    async def wait_for_items(
+        self, item_type: str, count: int, timeout: Optional[float]
+    ) -> bool:
+        """Waits until at least count items of item_type have been captured
+
+        :returns: True if they were captured or False if it timed out
+
+        """
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            if self._items_by_type.get(item_type, 0) >= count:
+                return True
+            future = loop.create_future()
+            self._async_waiters.append((loop, future, item_type, count))
+
+        try:
+            await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._condition:
+                self._async_waiters = [
+                    waiter for waiter in self._async_waiters if waiter[1] is not future
+                ]
+        return True
 
     def reset(self) -> None:
-        self.envelopes = []
+        with self._condition:
+            self.envelopes: Union[List[Envelope], Deque[Envelope]] = (
+                [] if self.max_envelopes is None else deque()
+            )
+            # Payloads for each envelope as (item type, payload) so they can be
+            # dropped with the envelope
+            self._envelope_items: Deque[List[Tuple[Optional[str], dict]]] = deque()
+            self._payloads: Deque[dict] = deque()
+            self._payloads_by_type: Dict[Optional[str], Deque[dict]] = {}
+            self._payloads_by_event_id: Dict[str, Deque[dict]] = {}
+
+            self._captured = 0
+            self._dropped = 0
+            self._items_by_type: Dict[str, int] = {}
+            self._bytes_by_type: Dict[str, int] = {}
 
 
 class ReuseException(Exception):
@@ -90,25 +338,87 @@ class SentryTestHelper:
     You can access emitted Envelope instances with the ``.envelopes`` property.
 
     You can access just the Envelope item payloads with ``.envelope_payloads``
-    property.
+    property. To get payloads of a specific item type, use ``.events()`` and
+    ``.transactions()``. To get the payload for a specific event id, use
+    ``.find()``.
 
     You can reset the envelope list with ``.reset()``.
 
+    For long-running tests like soak and load tests, set ``max_envelopes`` to
+    only keep the most recent envelopes. ``.stats()`` has running counts of
+    everything that was captured.
+
+    :param max_envelopes: the maximum number of envelopes to keep; None to keep
+        all of them
+
+    :raises ValueError: if max_envelopes is less than 1
+
     """
 
-    def __init__(self) -> None:
-        self._transport = _CaptureTransport()
+    def __init__(self, max_envelopes: Optional[int] = None) -> None:
+        self._transport = _CaptureTransport(max_envelopes=max_envelopes)
 
     @property
-    def envelopes(self) -> List[Envelope]:
-        """Access the captured envelopes list."""
+    def envelopes(self) -> Union[List[Envelope], Deque[Envelope]]:
+        """Access the captured envelopes list.
+
+        This is a deque if ``max_envelopes`` is set.
+
+        """
         return self._transport.envelopes
 
+    def stats(self) -> CaptureStats:
+        """Returns running counts of captured envelopes, items, and bytes"""
+        return self._transport.stats()
+
     @property
     def envelope_payloads(self) -> List[dict]:
         """Access list of all the envelope payloads."""
         return self._transport.envelope_payloads()
 
+    def wait_for(
+        self, count: int = 1, timeout: Optional[float] = 5.0
+    ) -> Union[List[Envelope], Deque[Envelope]]:
+        """Waits until at least count envelopes have been captured
+
+        Use this instead of sleeping to give sentry_sdk time to send events.
+        It returns as soon as the envelopes are captured.
+
+        :arg count: the number of envelopes to wait for; envelopes dropped
+            because of ``max_envelopes`` count
+        :arg timeout: the maximum number of seconds to wait; None to wait
+            forever
+
+        :returns: the captured envelopes
+
+        :raises TimeoutError: if fewer than count envelopes were captured
+            before the timeout
+
+        """
+        if not self._transport.wait_for(count=count, timeout=timeout):
+            raise TimeoutError(
+                f"timed out waiting for {count} envelopes; "
+                + f"captured {self.stats().envelopes}"
+            )
+        return self.envelopes
+
+    def events(self, type: str = "event") -> List[dict]:
+        """Returns payloads from envelope items of a type
+
+        :arg type: the envelope item type like ``"event"``, ``"transaction"``,
+            or ``"session"``
+
+        """
+        return self._transport.payloads_by_type(type)
+
+    def transactions(self) -> List[dict]:
+        """Returns payloads of transaction envelope items"""
+        return self._transport.payloads_by_type("transaction")
+
+    def find(self, event_id: str) -> Optional[dict]:
+        """Returns the payload with the event id or None if there isn't one"""
+        return self._transport.find(event_id)
+
     def reset(self) -> None:
         """Resets the event list."""
         self._transport.reset()
@@ -143,6 +453,109 @@ class SentryTestHelper:
         with patch.object(client, attribute="transport", new=self._transport):
             yield self
 
+    @asynccontextmanager
+    async def ainit(
+        self, *args: Any, **kwargs: Any
+    ) -> AsyncGenerator["SentryTestHelper", None]:
+        """Create a new sentry_sdk client for the current asyncio task
+
+        This is like :py:meth:`init`, but for asyncio code. Rather than setting
+        the client on the global scope, it runs the block in a new isolation
+        scope with the client set on it. Scopes are stored in contextvars, so
+        the client and anything the block adds to the scope are only visible in
+        the current task and tasks it creates. That lets concurrent tests in one
+        event loop each have their own client.
+
+        Arguments are the same as to ``sentry_sdk.Client``.
+
+        Usage::
+
+            async def test_thing():
+                helper = SentryTestHelper()
+                async with helper.ainit(before_send=scrubber) as sentry_client:
+                    await do_something_that_errors()
+                    (event,) = await sentry_client.wait_for_events(1)
+
+        """
+        client = sentry_sdk.Client(*args, **kwargs)
+
+        self._transport.reset()
+
+        with sentry_sdk.isolation_scope() as isolation_scope:
+            isolation_scope.clear()
+            isolation_scope.set_client(client)
+            sentry_sdk.Scope.get_current_scope().clear()
+
+            # Mock the transport with one that captures events
+            with patch.object(client, attribute="transport", new=self._transport):
+                yield self
+
+    async def wait_for_events(
+        self, count: int = 1, timeout: Optional[float] = 5.0, type: str = "event"
+    ) -> List[dict]:
+        """Waits until at least count events have been captured
+
+        This doesn't block the event loop while waiting.
+
+        :arg count: the number of events to wait for; events dropped because of
+            ``max_envelopes`` count
+        :arg timeout: the maximum number of seconds to wait; None to wait
+            forever
+        :arg type: the envelope item type to wait for like ``"event"`` or
+            ``"transaction"``
+
+        :returns: payloads of captured envelope items of that type
+
+        :raises TimeoutError: if fewer than count events were captured before
+            the timeout
+
+        """
+        if not await self._transport.wait_for_items(
+            item_type=type, count=count, timeout=timeout
+        ):
+            captured = self.stats().items_by_type.get(type, 0)
+            raise TimeoutError(
+                f"timed out waiting for {count} {type} items; captured {captured}"
+            )
+        return self.events(type=type)
+
+    @contextmanager
+    def use_client(
+        self, client: sentry_sdk.Client
+    ) -> Generator["SentryTestHelper", None, None]:
+        """Use an existing sentry_sdk client with fresh scopes
+
+        This is for reusing one client across many tests because creating a
+        client and setting up its integrations is slow. It sets the client on
+        the global scope, patches the client transport with one that captures
+        Sentry events, and runs the block in new isolation and current scopes
+        that are cleared so tags, user, contexts, and breadcrumbs from other
+        tests don't show up in events. Breadcrumbs in the global scope are
+        cleared, too. When the block is done, the previous client is restored.
+
+        :arg client: the sentry_sdk client to use
+
+        """
+        global_scope = sentry_sdk.Scope.get_global_scope()
+        previous_client = global_scope.client
+        global_scope.set_client(client)
+
+        self._transport.reset()
+
+        # Clear the breadcrumbs in the global scope
+        global_scope.clear_breadcrumbs()
+
+        try:
+            with sentry_sdk.isolation_scope() as isolation_scope:
+                isolation_scope.clear()
+                sentry_sdk.Scope.get_current_scope().clear()
+
+                # Mock the transport with one that captures events
+                with patch.object(client, attribute="transport", new=self._transport):
+                    yield self
+        finally:
+            global_scope.set_client(previous_client)
+
     @contextmanager
     def reuse(self) -> Generator["SentryTestHelper", None, None]:
         """Re-use the current sentry_sdk client, but patch the transport
@@ -173,6 +586,414 @@ class ConfigurationError(Exception):
     pass
 
 
+@attrs.frozen
+class _ReceivedRequest:
+    path: str
+    content_encoding: str
+    body: bytes
+
+
+def _decompress(content_encoding: str, body: bytes) -> bytes:
+    if content_encoding in ("", "identity"):
+        return body
+    if content_encoding == "gzip":
+        return gzip.decompress(body)
+    if content_encoding == "br":
+        try:
+            brotli = importlib.import_module("brotli")
+        except ImportError as exc:
+            raise ConfigurationError(
+                "decoding brotli bodies requires the brotli package"
+            ) from exc
+        return brotli.decompress(body)
+    raise ValueError(f"content encoding {content_encoding!r} is not supported")
+
+
+class _FakeSentryHandler(BaseHTTPRequestHandler):
+    server: "_FakeSentryHTTPServer"
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        self.server.fake_sentry._receive(
+            _ReceivedRequest(
+                path=self.path,
+                content_encoding=self.headers.get("Content-Encoding", "").lower(),
+                body=body,
+            )
+        )
+        response = json.dumps({"id": uuid.uuid4().hex}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Don't print a line for every request
+        pass
+
+
+class _FakeSentryHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    fake_sentry: "FakeSentryServer"
+
+
+def _item_payload(item: Item) -> Any:
+    """Returns the parsed payload of an envelope item or None"""
+    # Items parsed from a request body only have bytes
+    if item.payload.json is not None:
+        return item.payload.json
+    try:
+        return json.loads(item.payload.get_bytes())
+    except ValueError:
+        return None
+
+
+class FakeSentryServer:
+    """Local HTTP server that accepts Sentry envelopes
+
+    This runs a threaded HTTP server on localhost in the current process. Point
+    a sentry_sdk client at its ``.dsn`` and events go through the real HTTP
+    transport, including compression, to the server, which keeps them in
+    memory.
+
+    Request bodies are stored as they're received and decompressed and parsed
+    the first time envelopes are accessed, so receiving is cheap. Bodies can be
+    uncompressed, gzip, or brotli; brotli requires the ``brotli`` package.
+    Requests with bodies that can't be decompressed or parsed are left out of
+    ``.envelopes`` and listed in ``.decode_errors``.
+
+    Usage::
+
+        with FakeSentryServer() as server:
+            sentry_sdk.init(dsn=server.dsn)
+
+            # Do things that send events
+
+            sentry_sdk.flush()
+            server.wait_for(count=1)
+            (payload,) = server.events()
+
+    :param host: the host to listen on
+    :param port: the port to listen on; 0 picks a free port
+
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self._server: Optional[_FakeSentryHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+        # Notified when requests are received
+        self._condition = threading.Condition()
+        self._requests: List[_ReceivedRequest] = []
+        # Envelopes and errors from parsing the first _parsed requests
+        self._parsed = 0
+        self._envelopes: List[Envelope] = []
+        self._decode_errors: List[str] = []
+
+    def __enter__(self) -> "FakeSentryServer":
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """Starts the server in a background thread"""
+        self._server = _FakeSentryHTTPServer((self.host, self.port), _FakeSentryHandler)
+        self._server.fake_sentry = self
+        self.port = self._server.server_address[1]
+        # A short poll interval makes stopping the server fast
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            name="fillmore-fake-sentry",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the server"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def dsn(self) -> str:
+        """DSN for sentry_sdk clients to send events to this server"""
+        return f"http://public@{self.host}:{self.port}/1"
+
+    @property
+    def base_url(self) -> str:
+        """Base url of the server"""
+        return get_sentry_base_url(self.dsn)
+
+    def _receive(self, request: _ReceivedRequest) -> None:
+        with self._condition:
+            self._requests.append(request)
+            self._condition.notify_all()
+
+    @property
+    def request_count(self) -> int:
+        """Number of requests received"""
+        with self._condition:
+            return len(self._requests)
+
+    @property
+    def envelopes(self) -> List[Envelope]:
+        """Envelopes received so far"""
+        with self._condition:
+            self._parse_requests()
+            return list(self._envelopes)
+
+    @property
+    def decode_errors(self) -> List[str]:
+        """Why requests received so far couldn't be parsed as envelopes"""
+        with self._condition:
+            self._parse_requests()
+            return list(self._decode_errors)
+
+    def _parse_requests(self) -> None:
+        # Call with the condition held
+        for request in self._requests[self._parsed :]:
+            self._parsed += 1
+            try:
+                body = _decompress(request.content_encoding, request.body)
+                envelope = Envelope.deserialize(body)
+            except Exception as exc:
+                # One bad request body shouldn't hide the rest
+                self._decode_errors.append(
+                    f"request {self._parsed}: {type(exc).__name__}: {exc}"
+                )
+                continue
+            self._envelopes.append(envelope)
+
+    @property
+    def envelope_payloads(self) -> List[dict]:
+        """Payloads of all the items in envelopes received so far"""
+        payloads = []
+        for envelope in self.envelopes:
+            for item in envelope.items:
+                payload = _item_payload(item)
+                if payload:
+                    payloads.append(payload)
+        return payloads
+
+    def events(self, type: str = "event") -> List[dict]:
+        """Returns payloads from envelope items of a type
+
+        :arg type: the envelope item type like ``"event"``, ``"transaction"``,
+            or ``"session"``
+
+        """
+        payloads = []
+        for envelope in self.envelopes:
+            for item in envelope.items:
+                if item.type != type:
+                    continue
+                payload = _item_payload(item)
+                if payload:
+                    payloads.append(payload)
+        return payloads
+
+    def find(self, event_id: str) -> Optional[dict]:
+        """Returns the payload with the event id or None if there isn't one"""
+        for payload in self.envelope_payloads:
+            if isinstance(payload, dict) and payload.get("event_id") == event_id:
+                return payload
+        return None
+
+    def wait_for(self, count: int = 1, timeout: Optional[float] = 5.0) -> None:
+        """Waits until at least count envelopes have been received
+
+        :raises TimeoutError: if fewer than count envelopes were received before
+            the timeout
+
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: len(self._requests) >= count, timeout=timeout
+            ):
+                raise TimeoutError(
+                    f"timed out waiting for {count} envelopes; "
+                    + f"received {len(self._requests)}"
+                )
+
+    def reset(self) -> None:
+        """Clears received envelopes"""
+        with self._condition:
+            self._requests = []
+            self._parsed = 0
+            self._envelopes = []
+            self._decode_errors = []
+
+
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+
+class JSONFileSink:
+    """SaveEvents sink that writes each event to its own ``.json`` file
+
+    :param outputdir: the directory to save events in; it must exist
+    :param index: a :py:class:`fillmore.corpus.CorpusIndex` for a corpus that
+        includes outputdir to add files to as they're written
+
+    :raises ConfigurationError: if the outputdir doesn't exist
+
+    """
+
+    def __init__(
+        self, outputdir: Union[str, Path], index: Optional[CorpusIndex] = None
+    ):
+        self.outputdir = Path(outputdir)
+        if not self.outputdir.is_dir():
+            raise ConfigurationError(f"outputdir {outputdir} does not exist")
+        self.index = index
+
+    def write(self, data: str) -> None:
+        event_id = uuid.uuid4().hex
+        path = self.outputdir / f"{event_id}.json"
+        path.write_text(data)
+        if self.index is not None:
+            self.index.add_file(path)
+
+    def close(self) -> None:
+        pass
+
+
+class JSONLSink:
+    """SaveEvents sink that writes events to rotating, compressed JSONL files
+
+    Events are appended one per line to a file named like
+    ``events-20240102T030405-1a2b3c4d.jsonl.gz``. The file is written as
+    ``<name>.partial`` and renamed when it's rotated or the sink is closed, so
+    corpus tools only see complete files.
+
+    Files are rotated when they've had ``max_bytes`` of uncompressed event
+    data written to them or are ``max_seconds`` old, whichever comes first.
+
+    Usage::
+
+        scrubber = SaveEvents(
+            wrapped_scrubber=scrubber,
+            sink=JSONLSink("/some/path", compression="zstd"),
+            background=True,
+        )
+
+    :param outputdir: the directory to save events in; it must exist
+    :param compression: ``"gzip"``, ``"zstd"``, or None for no compression;
+        zstd requires Python 3.14 or the ``zstandard`` package
+    :param max_bytes: rotate after this many bytes of uncompressed event data;
+        None for no limit
+    :param max_seconds: rotate after the file has been open this many seconds;
+        None for no limit
+    :param index: a :py:class:`fillmore.corpus.CorpusIndex` for a corpus that
+        includes outputdir to add files to when they're finished
+
+    :raises ConfigurationError: if the outputdir doesn't exist or the
+        compression isn't available
+
+    """
+
+    def __init__(
+        self,
+        outputdir: Union[str, Path],
+        compression: Optional[str] = "gzip",
+        max_bytes: Optional[int] = 100 * 1024 * 1024,
+        max_seconds: Optional[float] = 60 * 60,
+        index: Optional[CorpusIndex] = None,
+    ):
+        self.outputdir = Path(outputdir)
+        if not self.outputdir.is_dir():
+            raise ConfigurationError(f"outputdir {outputdir} does not exist")
+
+        if not is_compression_available(compression):
+            raise ConfigurationError(f"compression {compression!r} is not available")
+
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.index = index
+
+        self._lock = threading.Lock()
+        self._fp: Optional[Any] = None
+        self._path: Optional[Path] = None
+        self._bytes_written = 0
+        self._opened_at = 0.0
+
+    def _open(self) -> None:
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        suffix = ".jsonl" + COMPRESSION_SUFFIXES.get(self.compression or "", "")
+        self._path = (
+            self.outputdir / f"events-{timestamp}-{uuid.uuid4().hex[:8]}{suffix}"
+        )
+        partial_path = self._path.with_name(self._path.name + ".partial")
+        self._fp = open_compressed(partial_path, "wb", self.compression)
+        self._bytes_written = 0
+        self._opened_at = time.monotonic()
+
+    def _rotate(self) -> None:
+        if self._fp is None or self._path is None:
+            return
+        path = self._path
+        self._fp.close()
+        self._fp = None
+        self._path = None
+        path.with_name(path.name + ".partial").rename(path)
+        if self.index is not None:
+            self.index.add_file(path)
+
+    def _should_rotate(self) -> bool:
+        if self.max_bytes is not None and self._bytes_written >= self.max_bytes:
+            return True
+        if (
+            self.max_seconds is not None
+            and time.monotonic() - self._opened_at >= self.max_seconds
+        ):
+            return True
+        return False
+
+    def write(self, data: str) -> None:
+        line = data.encode("utf-8") + b"\n"
+        with self._lock:
+            if self._fp is not None and self._should_rotate():
+                self._rotate()
+            if self._fp is None:
+                self._open()
+            assert self._fp is not None
+            self._fp.write(line)
+            self._bytes_written += len(line)
+
+    def rotate(self) -> None:
+        """Finishes the current file; the next event starts a new one"""
+        with self._lock:
+            self._rotate()
+
+    def close(self) -> None:
+        """Finishes the current file"""
+        self.rotate()
+
+
+def _close_save_events(
+    events_queue: "queue.Queue[Optional[str]]",
+    writer: Optional[threading.Thread],
+    sink: Union["JSONFileSink", "JSONLSink"],
+) -> None:
+    if writer is not None and writer.is_alive():
+        events_queue.put(None)
+        writer.join()
+    sink.close()
+
+
 class SaveEvents:
     """Utility wrapper for saving Sentry events (envelope payloads) to disk.
 
@@ -198,28 +1019,1179 @@ class SaveEvents:
             outputdir="/some/path"
         )
 
+    By default, each event is written to its own ``.json`` file in
+    ``outputdir``. To write events to rotating, compressed JSONL files instead,
+    pass a :py:class:`fillmore.test.JSONLSink` as ``sink``.
+
+    By default, events are written in the thread that calls ``before_send``. To
+    keep disk latency out of that thread, set ``background=True``. Events are
+    serialized in the calling thread and put on a bounded queue that a daemon
+    writer thread drains. Queued events are flushed and the sink is closed when
+    the process exits or, for SaveEvents that don't write in the background,
+    when the SaveEvents is garbage collected.
+
+    To save fewer events, set ``sample_rate`` to save a random fraction of
+    them or set ``distinct_shapes=True`` to only save events with a shape that
+    hasn't been seen before. An event's shape is the set of key paths in it
+    (see :py:func:`fillmore.corpus.event_key_paths`) ignoring values. Shapes
+    are kept in a set of at most ``max_shapes`` items; when it's full, the
+    oldest shapes are forgotten. ``.skipped`` counts events that weren't saved.
+
+    After ``.close()``, events are passed to the wrapped scrubber but aren't
+    saved; they're counted in ``.dropped``.
+
+    :param wrapped_scrubber: the Scrubber to pass events to after saving them
+    :param outputdir: the directory to save events in as ``.json`` files; it
+        must exist
+    :param sink: the sink to write events to; use this instead of outputdir
+    :param background: whether to write events in a background thread
+    :param queue_size: maximum number of events waiting to be written in
+        background mode
+    :param drop_policy: what to do with an event when the queue is full in
+        background mode; one of ``"drop_newest"`` (drop the new event),
+        ``"drop_oldest"`` (drop the oldest queued event), or ``"block"`` (wait
+        for room in the queue)
+    :param sample_rate: fraction of events to save from 0.0 to 1.0
+    :param distinct_shapes: whether to only save events with new shapes
+    :param max_shapes: maximum number of shapes to remember
+
+    :raises ConfigurationError: if the outputdir doesn't exist, neither or both
+        of outputdir and sink are specified, the drop_policy isn't valid,
+        the sample_rate isn't between 0.0 and 1.0, or max_shapes is less
+        than 1
+
     """
 
-    def __init__(self, wrapped_scrubber: Scrubber, outputdir: str):
+    def __init__(
+        self,
+        wrapped_scrubber: Scrubber,
+        outputdir: Optional[str] = None,
+        background: bool = False,
+        queue_size: int = 1000,
+        drop_policy: str = DROP_NEWEST,
+        sink: Optional[Union[JSONFileSink, JSONLSink]] = None,
+        sample_rate: float = 1.0,
+        distinct_shapes: bool = False,
+        max_shapes: int = 10_000,
+    ):
         self.wrapped_scrubber = wrapped_scrubber
-        self.outputdir = Path(outputdir)
-        if not self.outputdir.is_dir():
-            raise ConfigurationError(f"outputdir {outputdir} does not exist")
+        if (outputdir is None) == (sink is None):
+            raise ConfigurationError("specify one of outputdir or sink")
+        if sink is None:
+            assert outputdir is not None
+            sink = JSONFileSink(outputdir)
+        self.sink = sink
+        self.outputdir = sink.outputdir
+
+        if drop_policy not in (DROP_NEWEST, DROP_OLDEST, BLOCK):
+            raise ConfigurationError(f"drop_policy {drop_policy!r} is not valid")
+
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ConfigurationError(f"sample_rate {sample_rate!r} is not valid")
+
+        if max_shapes < 1:
+            raise ConfigurationError(f"max_shapes {max_shapes!r} must be at least 1")
+
+        self.background = background
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self._closed = False
+        self._warned_closed = False
+        # Guards dropped and skipped which are counted in the calling threads
+        # and the writer thread
+        self._counts_lock = threading.Lock()
+
+        self.sample_rate = sample_rate
+        self.distinct_shapes = distinct_shapes
+        self.max_shapes = max_shapes
+        self.skipped = 0
+        self._random = random.Random()
+        # Shape signature -> None; dicts keep insertion order so the oldest
+        # shapes are first
+        self._shapes: Dict[int, None] = {}
+        self._shapes_lock = threading.Lock()
+
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue(maxsize=queue_size)
+        self._writer: Optional[threading.Thread] = None
+        if background:
+            self._writer = threading.Thread(
+                target=self._write_queued, name="fillmore-save-events", daemon=True
+            )
+            self._writer.start()
+
+        # Make sure queued events are written and the sink's files are finished
+        # when the SaveEvents is garbage collected or at exit; this doesn't
+        # reference the SaveEvents so it doesn't keep it alive
+        self._finalizer = weakref.finalize(
+            self, _close_save_events, self._queue, self._writer, self.sink
+        )
 
     def __call__(self, event: dict, hint: Any) -> dict:
         try:
-            event_id = uuid.uuid4().hex
-            path = self.outputdir / f"{event_id}.json"
-            data = json.dumps(event)
-            path.write_text(data)
+            if self._closed:
+                self._drop_closed()
+            elif self._should_save(event):
+                # Serialize now because the scrubber changes the event
+                data = json.dumps(event)
+                if self.background:
+                    self._enqueue(data)
+                else:
+                    self._write(data)
+            else:
+                with self._counts_lock:
+                    self.skipped += 1
         except Exception as exc:
             LOGGER.exception(f"error in SaveEvents.__call__: {exc}")
 
         return self.wrapped_scrubber(event=event, hint=hint)
 
+    def _should_save(self, event: dict) -> bool:
+        if self.sample_rate < 1.0 and self._random.random() >= self.sample_rate:
+            return False
+
+        if not self.distinct_shapes:
+            return True
+
+        signature = hash(frozenset(event_key_paths(event)))
+        with self._shapes_lock:
+            if signature in self._shapes:
+                return False
+            if len(self._shapes) >= self.max_shapes:
+                del self._shapes[next(iter(self._shapes))]
+            self._shapes[signature] = None
+        return True
+
+    def _drop(self) -> None:
+        with self._counts_lock:
+            self.dropped += 1
+
+    def _drop_closed(self) -> None:
+        with self._counts_lock:
+            self.dropped += 1
+            warn = not self._warned_closed
+            self._warned_closed = True
+        if warn:
+            LOGGER.warning("SaveEvents is closed; events are no longer saved")
+
+    def _write(self, data: str) -> None:
+        self.sink.write(data)
+
+    def _enqueue(self, data: str) -> None:
+        if self.drop_policy == BLOCK:
+            # Wait in intervals so an event that races with close() is dropped
+            # rather than waiting forever on a queue nothing reads
+            while True:
+                try:
+                    self._queue.put(data, timeout=0.1)
+                    return
+                except queue.Full:
+                    if self._closed:
+                        self._drop_closed()
+                        return
+
+        while True:
+            try:
+                self._queue.put_nowait(data)
+                return
+            except queue.Full:
+                if self.drop_policy == DROP_NEWEST:
+                    self._drop()
+                    return
+
+            # Drop the oldest event to make room
+            try:
+                oldest = self._queue.get_nowait()
+                self._queue.task_done()
+            except queue.Empty:
+                continue
+            if oldest is None:
+                # close() is stopping the writer; put the stop back and drop
+                # this event instead
+                self._queue.put(None)
+                self._drop_closed()
+                return
+            self._drop()
+
+    def _write_queued(self) -> None:
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    return
+                self._write(data)
+            except Exception as exc:
+                LOGGER.exception(f"error in SaveEvents writer: {exc}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self) -> None:
+        """Waits until all queued events are written"""
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        """Writes all queued events, stops the writer thread, and closes the sink
+
+        Events passed to the SaveEvents after this aren't saved.
+
+        """
+        self._closed = True
+        self._finalizer()
+
+
+#: Path to a value in an event as a tuple of dict keys and list indexes
+EventPath = Tuple[Union[str, int], ...]
+
+
+@attrs.frozen
+class GeneratedEvent:
+    """An event made by :py:class:`fillmore.test.EventGenerator`
+
+    :param event: the Sentry event
+    :param secrets: list of ``(path, secret)`` tuples for the secrets planted
+        in the event; the secret is either the value at the path or part of it
+        (for example, a cookie in a cookie string)
+
+    """
+
+    event: Dict[str, Any]
+    secrets: List[Tuple[EventPath, str]]
+
+    def leaks(self, event: Optional[Dict[str, Any]] = None) -> List[EventPath]:
+        """Returns the paths of planted secrets that are still in the event
+
+        :arg event: the scrubbed event; defaults to ``.event`` which is what
+            you want if the scrubber scrubbed it in place
+
+        """
+        if event is None:
+            event = self.event
+
+        leaked = []
+        for path, secret in self.secrets:
+            value: Any = event
+            try:
+                for part in path:
+                    value = value[part]
+            except (KeyError, IndexError, TypeError):
+                continue
+            if secret in str(value):
+                leaked.append(path)
+        return leaked
+
+
+@attrs.define
+class EventGenerator:
+    """Generates Sentry events with a given shape and planted secrets
+
+    Events are shaped like error events from sentry-sdk for a web request with
+    breadcrumbs and a stacktrace with frame-local vars. Event contents are
+    random, but deterministic: the same seed and index always produce the same
+    event.
+
+    Secrets look like ``secret-<hex>`` and are planted in:
+
+    * ``request.headers`` in ``Auth-Token`` and ``Authorization``
+    * ``request.cookies`` in the ``sessionid`` and ``csrftoken`` cookies
+    * ``request.query_string`` in the ``code`` and ``state`` params
+    * ``request.data`` in ``password``
+    * frame-local vars in ``password`` and ``token`` in some frames
+
+    Usage::
+
+        generator = EventGenerator(seed=42, frames=50, vars_per_frame=20)
+
+        # Lazily generate events
+        for generated in generator.iter_events(count=1000):
+            scrubber(generated.event, {})
+            assert generated.leaks() == []
+
+        # Generate a list of events
+        events = generator.generate_events(count=100)
+
+    :param seed: the seed for the random number generator
+    :param frames: number of stacktrace frames
+    :param vars_per_frame: number of frame-local vars in each frame
+    :param headers: number of request headers
+    :param cookies: number of request cookies
+    :param query_params: number of query string params
+    :param breadcrumbs: number of breadcrumbs
+    :param value_size: length of generated string values
+    :param secret_frame_rate: chance a frame gets secret frame-local vars
+
+    """
+
+    seed: int = 0
+    frames: int = 10
+    vars_per_frame: int = 10
+    headers: int = 10
+    cookies: int = 5
+    query_params: int = 5
+    breadcrumbs: int = 10
+    value_size: int = 20
+    secret_frame_rate: float = 0.2
+
+    def generate(self, index: int) -> GeneratedEvent:
+        """Generates event number index"""
+        rng = random.Random(f"{self.seed}-{index}")
+        secrets: List[Tuple[EventPath, str]] = []
+
+        def text(size: int = self.value_size) -> str:
+            return "".join(rng.choices(string.ascii_lowercase, k=size))
+
+        def secret(path: EventPath) -> str:
+            value = f"secret-{rng.getrandbits(64):016x}"
+            secrets.append((path, value))
+            return value
+
+        timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=index)
+
+        headers = {f"X-Header-{i}": text() for i in range(self.headers)}
+        headers["Auth-Token"] = secret(("request", "headers", "Auth-Token"))
+        headers["Authorization"] = "Bearer " + secret(
+            ("request", "headers", "Authorization")
+        )
+
+        cookies = [(f"cookie{i}", text()) for i in range(self.cookies)]
+        cookies.append(("sessionid", secret(("request", "cookies"))))
+        cookies.append(("csrftoken", secret(("request", "cookies"))))
+
+        query_params = [(f"param{i}", text()) for i in range(self.query_params)]
+        query_params.append(("code", secret(("request", "query_string"))))
+        query_params.append(("state", secret(("request", "query_string"))))
+        query_string = urlencode(query_params)
+
+        frames = []
+        for i in range(self.frames):
+            frame_vars = {f"var{j}": repr(text()) for j in range(self.vars_per_frame)}
+            if rng.random() < self.secret_frame_rate:
+                vars_path = (
+                    "exception",
+                    "values",
+                    0,
+                    "stacktrace",
+                    "frames",
+                    i,
+                    "vars",
+                )
+                frame_vars["password"] = repr(secret(vars_path + ("password",)))
+                frame_vars["token"] = repr(secret(vars_path + ("token",)))
+            module = f"app.{text(8)}"
+            frames.append(
+                {
+                    "filename": module.replace(".", "/") + ".py",
+                    "abs_path": "/app/" + module.replace(".", "/") + ".py",
+                    "function": text(10),
+                    "module": module,
+                    "lineno": rng.randint(1, 1000),
+                    "pre_context": [text() for _ in range(5)],
+                    "context_line": text(),
+                    "post_context": [text() for _ in range(5)],
+                    "vars": frame_vars,
+                    "in_app": True,
+                }
+            )
+
+        breadcrumbs = [
+            {
+                "type": "default",
+                "category": "httplib",
+                "message": text(),
+                "level": "info",
+                "data": {"url": f"http://example.com/{text(10)}", "method": "GET"},
+                "timestamp": (timestamp - timedelta(milliseconds=i)).isoformat(),
+            }
+            for i in range(self.breadcrumbs)
+        ]
+
+        event = {
+            "level": "error",
+            "exception": {
+                "values": [
+                    {
+                        "mechanism": {"type": "generic", "handled": True},
+                        "module": None,
+                        "type": "Exception",
+                        "value": text(),
+                        "stacktrace": {"frames": frames},
+                    }
+                ]
+            },
+            "event_id": f"{rng.getrandbits(128):032x}",
+            "timestamp": timestamp.isoformat(),
+            "contexts": {
+                "trace": {
+                    "trace_id": f"{rng.getrandbits(128):032x}",
+                    "span_id": f"{rng.getrandbits(64):016x}",
+                    "parent_span_id": None,
+                },
+                "runtime": {"name": "CPython", "version": "3.12.0"},
+            },
+            "transaction_info": {},
+            "breadcrumbs": {"values": breadcrumbs},
+            "extra": {"sys.argv": ["app.py"]},
+            "request": {
+                "url": "http://example.com/" + text(10),
+                "query_string": query_string,
+                "method": "POST",
+                "env": {"SERVER_NAME": "example.com", "SERVER_PORT": "80"},
+                "headers": headers,
+                "cookies": "; ".join(f"{name}={value}" for name, value in cookies),
+                "data": {
+                    "username": text(),
+                    "password": secret(("request", "data", "password")),
+                },
+            },
+            "release": "1.0.0",
+            "environment": "production",
+            "server_name": "app-host",
+            "sdk": {
+                "name": "sentry.python",
+                "version": sentry_sdk.VERSION,
+                "packages": [
+                    {"name": "pypi:sentry-sdk", "version": sentry_sdk.VERSION}
+                ],
+                "integrations": ["argv", "atexit", "dedupe", "excepthook"],
+            },
+            "platform": "python",
+        }
+
+        return GeneratedEvent(event=event, secrets=secrets)
+
+    def iter_events(self, count: Optional[int] = None) -> Iterator[GeneratedEvent]:
+        """Lazily generates count events or forever if count is None"""
+        index = 0
+        while count is None or index < count:
+            yield self.generate(index)
+            index += 1
+
+    def generate_events(self, count: int) -> List[GeneratedEvent]:
+        """Generates a list of count events"""
+        return list(self.iter_events(count=count))
+
+
+@attrs.frozen
+class ScrubMeasurement:
+    """Memory used by part of a scrub pass averaged per event
+
+    Python doesn't count allocations that are freed again, so ``peak_bytes``
+    is the allocation figure: it includes temporary copies. ``retained_blocks``
+    and ``retained_bytes`` are usually about 0 for rules that free what they
+    allocate.
+
+    :param name: what was measured
+    :param peak_bytes: most memory allocated at one time while scrubbing,
+        including memory that was freed afterwards
+    :param retained_blocks: net change in the number of memory blocks; this is
+        negative if scrubbing freed more than it allocated
+    :param retained_bytes: net change in the number of bytes allocated; this
+        is negative if scrubbing freed more than it allocated
+
+    """
+
+    name: str
+    peak_bytes: float
+    retained_blocks: float
+    retained_bytes: float
+
+
+@attrs.frozen
+class ScrubMeasurements:
+    """Results of :py:func:`fillmore.test.measure_scrub`
+
+    :param events: number of events scrubbed
+    :param total: measurement of the whole scrub pass
+    :param rules: measurement for each rule in the order of the Scrubber rules
+    :param scrub_functions: measurement for each scrub function summed over
+        the rules that use it
+
+    """
+
+    events: int
+    total: ScrubMeasurement
+    rules: List[ScrubMeasurement]
+    scrub_functions: List[ScrubMeasurement]
+
+    def summary(self) -> str:
+        """Returns the measurements as a text table"""
+        lines = [
+            f"{self.events} events",
+            f"{'name':<60} {'peak bytes':>12} {'retained blocks':>16} "
+            + f"{'retained bytes':>15}",
+        ]
+        for measurement in [self.total] + self.rules + self.scrub_functions:
+            lines.append(
+                f"{measurement.name:<60} {measurement.peak_bytes:>12.0f} "
+                + f"{measurement.retained_blocks:>16.1f} "
+                + f"{measurement.retained_bytes:>15.0f}"
+            )
+        return "\n".join(lines)
+
+
+def measure_scrub(scrubber: Scrubber, events: Iterable[dict]) -> ScrubMeasurements:
+    """Measures memory used by scrubbing events
+
+    This scrubs a copy of each event with ``tracemalloc`` tracing and measures
+    memory used by each rule. Use it to compare rule configurations and find
+    scrub functions that copy large values. Compare ``peak_bytes``: it's the
+    memory a rule allocated including temporary copies. ``tracemalloc`` can't
+    count allocations that were freed, so the retained figures only show
+    memory a rule keeps.
+
+    Usage::
+
+        events = [generated.event for generated in EventGenerator().iter_events(100)]
+        measurements = measure_scrub(scrubber, events)
+        print(measurements.summary())
+
+    .. Note::
+
+       Tracing memory allocations is slow. Don't use this for timing.
+
+    :arg scrubber: the Scrubber to measure
+    :arg events: iterable of events; the events are not changed
+
+    :returns: a :py:class:`fillmore.test.ScrubMeasurements`
+
+    """
+    rules = scrubber._compiled_rules
+    peaks = [0] * len(rules)
+    blocks = [0] * len(rules)
+    sizes = [0] * len(rules)
+    total_peak = 0
+    event_count = 0
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    try:
+        for event in events:
+            event = copy.deepcopy(event)
+            event_count += 1
+            event_peak = 0
+            for rule in rules:
+                tracemalloc.reset_peak()
+                size_before, _ = tracemalloc.get_traced_memory()
+                blocks_before = sys.getallocatedblocks()
+
+                scrubber._apply_rule(rule, event)
+
+                blocks_after = sys.getallocatedblocks()
+                size_after, peak = tracemalloc.get_traced_memory()
+
+                peaks[rule.index] += peak - size_before
+                blocks[rule.index] += blocks_after - blocks_before
+                sizes[rule.index] += size_after - size_before
+                event_peak = max(event_peak, peak - size_before)
+            total_peak += event_peak
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    count = event_count or 1
+
+    rule_measurements = [
+        ScrubMeasurement(
+            name=f"rule {rule.index}: {'.'.join(rule.path)} {list(rule.keys)}",
+            peak_bytes=peaks[rule.index] / count,
+            retained_blocks=blocks[rule.index] / count,
+            retained_bytes=sizes[rule.index] / count,
+        )
+        for rule in rules
+    ]
+
+    function_names: Dict[str, List[int]] = {}
+    for rule in rules:
+        name = f"{rule.scrub.__module__}.{rule.scrub.__qualname__}"
+        function_names.setdefault(name, []).append(rule.index)
+
+    function_measurements = [
+        ScrubMeasurement(
+            name=name,
+            peak_bytes=max(peaks[i] for i in indexes) / count,
+            retained_blocks=sum(blocks[i] for i in indexes) / count,
+            retained_bytes=sum(sizes[i] for i in indexes) / count,
+        )
+        for name, indexes in function_names.items()
+    ]
+
+    return ScrubMeasurements(
+        events=event_count,
+        total=ScrubMeasurement(
+            name="total",
+            peak_bytes=total_peak / count,
+            retained_blocks=sum(blocks) / count,
+            retained_bytes=sum(sizes) / count,
+        ),
+        rules=rule_measurements,
+        scrub_functions=function_measurements,
+    )
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    """Returns the nearest-rank percentile of sorted values or 0 if empty"""
+    if not sorted_values:
+        return 0.0
+    rank = max(
+        0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1)
+    )
+    return sorted_values[rank]
+
+
+@attrs.frozen
+class LoadTestResult:
+    """Results of :py:func:`fillmore.test.loadtest`
+
+    Latencies are in milliseconds.
+
+    :param threads: number of threads capturing events
+    :param events: number of events captured
+    :param seconds: wall-clock seconds the load test ran
+    :param sent: number of envelopes that reached the transport or server
+    :param latency_p50: median before_send latency
+    :param latency_p99: 99th percentile before_send latency
+    :param latency_p999: 99.9th percentile before_send latency
+    :param latency_max: maximum before_send latency
+
+    """
+
+    threads: int
+    events: int
+    seconds: float
+    sent: int
+    latency_p50: float
+    latency_p99: float
+    latency_p999: float
+    latency_max: float
+
+    @property
+    def events_per_second(self) -> float:
+        """Events captured per wall-clock second across all threads"""
+        return self.events / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        """Returns the results as text"""
+        return "\n".join(
+            [
+                f"{self.events} events in {self.seconds:.2f}s with {self.threads} "
+                + f"threads: {self.events_per_second:.1f} events/s, {self.sent} sent",
+                f"before_send latency ms: p50 {self.latency_p50:.3f} "
+                + f"p99 {self.latency_p99:.3f} p999 {self.latency_p999:.3f} "
+                + f"max {self.latency_max:.3f}",
+            ]
+        )
+
+
+def loadtest(
+    scrubber: Scrubber,
+    events: Union[Iterable[dict], EventGenerator],
+    threads: int = 4,
+    duration: float = 10.0,
+    max_events: Optional[int] = None,
+    server: bool = False,
+    pool_size: int = 100,
+    **sentry_options: Any,
+) -> LoadTestResult:
+    """Measures scrubbing throughput through the sentry_sdk pipeline
+
+    This sets up a sentry_sdk client with
+    :py:func:`fillmore.libsentry.set_up_sentry` with the scrubber as the
+    ``before_send`` and captures events with ``sentry_sdk.capture_event`` from
+    multiple threads until the duration is up. That measures what the sentry_sdk
+    event pipeline plus the scrubber cost under concurrency rather than the
+    scrubber on its own.
+
+    By default, envelopes go to a capture transport that keeps only the most
+    recent one. With ``server=True``, they're sent over HTTP with the sentry_sdk
+    transport to a :py:class:`fillmore.test.FakeSentryServer`. The sentry_sdk
+    transport drops envelopes when its queue is full, so ``sent`` can be less
+    than ``events``.
+
+    The client replaces the global client for the duration of the load test.
+
+    Usage::
+
+        result = loadtest(scrubber, EventGenerator(frames=50), threads=8, duration=5)
+        print(result.summary())
+
+    .. Note::
+
+       Each capture scrubs a deep copy of an event. Copying is included in
+       events per second, but not in before_send latency.
+
+    :arg scrubber: the Scrubber to use as the ``before_send``
+    :arg events: events to capture or an :py:class:`fillmore.test.EventGenerator`;
+        events are reused round-robin and not changed
+    :arg threads: number of threads capturing events
+    :arg duration: number of seconds to run for
+    :arg max_events: stop after capturing this many events
+    :arg server: whether to send envelopes to a
+        :py:class:`fillmore.test.FakeSentryServer` over HTTP
+    :arg pool_size: number of events to generate when events is an
+        EventGenerator
+    :arg sentry_options: additional arguments to pass to ``set_up_sentry``
+
+    :returns: a :py:class:`fillmore.test.LoadTestResult`
+
+    """
+    if isinstance(events, EventGenerator):
+        pool = [generated.event for generated in events.iter_events(count=pool_size)]
+    else:
+        pool = list(events)
+    if not pool:
+        raise ValueError("events is empty")
+
+    latencies: List[float] = []
+
+    def before_send(event: Dict[str, Any], hint: Dict[str, Any]) -> Any:
+        start = time.perf_counter()
+        try:
+            return scrubber(event, hint)
+        finally:
+            # list.append is atomic, so threads can share the list
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    lock = threading.Lock()
+    captured = 0
+
+    def run(deadline: float) -> None:
+        nonlocal captured
+        while time.perf_counter() < deadline:
+            with lock:
+                if max_events is not None and captured >= max_events:
+                    return
+                index = captured
+                captured += 1
+            event = copy.deepcopy(pool[index % len(pool)])
+            sentry_sdk.capture_event(event)  # type: ignore[arg-type]
+
+    fake_server = FakeSentryServer() if server else None
+    transport = _CaptureTransport(max_envelopes=1)
+    if fake_server is not None:
+        fake_server.start()
+        dsn = fake_server.dsn
+    else:
+        dsn = "http://public@localhost/1"
+        sentry_options["transport"] = transport
+
+    global_scope = sentry_sdk.Scope.get_global_scope()
+    previous_client = global_scope.client
+    try:
+        set_up_sentry(
+            sentry_dsn=dsn,
+            release="fillmore-loadtest",
+            host_id="fillmore-loadtest",
+            before_send=before_send,
+            **sentry_options,
+        )
+        client = sentry_sdk.get_client()
+
+        start = time.perf_counter()
+        workers = [
+            threading.Thread(target=run, args=(start + duration,), daemon=True)
+            for _ in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+
+        # Wait for the transport to send what's queued
+        client.close(timeout=max(duration, 5.0))
+        if fake_server is not None:
+            sent = fake_server.request_count
+        else:
+            sent = transport.stats().envelopes
+    finally:
+        global_scope.set_client(previous_client)
+        if fake_server is not None:
+            fake_server.stop()
+
+    latencies.sort()
+    return LoadTestResult(
+        threads=threads,
+        events=captured,
+        seconds=seconds,
+        sent=sent,
+        latency_p50=_percentile(latencies, 50),
+        latency_p99=_percentile(latencies, 99),
+        latency_p999=_percentile(latencies, 99.9),
+        latency_max=latencies[-1] if latencies else 0.0,
+    )
+
+
+# Stands in for values a scrubber removed
+_REMOVED = object()
+
+# Words and numbers in a value for finding content that a scrubber kept
+_CONTENT_TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+def _changed_values(original: Any, scrubbed: Any) -> Dict[str, Tuple[Any, Any]]:
+    """Returns path -> (original value, scrubbed value) for changed values"""
+    changed: Dict[str, Tuple[Any, Any]] = {}
+    stack: List[Tuple[Any, Any, str]] = [(original, scrubbed, "")]
+    while stack:
+        a, b, path = stack.pop()
+        prefix = f"{path}." if path else ""
+        if isinstance(a, dict) and isinstance(b, dict):
+            for key, value in a.items():
+                if key in b:
+                    stack.append((value, b[key], f"{prefix}{key}"))
+                else:
+                    changed[f"{prefix}{key}"] = (value, _REMOVED)
+        elif isinstance(a, list) and isinstance(b, list):
+            for i, value in enumerate(a):
+                if i < len(b):
+                    stack.append((value, b[i], f"{prefix}[{i}]"))
+                else:
+                    changed[f"{prefix}[{i}]"] = (value, _REMOVED)
+        elif type(a) is not type(b) or a != b:
+            changed[path] = (a, b)
+    return changed
+
+
+def scrubbed_paths(original: Any, scrubbed: Any) -> Set[str]:
+    """Returns the paths of values a scrubber changed or removed
+
+    Paths are dotted keys with list indexes in brackets like
+    ``exception.values.[0].stacktrace.frames.[2].vars.password``. If a scrubber
+    replaces a dict or list with a single value, the path of the dict or list
+    is returned rather than the paths of everything in it.
+
+    :arg original: the event before scrubbing
+    :arg scrubbed: the event after scrubbing
+
+    :returns: set of paths
+
+    """
+    return set(_changed_values(original, scrubbed))
+
+
+def _content_tokens(value: Any) -> Set[str]:
+    if value is _REMOVED:
+        return set()
+    text = value if isinstance(value, str) else repr(value)
+    return set(_CONTENT_TOKEN_RE.findall(text))
+
+
+def _keeps_removed_content(original: Any, scrubbed: Any, other: Any) -> bool:
+    """Returns whether other has content from original that scrubbed removed
+
+    This catches scrubbers that change the same value differently like one
+    that scrubs the ``code`` cookie and one that scrubs the ``state`` cookie.
+
+    """
+    removed = _content_tokens(original) - _content_tokens(scrubbed)
+    return not removed.isdisjoint(_content_tokens(other))
+
+
+@attrs.frozen
+class ScrubberDifference:
+    """An event two Scrubbers scrub differently
+
+    :param path: the event file
+    :param position: position of the event in the file starting at 0
+    :param unmasked: sorted paths the old Scrubber scrubbed and the new one
+        doesn't or where the new Scrubber's value still has content the old
+        Scrubber removed; these are potential leaks
+    :param newly_masked: sorted paths the new Scrubber scrubs and the old one
+        didn't or where the new Scrubber removed content the old Scrubber kept
+
+    """
+
+    path: Path
+    position: int
+    unmasked: List[str]
+    newly_masked: List[str]
+
+
+#: Number of events sent to a worker process at a time by
+#: :py:func:`fillmore.test.compare_scrubbers`
+COMPARE_BATCH_SIZE = 100
+
+# Worker processes load the scrubbers once and keep them here
+_COMPARE_WORKER: Dict[str, Scrubber] = {}
+
+
+def _get_scrubber(scrubber: Union[Scrubber, str]) -> Scrubber:
+    if isinstance(scrubber, Scrubber):
+        return scrubber
+    return load_scrubber(scrubber)
+
+
+def _iter_differences(
+    old: Scrubber, new: Scrubber, events: Iterable[Tuple[Path, int, Any]]
+) -> Iterator[ScrubberDifference]:
+    for path, position, event in events:
+        # Each Scrubber scrubs its own copy so neither sees the other's changes
+        old_changes = _changed_values(event, old(copy.deepcopy(event), None))
+        new_changes = _changed_values(event, new(copy.deepcopy(event), None))
+        unmasked = old_changes.keys() - new_changes.keys()
+        newly_masked = new_changes.keys() - old_changes.keys()
+
+        # Both Scrubbers changed these values, but maybe not the same way
+        for key_path in old_changes.keys() & new_changes.keys():
+            original, old_value = old_changes[key_path]
+            new_value = new_changes[key_path][1]
+            if _keeps_removed_content(original, old_value, new_value):
+                unmasked.add(key_path)
+            if _keeps_removed_content(original, new_value, old_value):
+                newly_masked.add(key_path)
+
+        if unmasked or newly_masked:
+            yield ScrubberDifference(
+                path=path,
+                position=position,
+                unmasked=sorted(unmasked),
+                newly_masked=sorted(newly_masked),
+            )
+
+
+def _init_compare_worker(old: str, new: str) -> None:
+    _COMPARE_WORKER["old"] = load_scrubber(old)
+    _COMPARE_WORKER["new"] = load_scrubber(new)
+
+
+def _compare_batch(batch: List[Tuple[Path, int, Any]]) -> List[ScrubberDifference]:
+    return list(
+        _iter_differences(_COMPARE_WORKER["old"], _COMPARE_WORKER["new"], batch)
+    )
+
+
+def compare_scrubbers(
+    old: Union[Scrubber, str],
+    new: Union[Scrubber, str],
+    corpus: Union[str, Path],
+    workers: int = 1,
+) -> Iterator[ScrubberDifference]:
+    """Compares how two Scrubbers scrub the events in a corpus
+
+    Use this when changing rules to check that nothing the old rules scrubbed
+    is left unscrubbed by the new rules. Each event is scrubbed by both
+    Scrubbers, each working on its own copy, and compared with
+    :py:func:`fillmore.test.scrubbed_paths`. Where both Scrubbers changed a
+    value, the words and numbers in the values are compared too, so a new
+    Scrubber that keeps a cookie the old one scrubbed is caught even if it
+    scrubs a different cookie in the same value.
+
+    Differences are generated as events are compared, so this works with
+    corpora that don't fit in memory. With more than one worker, events are
+    sent to the workers in batches of
+    :py:data:`fillmore.test.COMPARE_BATCH_SIZE` and at most two batches per
+    worker are in flight at a time.
+
+    Usage::
+
+        for difference in compare_scrubbers(
+            "myapp.sentry:old_scrubber", "myapp.sentry:scrubber", "events/", workers=4
+        ):
+            assert difference.unmasked == [], difference
+
+    :arg old: the Scrubber to compare against or a ``module:name`` spec
+    :arg new: the changed Scrubber or a ``module:name`` spec
+    :arg corpus: event file or corpus directory
+    :arg workers: number of worker processes to compare events with; Scrubbers
+        can't be pickled, so with more than one worker, old and new must be
+        specs
+
+    :returns: generator of :py:class:`fillmore.test.ScrubberDifference` for
+        events the Scrubbers scrub differently in corpus order
+
+    :raises ValueError: if there's more than one worker and old or new isn't a
+        spec or if a spec doesn't point to a Scrubber
+
+    """
+    events = (
+        (path, position, event)
+        for path in iter_event_files(corpus)
+        for position, event in enumerate(iter_file_events(path))
+    )
+    if workers == 1:
+        yield from _iter_differences(_get_scrubber(old), _get_scrubber(new), events)
+        return
+
+    if not (isinstance(old, str) and isinstance(new, str)):
+        raise ValueError("old and new must be module:name specs with workers > 1")
+
+    with multiprocessing.Pool(
+        processes=workers, initializer=_init_compare_worker, initargs=(old, new)
+    ) as pool:
+        pending: Deque[AsyncResult] = deque()
+        while True:
+            batch = list(islice(events, COMPARE_BATCH_SIZE))
+            if not batch:
+                break
+            pending.append(pool.apply_async(_compare_batch, (batch,)))
+            # Don't read ahead of the consumer by more than a couple of
+            # batches per worker
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+#: Keys with values that are different every time an event is made
+VOLATILE_KEYS = frozenset(
+    [
+        "event_id",
+        "timestamp",
+        "start_timestamp",
+        "received",
+        "trace_id",
+        "span_id",
+        "parent_span_id",
+    ]
+)
+
+#: Keys with values normalized by ``normalize_event`` in the ``sdk`` and
+#: ``runtime`` parts of events which change with sentry_sdk and Python versions
+VERSION_KEYS = frozenset(["version", "build"])
+
+_MEMORY_ADDRESS_RE = re.compile(r"\b0x[0-9a-fA-F]{6,16}\b")
+
+
+def normalize_event(event: Any) -> Any:
+    """Returns a copy of an event with volatile values replaced
+
+    This makes events comparable between test runs. It replaces:
+
+    * values of :py:data:`fillmore.test.VOLATILE_KEYS` like ``event_id`` and
+      ``timestamp`` with ``"<key>"``
+    * values of :py:data:`fillmore.test.VERSION_KEYS` in ``sdk`` and
+      ``runtime`` with ``"<key>"``
+    * memory addresses in strings like reprs of objects with ``0x<address>``
+
+    :arg event: the event to normalize; it's not changed
+
+    :returns: the normalized copy
+
+    """
+
+    def _normalize(value: Any, in_versioned: bool) -> Any:
+        if isinstance(value, dict):
+            normalized = {}
+            for key, item in value.items():
+                if item is not None and (
+                    key in VOLATILE_KEYS or (in_versioned and key in VERSION_KEYS)
+                ):
+                    normalized[key] = f"<{key}>"
+                else:
+                    normalized[key] = _normalize(
+                        item, in_versioned or key in ("sdk", "runtime")
+                    )
+            return normalized
+        if isinstance(value, (list, tuple)):
+            return [_normalize(item, in_versioned) for item in value]
+        if isinstance(value, str):
+            return _MEMORY_ADDRESS_RE.sub("0x<address>", value)
+        return value
+
+    return _normalize(event, False)
+
+
+class SnapshotFile:
+    """Snapshots stored in a JSONL file
+
+    Each line is a compact JSON object with the ``name`` and the ``snapshot``
+    and lines are sorted by name, so changes to snapshots make small diffs.
+
+    The file isn't read until a snapshot is needed and is only written by
+    :py:meth:`save` if a snapshot changed.
+
+    :param path: path of the file; it doesn't have to exist
+
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self._snapshots: Optional[Dict[str, Any]] = None
+        self.changed = False
+
+    def _load(self) -> Dict[str, Any]:
+        if self._snapshots is None:
+            snapshots = {}
+            if self.path.exists():
+                with self.path.open("r", encoding="utf-8") as fp:
+                    for line in fp:
+                        if line.strip():
+                            item = json.loads(line)
+                            snapshots[item["name"]] = item["snapshot"]
+            self._snapshots = snapshots
+        return self._snapshots
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._load()
+
+    def get(self, name: str) -> Any:
+        """Returns the named snapshot
+
+        :raises KeyError: if there's no snapshot with that name
+
+        """
+        return self._load()[name]
+
+    def set(self, name: str, snapshot: Any) -> None:
+        """Sets the named snapshot if it's different"""
+        snapshots = self._load()
+        if name not in snapshots or snapshots[name] != snapshot:
+            snapshots[name] = snapshot
+            self.changed = True
+
+    def save(self) -> None:
+        """Writes the snapshots if any changed"""
+        if not self.changed:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".tmp-{self.path.name}")
+        with tmp_path.open("w", encoding="utf-8") as fp:
+            for name, snapshot in sorted(self._load().items()):
+                fp.write(
+                    json.dumps(
+                        {"name": name, "snapshot": snapshot},
+                        sort_keys=True,
+                        separators=(",", ":"),
+                    )
+                    + "\n"
+                )
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+#: reprlib.Repr used for compact diff_structure differences
+_COMPACT_REPR = reprlib.Repr()
+_COMPACT_REPR.maxlevel = 2
+_COMPACT_REPR.maxdict = 4
+_COMPACT_REPR.maxlist = 4
+_COMPACT_REPR.maxtuple = 4
+_COMPACT_REPR.maxstring = 60
+_COMPACT_REPR.maxother = 60
+
+
+def _compact(value: Any) -> str:
+    return f"{type(value).__name__}: {_COMPACT_REPR.repr(value)}"
+
+
+# Paths are built lazily as (parent, key or index, is index) linked lists and
+# only turned into strings for differences
+_DiffPath = Optional[Tuple[Any, Any, bool]]
+
+
+def _path_to_str(prefix: str, path: _DiffPath) -> str:
+    parts: List[str] = []
+    while path is not None:
+        path, part, is_index = path
+        parts.append(f"[{part}]" if is_index else str(part))
+    return prefix + "".join(f".{part}" for part in reversed(parts))
+
 
 def diff_structure(
-    a: Dict[str, Any], b: Dict[str, Any], path: str = ""
+    a: Dict[str, Any],
+    b: Dict[str, Any],
+    path: str = "",
+    max_differences: Optional[int] = None,
+    compact: bool = False,
 ) -> List[Dict[str, Any]]:
     """Compares two Sentry envelope payload json structures.
 
@@ -242,9 +2214,17 @@ def diff_structure(
         differences = diff_structure(payload, expected)
         assert differences == []
 
+    For large structures, ``max_differences`` stops comparing after that many
+    differences and ``compact=True`` keeps differences small by recording the
+    type name and a truncated repr of values instead of the values themselves.
 
     :arg a: first structure
     :arg b: second structure
+    :arg path: prefix for the paths in differences
+    :arg max_differences: stop after finding this many differences; None to
+        find all differences
+    :arg compact: whether to record ``"a"`` and ``"b"`` as strings with the
+        type name and a truncated repr and truncate values in ``"msg"``
 
     :returns: list of differences each as a dict with "msg", "a", "b", "path"
         keys
@@ -258,72 +2238,467 @@ def diff_structure(
                 "b": "five",
             }
 
+        With ``compact=True``::
+
+            {
+                "msg": "different types: a:<class 'int'> b:<class 'str'>",
+                "path": "some.path",
+                "a": "int: 5",
+                "b": "str: 'five'",
+            }
+
     """
-    if a is ANY or b is ANY:
-        return []
+    value_repr = _COMPACT_REPR.repr if compact else repr
+    differences: List[Dict[str, Any]] = []
 
-    if type(a) is not type(b):
-        return [
+    def add_difference(msg: str, diff_path: _DiffPath, a: Any, b: Any) -> None:
+        differences.append(
             {
-                "msg": f"different types a:{type(a)} b:{type(b)}",
-                "path": path,
-                "a": a,
-                "b": b,
+                "msg": msg,
+                "path": _path_to_str(path, diff_path),
+                "a": _compact(a) if compact else a,
+                "b": _compact(b) if compact else b,
             }
-        ]
+        )
 
-    if isinstance(a, (list, tuple)):
-        i = 0
-        differences = []
-        for item_a, item_b in zip_longest(a, b, fillvalue=None):
-            differences.extend(diff_structure(item_a, item_b, f"{path}.[{i}]"))
-            i += 1
-        return differences
+    # Stack of (a, b, path) to compare and (msg, a, b, path) differences to add
+    # in the order they come off the stack; this keeps differences in
+    # depth-first order without recursing
+    stack: List[Tuple[Any, ...]] = [(a, b, None)]
+    while stack:
+        if max_differences is not None and len(differences) >= max_differences:
+            break
+
+        item = stack.pop()
+        if len(item) == 4:
+            add_difference(*item)
+            continue
+
+        item_a, item_b, item_path = item
+        if item_a is ANY or item_b is ANY:
+            continue
+
+        if type(item_a) is not type(item_b):
+            add_difference(
+                f"different types a:{type(item_a)} b:{type(item_b)}",
+                item_path,
+                item_a,
+                item_b,
+            )
+            continue
+
+        if isinstance(item_a, (list, tuple)):
+            children = list(zip_longest(item_a, item_b, fillvalue=None))
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((children[i][0], children[i][1], (item_path, i, True)))
+            continue
+
+        if isinstance(item_a, dict):
+            keyset_a = set(item_a.keys())
+            keyset_b = set(item_b.keys())
+
+            # Push in reverse so common keys come off first, then keys missing
+            # from b, then keys missing from a
+            for key in sorted(keyset_b - keyset_a, reverse=True):
+                stack.append((f"{key} in b, not in a", item_path, item_a, item_b))
+            for key in sorted(keyset_a - keyset_b, reverse=True):
+                stack.append((f"{key} in a, not in b", item_path, item_a, item_b))
+            for key in sorted(keyset_a & keyset_b, reverse=True):
+                stack.append((item_a[key], item_b[key], (item_path, key, False)))
+            continue
+
+        if isinstance(item_a, (int, float, str)):
+            if item_a != item_b:
+                add_difference(
+                    f"{value_repr(item_a)} != {value_repr(item_b)}",
+                    item_path,
+                    item_a,
+                    item_b,
+                )
 
-    if isinstance(a, dict):
-        keyset_a = set(a.keys())
-        keyset_b = set(b.keys())
-        differences = []
+    return differences
 
-        # Iterate over common keys of both sets
-        for key in sorted(keyset_a & keyset_b):
-            differences.extend(diff_structure(a[key], b[key], f"{path}.{key}"))
 
-        # Print out missing keys
-        delta_keys = keyset_a - keyset_b
-        if delta_keys:
-            for key in sorted(delta_keys):
-                differences.append(
-                    {
-                        "msg": f"{key} in a, not in b",
-                        "path": path,
-                        "a": a,
-                        "b": b,
-                    }
-                )
+class Matcher(abc.ABC):
+    """Base class for matchers in :py:func:`fillmore.test.compile_expected`
+    templates
 
-        delta_keys = keyset_b - keyset_a
-        if delta_keys:
-            for key in sorted(delta_keys):
-                differences.append(
-                    {
-                        "msg": f"{key} in b, not in a",
-                        "path": path,
-                        "a": a,
-                        "b": b,
-                    }
-                )
-        return differences
+    Subclass this and implement ``match`` to make your own matchers.
+
+    """
+
+    @abc.abstractmethod
+    def match(self, value: Any) -> Optional[str]:
+        """Returns None if the value matches or a message saying why not"""
+
+
+@attrs.frozen
+class Regex(Matcher):
+    """Matches strings that match a regular expression
+
+    :param pattern: the regular expression; the whole string has to match
+
+    """
+
+    pattern: str
+    _regex: Pattern = attrs.field(init=False, repr=False, eq=False)
+
+    def __attrs_post_init__(self) -> None:
+        object.__setattr__(self, "_regex", re.compile(self.pattern))
+
+    def match(self, value: Any) -> Optional[str]:
+        if not isinstance(value, str) or self._regex.fullmatch(value) is None:
+            return f"{value!r} does not match {self.pattern!r}"
+        return None
+
+
+@attrs.frozen(init=False)
+class OfType(Matcher):
+    """Matches values that are instances of any of the types
+
+    For example, ``OfType(int, float)``.
+
+    """
+
+    types: Tuple[type, ...]
+
+    def __init__(self, *types: type):
+        self.__attrs_init__(types=types)
+
+    def match(self, value: Any) -> Optional[str]:
+        if not isinstance(value, self.types):
+            return f"{type(value)} is not one of {self.types}"
+        return None
+
+
+@attrs.frozen
+class Scrubbed(Matcher):
+    """Matches values that were scrubbed with ``fillmore.scrubber.MASK_TEXT``
+
+    Use :py:data:`fillmore.test.SCRUBBED` rather than making these.
+
+    """
+
+    def match(self, value: Any) -> Optional[str]:
+        if value != MASK_TEXT:
+            return f"{value!r} is not scrubbed"
+        return None
+
+
+#: Matches scrubbed values
+SCRUBBED = Scrubbed()
+
+
+@attrs.frozen
+class OptionalKey:
+    """Dict value for a key that can be missing; if it's there, the value has
+    to match the template
+
+    For example, ``{"user": OptionalKey({"id": OfType(str)})}``.
+
+    """
+
+    template: Any
+
+
+@attrs.frozen
+class ListOf:
+    """Matches lists where every item matches the template
+
+    :param template: the template for items
+    :param min_length: the minimum number of items
+    :param max_length: the maximum number of items; None for no maximum
+
+    """
+
+    template: Any
+    min_length: int = 0
+    max_length: Optional[int] = None
+
+
+# Compiled template nodes; each has the template it was compiled from for
+# reporting differences
 
-    if isinstance(a, (int, float, str)):
-        if a != b:
-            return [
+
+@attrs.frozen
+class _ValueNode:
+    template: Any
+
+
+@attrs.frozen
+class _MatcherNode:
+    template: Matcher
+
+
+@attrs.frozen
+class _DictNode:
+    template: Dict[Any, Any]
+    # (key, node) in sorted key order
+    children: Tuple[Tuple[Any, Any], ...]
+    required: FrozenSet[Any]
+    allowed: FrozenSet[Any]
+
+
+@attrs.frozen
+class _ListNode:
+    template: Union[list, tuple]
+    items: Tuple[Any, ...]
+
+
+@attrs.frozen
+class _ListOfNode:
+    template: ListOf
+    item: Any
+
+
+# ANY always matches so it's compiled to None
+_AnyNode = None
+
+
+def _compile_node(template: Any) -> Any:
+    if template is ANY:
+        return _AnyNode
+    if isinstance(template, Matcher):
+        return _MatcherNode(template=template)
+    if isinstance(template, ListOf):
+        return _ListOfNode(template=template, item=_compile_node(template.template))
+    if isinstance(template, OptionalKey):
+        raise ConfigurationError("OptionalKey can only be used as a dict value")
+    if isinstance(template, dict):
+        children = []
+        required = set()
+        for key in sorted(template.keys()):
+            value = template[key]
+            if isinstance(value, OptionalKey):
+                value = value.template
+            else:
+                required.add(key)
+            children.append((key, _compile_node(value)))
+        return _DictNode(
+            template=template,
+            children=tuple(children),
+            required=frozenset(required),
+            allowed=frozenset(template.keys()),
+        )
+    if isinstance(template, (list, tuple)):
+        return _ListNode(
+            template=template, items=tuple(_compile_node(item) for item in template)
+        )
+    return _ValueNode(template=template)
+
+
+class ExpectedStructure:
+    """Compiled template from :py:func:`fillmore.test.compile_expected`
+
+    The template is analyzed once when it's compiled, so checking many payloads
+    against it is cheap.
+
+    """
+
+    def __init__(self, template: Any):
+        self.template = template
+        self._root = _compile_node(template)
+
+    def __repr__(self) -> str:
+        return f"<ExpectedStructure {_COMPACT_REPR.repr(self.template)}>"
+
+    def diff(
+        self,
+        payload: Any,
+        max_differences: Optional[int] = None,
+        compact: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """Compares a payload to the template
+
+        Differences are like the ones from
+        :py:func:`fillmore.test.diff_structure` with the payload as ``"a"`` and
+        the template as ``"b"``.
+
+        :arg payload: the payload to check
+        :arg max_differences: stop after finding this many differences; None to
+            find all differences
+        :arg compact: whether to record ``"a"`` and ``"b"`` as strings with the
+            type name and a truncated repr
+
+        :returns: list of differences
+
+        """
+        value_repr = _COMPACT_REPR.repr if compact else repr
+        differences: List[Dict[str, Any]] = []
+
+        def add_difference(msg: str, diff_path: _DiffPath, a: Any, b: Any) -> None:
+            differences.append(
                 {
-                    "msg": f"{a!r} != {b!r}",
-                    "path": path,
-                    "a": a,
-                    "b": b,
+                    "msg": msg,
+                    "path": _path_to_str("", diff_path),
+                    "a": _compact(a) if compact else a,
+                    "b": _compact(b) if compact else b,
                 }
-            ]
+            )
+
+        # Stack of (node, value, path) to check and (msg, path, a, b)
+        # differences to add; see diff_structure
+        stack: List[Tuple[Any, ...]] = [(self._root, payload, None)]
+        while stack:
+            if max_differences is not None and len(differences) >= max_differences:
+                break
+
+            item = stack.pop()
+            if len(item) == 4:
+                add_difference(*item)
+                continue
+
+            node, value, path = item
+            if node is _AnyNode or value is ANY:
+                continue
+
+            if isinstance(node, _MatcherNode):
+                msg = node.template.match(value)
+                if msg is not None:
+                    add_difference(msg, path, value, node.template)
+                continue
+
+            if isinstance(node, _DictNode):
+                if not isinstance(value, dict):
+                    add_difference(
+                        f"different types a:{type(value)} b:{dict}",
+                        path,
+                        value,
+                        node.template,
+                    )
+                    continue
+
+                keys = set(value.keys())
+                for key in sorted(node.required - keys, reverse=True):
+                    stack.append((f"{key} in b, not in a", path, value, node.template))
+                for key in sorted(keys - node.allowed, reverse=True):
+                    stack.append((f"{key} in a, not in b", path, value, node.template))
+                for key, child in reversed(node.children):
+                    if key in value:
+                        stack.append((child, value[key], (path, key, False)))
+                continue
+
+            if isinstance(node, _ListOfNode):
+                if not isinstance(value, (list, tuple)):
+                    add_difference(
+                        f"different types a:{type(value)} b:{list}",
+                        path,
+                        value,
+                        node.template,
+                    )
+                    continue
+
+                template = node.template
+                if len(value) < template.min_length or (
+                    template.max_length is not None and len(value) > template.max_length
+                ):
+                    add_difference(
+                        f"length {len(value)} is not between {template.min_length} "
+                        + f"and {template.max_length}",
+                        path,
+                        value,
+                        template,
+                    )
+                    continue
+
+                for i in range(len(value) - 1, -1, -1):
+                    stack.append((node.item, value[i], (path, i, True)))
+                continue
+
+            if isinstance(node, _ListNode):
+                if type(value) is not type(node.template):
+                    add_difference(
+                        f"different types a:{type(value)} b:{type(node.template)}",
+                        path,
+                        value,
+                        node.template,
+                    )
+                    continue
+
+                # Like diff_structure, missing items are compared as None
+                for i in range(max(len(value), len(node.items)) - 1, -1, -1):
+                    child = node.items[i] if i < len(node.items) else _ValueNode(None)
+                    child_value = value[i] if i < len(value) else None
+                    stack.append((child, child_value, (path, i, True)))
+                continue
+
+            expected = node.template
+            if type(value) is not type(expected):
+                add_difference(
+                    f"different types a:{type(value)} b:{type(expected)}",
+                    path,
+                    value,
+                    expected,
+                )
+            elif isinstance(value, (int, float, str)) and value != expected:
+                add_difference(
+                    f"{value_repr(value)} != {value_repr(expected)}",
+                    path,
+                    value,
+                    expected,
+                )
+
+        return differences
+
+    def matches(self, payload: Any) -> bool:
+        """Returns whether the payload matches the template"""
+        return not self.diff(payload, max_differences=1)
+
+    def assert_matches(self, payload: Any, max_differences: int = 10) -> None:
+        """Asserts the payload matches the template
+
+        :raises AssertionError: with up to max_differences compact differences
+            if it doesn't
+
+        """
+        differences = self.diff(payload, max_differences=max_differences, compact=True)
+        if differences:
+            lines = [f"{diff['path'] or '.'}: {diff['msg']}" for diff in differences]
+            raise AssertionError(
+                "payload does not match expected structure:\n" + "\n".join(lines)
+            )
+
 
-    return []
+def compile_expected(template: Any) -> ExpectedStructure:
+    """Compiles a template for checking payloads against
+
+    A template is an expected structure like you'd pass to
+    :py:func:`fillmore.test.diff_structure`. In addition to
+    ``unittest.mock.ANY``, it can have these matchers:
+
+    * :py:class:`fillmore.test.Regex`: strings that match a regular expression
+    * :py:class:`fillmore.test.OfType`: values of specific types
+    * :py:data:`fillmore.test.SCRUBBED`: values scrubbed by a Scrubber
+    * :py:class:`fillmore.test.OptionalKey`: dict keys that can be missing
+    * :py:class:`fillmore.test.ListOf`: lists where every item matches a
+      template
+    * subclasses of :py:class:`fillmore.test.Matcher`
+
+    Example::
+
+        expected = compile_expected(
+            {
+                "level": Regex("error|fatal"),
+                "event_id": OfType(str),
+                "request": {
+                    "headers": {
+                        "Auth-Token": SCRUBBED,
+                        "Host": ANY,
+                    },
+                    "cookies": OptionalKey(ANY),
+                },
+                "breadcrumbs": {"values": ListOf({"message": OfType(str)})},
+            }
+        )
+
+        for payload in sentry_helper.envelope_payloads:
+            expected.assert_matches(payload)
+
+    :arg template: the expected structure
+
+    :returns: a :py:class:`fillmore.test.ExpectedStructure`
+
+    :raises ConfigurationError: if OptionalKey is used outside of a dict
+
+    """
+    return ExpectedStructure(template)
@@ -0,0 +1,330 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import gzip
+import json
+
+import pytest
+
+from fillmore.cli import main, rules_hash
+from fillmore.corpus import is_compression_available
+from fillmore.scrubber import build_scrub_cookies, Rule, Scrubber
+
+
+SCRUBBER = Scrubber(
+    rules=[
+        Rule(path="request.headers", keys=["Auth-Token"], scrub="scrub"),
+        Rule(path="frames.[].vars", keys=["password"], scrub="scrub"),
+        Rule(path="request", keys=["data"], scrub="scrub"),
+        Rule(path="request.headers", keys=["X-Never"], scrub="scrub"),
+    ]
+)
+
+
+# SCRUBBER without the Auth-Token rule and with an api_key rule
+NEW_SCRUBBER = Scrubber(
+    rules=[
+        Rule(path="frames.[].vars", keys=["password", "api_key"], scrub="scrub"),
+        Rule(path="request", keys=["data"], scrub="scrub"),
+    ]
+)
+
+
+# Scrubbers that change the same cookies value differently
+CODE_SCRUBBER = Scrubber(
+    rules=[Rule(path="request", keys=["cookies"], scrub=build_scrub_cookies(["code"]))]
+)
+STATE_SCRUBBER = Scrubber(
+    rules=[Rule(path="request", keys=["cookies"], scrub=build_scrub_cookies(["state"]))]
+)
+
+
+NOT_A_SCRUBBER = object()
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    events = [
+        {
+            "request": {
+                "headers": {"Auth-Token": "a", "X-Session": "b"},
+                "data": {"password": "c"},
+            },
+            "frames": [{"vars": {"password": "d"}}, {"vars": {"password": "e"}}],
+        },
+        {
+            "request": {"headers": {"X-Session": "f"}},
+            "frames": [{"vars": {"api_key": "g"}}],
+        },
+    ]
+    (tmp_path / "a.json").write_text(json.dumps(events[0]))
+    (tmp_path / "b.jsonl").write_text("\n".join(json.dumps(event) for event in events))
+    return tmp_path
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_coverage(corpus, capsys, workers):
+    exit_code = main(
+        [
+            "coverage",
+            "--rules",
+            "tests.test_cli:SCRUBBER",
+            "--workers",
+            workers,
+            str(corpus),
+        ]
+    )
+    assert exit_code == 0
+
+    out = capsys.readouterr().out
+    assert out == (
+        "Events: 3 in 2 files\n"
+        "\n"
+        "Rule matches:\n"
+        "           2  request.headers ['Auth-Token']\n"
+        "           4  frames.[].vars ['password']\n"
+        "           2  request ['data']\n"
+        "           0  request.headers ['X-Never']  <- never matched\n"
+        "\n"
+        "Sensitive-looking keys not covered by any rule:\n"
+        "           3  request.headers.X-Session\n"
+        "           1  frames.[].vars.api_key\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "spec", ["tests.test_cli:NOT_A_SCRUBBER", "tests.nonexistent:SCRUBBER", "nodots"]
+)
+def test_bad_rules(corpus, capsys, spec):
+    assert main(["coverage", "--rules", spec, str(corpus)]) == 1
+    assert "fillmore coverage: error:" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_scrub(corpus, tmp_path_factory, capsys, workers):
+    outputdir = tmp_path_factory.mktemp("output")
+    args = [
+        "scrub",
+        "--rules",
+        "tests.test_cli:SCRUBBER",
+        "--workers",
+        workers,
+        "-o",
+        str(outputdir),
+        str(corpus),
+    ]
+    assert main(args) == 0
+    out = capsys.readouterr().out
+    assert out.startswith("Scrubbed 2 files (3 events, ")
+    assert "skipped 0 unchanged files" in out
+    assert "Throughput: " in out
+
+    assert json.loads((outputdir / "a.json").read_text()) == {
+        "request": {
+            "headers": {"Auth-Token": "[Scrubbed]", "X-Session": "b"},
+            "data": "[Scrubbed]",
+        },
+        "frames": [
+            {"vars": {"password": "[Scrubbed]"}},
+            {"vars": {"password": "[Scrubbed]"}},
+        ],
+    }
+    assert len((outputdir / "b.jsonl").read_text().splitlines()) == 2
+
+    # Running again skips the unchanged files
+    assert main(args) == 0
+    assert "Scrubbed 0 files" in capsys.readouterr().out
+
+    # Changing a file scrubs it again
+    (corpus / "a.json").write_text(json.dumps({"request": {"data": "x"}}))
+    assert main(args) == 0
+    assert "skipped 1 unchanged files" in capsys.readouterr().out
+    assert json.loads((outputdir / "a.json").read_text()) == {
+        "request": {"data": "[Scrubbed]"}
+    }
+
+
+def test_scrub_compressed(corpus, tmp_path_factory, capsys):
+    with gzip.open(corpus / "c.jsonl.gz", "wt") as fp:
+        fp.write(json.dumps({"request": {"data": "x"}}) + "\n")
+
+    outputdir = tmp_path_factory.mktemp("output")
+    args = ["scrub", "--rules", "tests.test_cli:SCRUBBER", "--workers", "1"]
+    assert main(args + ["-o", str(outputdir), str(corpus)]) == 0
+    assert capsys.readouterr().out.startswith("Scrubbed 3 files (4 events, ")
+
+    # Output is compressed like the input
+    with gzip.open(outputdir / "c.jsonl.gz", "rt") as fp:
+        assert json.loads(fp.read()) == {"request": {"data": "[Scrubbed]"}}
+
+
+def test_scrub_path_error_in_earlier_event(tmp_path_factory, capsys):
+    # A rule path error in one event doesn't leave later events unscrubbed
+    corpus = tmp_path_factory.mktemp("corpus")
+    events = [
+        {"frames": None},
+        {"frames": [{"vars": {"password": "hunter2"}}]},
+    ]
+    (corpus / "a.jsonl").write_text("\n".join(json.dumps(event) for event in events))
+
+    outputdir = tmp_path_factory.mktemp("output")
+    args = ["scrub", "--rules", "tests.test_cli:SCRUBBER", "--workers", "1"]
+    assert main(args + ["-o", str(outputdir), str(corpus)]) == 0
+    capsys.readouterr()
+
+    output = (outputdir / "a.jsonl").read_text()
+    assert "hunter2" not in output
+    assert json.loads(output.splitlines()[1]) == {
+        "frames": [{"vars": {"password": "[Scrubbed]"}}]
+    }
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_scrub_bad_file(corpus, tmp_path_factory, capsys, workers):
+    (corpus / "bad.json").write_text('{"request": {"data": ')
+    with gzip.open(corpus / "bad.jsonl.gz", "wb") as fp:
+        fp.write(b'{"request": {}}\n')
+    # Truncate the compressed file
+    (corpus / "bad.jsonl.gz").write_bytes((corpus / "bad.jsonl.gz").read_bytes()[:15])
+
+    outputdir = tmp_path_factory.mktemp("output")
+    args = ["scrub", "--rules", "tests.test_cli:SCRUBBER", "--workers", workers]
+    assert main(args + ["-o", str(outputdir), str(corpus)]) == 1
+
+    # The bad files are reported and the good files are scrubbed
+    captured = capsys.readouterr()
+    assert "fillmore scrub: error: bad.json: StreamError: " in captured.err
+    assert "fillmore scrub: error: bad.jsonl.gz: " in captured.err
+    assert captured.out.startswith("Scrubbed 2 files (3 events, ")
+    assert "Failed to scrub 2 files" in captured.out
+    assert sorted(path.name for path in outputdir.iterdir()) == [
+        ".fillmore-scrub.json",
+        "a.json",
+        "b.jsonl",
+    ]
+
+    # Bad files aren't in the manifest, so they're tried again
+    assert main(args + ["-o", str(outputdir), str(corpus)]) == 1
+    assert "Failed to scrub 2 files" in capsys.readouterr().out
+
+
+@pytest.mark.skipif(not is_compression_available("zstd"), reason="needs zstd")
+def test_scrub_corrupt_zstd(corpus, tmp_path_factory, capsys):
+    (corpus / "bad.jsonl.zst").write_bytes(b"not zstd data")
+    outputdir = tmp_path_factory.mktemp("output")
+    args = ["scrub", "--rules", "tests.test_cli:SCRUBBER", "--workers", "2"]
+    assert main(args + ["-o", str(outputdir), str(corpus)]) == 1
+
+    captured = capsys.readouterr()
+    assert "fillmore scrub: error: bad.jsonl.zst: " in captured.err
+    assert captured.out.startswith("Scrubbed 2 files (3 events, ")
+
+
+def test_scrub_same_output_path(tmp_path, capsys):
+    for name in ["a", "b"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "x.json").write_text(json.dumps({"request": {}}))
+
+    args = ["scrub", "--rules", "tests.test_cli:SCRUBBER", "-o", str(tmp_path / "out")]
+    assert main(args + [str(tmp_path / "a"), str(tmp_path / "b")]) == 1
+    assert "would both be written to" in capsys.readouterr().err
+    assert not (tmp_path / "out" / "x.json").exists()
+
+    # Passing the same file twice is fine
+    assert main(args + [str(tmp_path / "a"), str(tmp_path / "a" / "x.json")]) == 0
+    assert capsys.readouterr().out.startswith("Scrubbed 1 files (1 events, ")
+
+
+def test_index_and_find(corpus, capsys):
+    assert main(["index", str(corpus)]) == 0
+    assert capsys.readouterr().out.startswith(
+        "Indexed 2 new or changed files and removed 0 deleted files in "
+    )
+
+    assert (
+        main(["find", str(corpus), "request.headers.Auth-Token", "*.[].*.api_key"]) == 0
+    )
+    assert capsys.readouterr().out == "a.json:0\nb.jsonl:0\nb.jsonl:1\n"
+
+
+@pytest.mark.parametrize("workers", ["1", "2"])
+def test_compare(corpus, capsys, workers):
+    args = ["compare", "--workers", workers, "--old", "tests.test_cli:SCRUBBER"]
+    assert main(args + ["--new", "tests.test_cli:NEW_SCRUBBER", str(corpus)]) == 1
+    assert capsys.readouterr().out == (
+        "a.json:0: unmasked request.headers.Auth-Token\n"
+        "b.jsonl:0: unmasked request.headers.Auth-Token\n"
+        "b.jsonl:1: newly masked frames.[0].vars.api_key\n"
+        "2 events with unmasked values, 1 events with newly masked values\n"
+    )
+
+    # Going the other way, api_key is unmasked
+    args = ["compare", "--workers", workers, "--old", "tests.test_cli:NEW_SCRUBBER"]
+    assert main(args + ["--new", "tests.test_cli:SCRUBBER", str(corpus)]) == 1
+    assert "b.jsonl:1: unmasked frames.[0].vars.api_key\n" in capsys.readouterr().out
+
+    # Comparing a scrubber to itself finds no differences
+    args = ["compare", "--workers", workers, "--old", "tests.test_cli:SCRUBBER"]
+    assert main(args + ["--new", "tests.test_cli:SCRUBBER", str(corpus)]) == 0
+    assert capsys.readouterr().out == (
+        "0 events with unmasked values, 0 events with newly masked values\n"
+    )
+
+
+def test_compare_same_path(tmp_path, capsys):
+    (tmp_path / "a.json").write_text(
+        json.dumps({"request": {"cookies": "code=SECRET; state=abc"}})
+    )
+    args = ["compare", "--old", "tests.test_cli:CODE_SCRUBBER"]
+    assert main(args + ["--new", "tests.test_cli:STATE_SCRUBBER", str(tmp_path)]) == 1
+    assert capsys.readouterr().out == (
+        "a.json:0: unmasked request.cookies\n"
+        "a.json:0: newly masked request.cookies\n"
+        "1 events with unmasked values, 1 events with newly masked values\n"
+    )
+
+
+def test_compare_bad_rules(corpus, capsys):
+    args = ["compare", "--old", "tests.test_cli:SCRUBBER", "--new", "nodots"]
+    assert main(args + [str(corpus)]) == 1
+    assert "fillmore compare: error:" in capsys.readouterr().err
+
+
+def _build_scrub_with(thing):
+    def _scrub_with(value):
+        return thing
+
+    return _scrub_with
+
+
+def test_rules_hash_stable():
+    # Memory addresses in reprs of things scrub functions close over aren't part
+    # of the hash, so it's the same in every process
+    def make_scrubber():
+        return Scrubber(
+            rules=[
+                Rule(path="request", keys=["data"], scrub=_build_scrub_with(object()))
+            ]
+        )
+
+    assert rules_hash(make_scrubber()) == rules_hash(make_scrubber())
+
+
+def test_rules_hash():
+    assert rules_hash(SCRUBBER) == rules_hash(SCRUBBER)
+    assert rules_hash(SCRUBBER) != rules_hash(Scrubber(rules=SCRUBBER.rules[1:]))
+    # Parameters of built scrub functions are part of the hash
+    assert rules_hash(
+        Scrubber(
+            rules=[
+                Rule(path="request", keys=["cookies"], scrub=build_scrub_cookies(["a"]))
+            ]
+        )
+    ) != rules_hash(
+        Scrubber(
+            rules=[
+                Rule(path="request", keys=["cookies"], scrub=build_scrub_cookies(["b"]))
+            ]
+        )
+    )
@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+
+import pytest
+
+from fillmore.corpus import (
+    CorpusIndex,
+    event_key_paths,
+    is_compression_available,
+    iter_event_files,
+    iter_events,
+    IndexedEvent,
+    key_path_matches,
+    open_compressed,
+    parse_key_path_pattern,
+)
+
+
+def test_iter_events(tmp_path):
+    (tmp_path / "a.json").write_text(json.dumps({"a": 1}))
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "b.jsonl").write_text('{"b": 1}\n\n{"b": 2}\n')
+    (tmp_path / "notes.txt").write_text("not an event")
+    (tmp_path / ".manifest.json").write_text("{}")
+
+    assert [path.name for path in iter_event_files(tmp_path)] == ["a.json", "b.jsonl"]
+    assert list(iter_events(tmp_path)) == [{"a": 1}, {"b": 1}, {"b": 2}]
+    assert list(iter_events(tmp_path / "a.json")) == [{"a": 1}]
+
+
+@pytest.mark.parametrize(
+    "compression, filename",
+    [
+        ("gzip", "a.jsonl.gz"),
+        pytest.param(
+            "zstd",
+            "a.jsonl.zst",
+            marks=pytest.mark.skipif(
+                not is_compression_available("zstd"), reason="zstd unavailable"
+            ),
+        ),
+    ],
+)
+def test_iter_events_compressed(tmp_path, compression, filename):
+    with open_compressed(tmp_path / filename, "wt", compression) as fp:
+        fp.write('{"a": 1}\n{"a": 2}\n')
+
+    assert [path.name for path in iter_event_files(tmp_path)] == [filename]
+    assert list(iter_events(tmp_path)) == [{"a": 1}, {"a": 2}]
+
+
+def test_open_compressed_bad_compression(tmp_path):
+    with pytest.raises(ValueError):
+        open_compressed(tmp_path / "a.jsonl.xz", "wb", "xz")
+
+
+def test_event_key_paths():
+    event = {
+        "request": {"headers": {"Auth-Token": "abc"}},
+        "frames": [{"vars": {"password": "x"}}, {"vars": {"user": "y"}}],
+        "tags": [["a", "b"]],
+    }
+    assert event_key_paths(event) == {
+        ("request",),
+        ("request", "headers"),
+        ("request", "headers", "Auth-Token"),
+        ("frames",),
+        ("frames", "[]", "vars"),
+        ("frames", "[]", "vars", "password"),
+        ("frames", "[]", "vars", "user"),
+        ("tags",),
+    }
+
+
+@pytest.mark.parametrize(
+    "key_path, pattern, expected",
+    [
+        (("request", "cookies"), "request.cookies", True),
+        (("contexts", "app", "token"), "contexts.*.token", True),
+        (("contexts", "app", "token"), "contexts.*", False),
+        (("frames", "[]", "vars"), "frames.[].vars", True),
+        (("request", "headers", "Auth-Token"), "request.headers.Auth-*", True),
+        (("request", "headers", "X-Token"), "request.headers.Auth-*", False),
+    ],
+)
+def test_key_path_matches(key_path, pattern, expected):
+    assert key_path_matches(key_path, parse_key_path_pattern(pattern)) == expected
+
+
+class TestCorpusIndex:
+    def test_find(self, tmp_path):
+        (tmp_path / "a.json").write_text(
+            json.dumps({"contexts": {"app": {"token": "x"}}})
+        )
+        (tmp_path / "b.jsonl").write_text(
+            json.dumps({"request": {"cookies": "a=b"}})
+            + "\n"
+            + json.dumps({"contexts": {"os": {"token": "y"}}, "request": {}})
+            + "\n"
+        )
+
+        with CorpusIndex(tmp_path) as index:
+            assert index.update() == (2, 0)
+            assert index.find("contexts.*.token") == [
+                IndexedEvent(path=tmp_path / "a.json", position=0),
+                IndexedEvent(path=tmp_path / "b.jsonl", position=1),
+            ]
+            assert index.find("request.cookies") == [
+                IndexedEvent(path=tmp_path / "b.jsonl", position=0)
+            ]
+            assert index.find("request.nothing") == []
+            assert index.key_paths()[("request",)] == 2
+
+            assert index.find("request.cookies")[0].load() == {
+                "request": {"cookies": "a=b"}
+            }
+
+    def test_update_incremental(self, tmp_path):
+        (tmp_path / "a.json").write_text(json.dumps({"a": 1}))
+        (tmp_path / "b.json").write_text(json.dumps({"b": 1}))
+
+        with CorpusIndex(tmp_path) as index:
+            assert index.update() == (2, 0)
+            # Nothing changed
+            assert index.update() == (0, 0)
+
+            (tmp_path / "a.json").write_text(json.dumps({"a": 1, "c": 1}))
+            (tmp_path / "b.json").unlink()
+            assert index.update() == (1, 1)
+            assert [event.path.name for event in index.find("c")] == ["a.json"]
+            assert index.find("b") == []
+
+        # The index persists
+        with CorpusIndex(tmp_path) as index:
+            assert index.update() == (0, 0)
+            assert [event.path.name for event in index.find("a")] == ["a.json"]
+
+    def test_add_file(self, tmp_path):
+        index_path = tmp_path / "index.sqlite"
+        corpus = tmp_path / "corpus"
+        corpus.mkdir()
+        with CorpusIndex(corpus, index_path=index_path) as index:
+            (corpus / "a.json").write_text(json.dumps({"a": 1}))
+            index.add_file(corpus / "a.json")
+            assert [event.path.name for event in index.find("a")] == ["a.json"]
+            # Already indexed
+            assert index.update() == (0, 0)
+
+        assert index_path.exists()
+        assert not (corpus / ".fillmore-index.sqlite").exists()
+
+    def test_shared_index(self, tmp_path):
+        # Two CorpusIndex instances--like two processes--sharing an index
+        # see the key paths the other added
+        with CorpusIndex(tmp_path) as a, CorpusIndex(tmp_path) as b:
+            (tmp_path / "a.json").write_text(json.dumps({"a": 1}))
+            b.update()
+            assert [event.path.name for event in a.find("a")] == ["a.json"]
+
+            (tmp_path / "b.json").write_text(json.dumps({"a": 2}))
+            a.add_file(tmp_path / "b.json")
+            assert [event.path.name for event in b.find("a")] == [
+                "a.json",
+                "b.json",
+            ]
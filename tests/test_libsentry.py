@@ -0,0 +1,298 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import gc
+import json
+import re
+import threading
+import time
+
+import pytest
+import sentry_sdk
+
+from fillmore.libsentry import (
+    BeforeSendGuard,
+    LATENCY_BUCKETS_MS,
+    mask_all,
+    set_up_sentry,
+)
+from fillmore.scrubber import Rule, Scrubber
+from fillmore.test import SentryTestHelper
+
+
+SCRUBBER = Scrubber(rules=[Rule(path="request", keys=["data"], scrub="scrub")])
+
+
+def slow_scrubber(event, hint):
+    time.sleep(0.02)
+    return SCRUBBER(event, hint)
+
+
+def broken_scrubber(event, hint):
+    raise ValueError("broken")
+
+
+def build_event():
+    return {
+        "event_id": "abc",
+        "timestamp": "2024-01-01T00:00:00Z",
+        "level": "error",
+        "platform": "python",
+        "release": "1.0",
+        "environment": "prod",
+        "sdk": {"name": "sentry.python", "version": "2.0.0"},
+        "contexts": {
+            "trace": {"trace_id": "def", "span_id": "ghi", "data": {"a": "b"}},
+            "runtime": {"name": "CPython"},
+        },
+        "request": {"data": "secret", "cookies": "sessionid=secret"},
+        "exception": {
+            "values": [
+                {
+                    "type": "ValueError",
+                    "value": "secret",
+                    "mechanism": {"type": "generic", "handled": True},
+                    "stacktrace": {"frames": [{"lineno": 5}]},
+                }
+            ]
+        },
+        "extra": {"handled": True, "missing": None},
+    }
+
+
+def test_mask_all():
+    event = build_event()
+    assert mask_all(event) == {
+        # Protocol and metadata fields are kept
+        "event_id": "abc",
+        "timestamp": "2024-01-01T00:00:00Z",
+        "level": "error",
+        "platform": "python",
+        "release": "1.0",
+        "environment": "prod",
+        "sdk": {"name": "sentry.python", "version": "2.0.0"},
+        "contexts": {
+            "trace": {"trace_id": "def", "span_id": "ghi", "data": {"a": "[Scrubbed]"}},
+            "runtime": {"name": "[Scrubbed]"},
+        },
+        # Content is masked
+        "request": {"data": "[Scrubbed]", "cookies": "[Scrubbed]"},
+        "exception": {
+            "values": [
+                {
+                    "type": "ValueError",
+                    "value": "[Scrubbed]",
+                    "mechanism": {"type": "generic", "handled": True},
+                    "stacktrace": {"frames": [{"lineno": "[Scrubbed]"}]},
+                }
+            ]
+        },
+        "extra": {"handled": True, "missing": None},
+    }
+    # The event isn't changed
+    assert event["request"]["data"] == "secret"
+
+
+def test_mask_all_through_sentry_sdk():
+    # Events masked because of a timeout are still valid events
+    guard = BeforeSendGuard(slow_scrubber, deadline_ms=1, on_timeout="mask_all")
+    sentry_client = sentry_sdk.Client(
+        before_send=guard, release="1.0", environment="prod"
+    )
+    helper = SentryTestHelper()
+    with helper.use_client(sentry_client) as client:
+        password = "hunter2"  # noqa: F841
+        try:
+            raise ValueError("secret value")
+        except ValueError:
+            sentry_sdk.capture_exception()
+
+        (envelope,) = client.envelopes
+        (event,) = client.events()
+
+    assert guard.stats().timeouts == 1
+    assert "hunter2" not in json.dumps(event)
+    assert "secret value" not in json.dumps(event)
+
+    assert re.fullmatch("[0-9a-f]{32}", event["event_id"])
+    assert envelope.headers["event_id"] == event["event_id"]
+    trace_header = envelope.headers["trace"]
+    assert re.fullmatch("[0-9a-f]{32}", trace_header["trace_id"])
+    assert trace_header["release"] == "1.0"
+    assert trace_header["environment"] == "prod"
+
+    assert isinstance(event["timestamp"], (str, float))
+    assert event["timestamp"] != "[Scrubbed]"
+    assert event["level"] == "error"
+    assert event["platform"] == "python"
+    assert event["sdk"]["name"] == "sentry.python"
+    assert event["contexts"]["trace"]["trace_id"] == trace_header["trace_id"]
+    (exception,) = event["exception"]["values"]
+    assert exception["type"] == "ValueError"
+    assert exception["value"] == "[Scrubbed]"
+
+
+def test_guard_passes_events_through():
+    guard = BeforeSendGuard(SCRUBBER, deadline_ms=1000)
+    event = guard(build_event(), {})
+    assert event["request"]["data"] == "[Scrubbed]"
+    assert event["request"]["cookies"] == "sessionid=secret"
+
+    stats = guard.stats()
+    assert stats.events == 1
+    assert stats.timeouts == 0
+    assert stats.errors == 0
+    assert sum(stats.buckets) == 1
+    assert len(stats.buckets) == len(LATENCY_BUCKETS_MS) + 1
+    assert 0 < stats.max_ms <= stats.total_ms
+
+
+@pytest.mark.parametrize(
+    "on_timeout, expected",
+    [("drop", None), ("mask_all", mask_all(build_event()))],
+)
+def test_guard_timeout(on_timeout, expected):
+    guard = BeforeSendGuard(slow_scrubber, deadline_ms=1, on_timeout=on_timeout)
+    assert guard(build_event(), {}) == expected
+    assert guard.stats().timeouts == 1
+
+
+@pytest.mark.parametrize(
+    "on_timeout, expected",
+    [("drop", None), ("mask_all", mask_all(build_event()))],
+)
+def test_guard_error(caplog, on_timeout, expected):
+    guard = BeforeSendGuard(broken_scrubber, deadline_ms=1000, on_timeout=on_timeout)
+    assert guard(build_event(), {}) == expected
+    assert guard.stats().errors == 1
+    assert caplog.record_tuples == [
+        ("fillmore.libsentry", 40, f"before_send error: doing {on_timeout}")
+    ]
+
+
+def test_guard_bad_on_timeout():
+    with pytest.raises(ValueError):
+        BeforeSendGuard(SCRUBBER, deadline_ms=1, on_timeout="send")
+
+
+def test_guard_stats_threads():
+    guard = BeforeSendGuard(SCRUBBER, deadline_ms=1000)
+
+    def run():
+        for _ in range(50):
+            guard(build_event(), {})
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = guard.stats()
+    assert stats.events == 200
+    assert sum(stats.buckets) == 200
+    assert 0 < stats.percentile(50) <= stats.percentile(99) <= stats.max_ms
+
+
+@pytest.mark.parametrize("before_send", [SCRUBBER, None])
+def test_set_up_sentry_bad_on_timeout(before_send):
+    with pytest.raises(ValueError):
+        set_up_sentry(
+            sentry_dsn="http://public@localhost/1",
+            release="1.0",
+            host_id="host",
+            before_send=before_send,
+            on_timeout="send",
+        )
+
+
+def test_guard_stats_short_lived_threads():
+    # Latencies from threads that exited are merged, so shards don't pile up
+    guard = BeforeSendGuard(SCRUBBER, deadline_ms=1000)
+    for _ in range(200):
+        thread = threading.Thread(target=guard, args=(build_event(), {}))
+        thread.start()
+        thread.join()
+    gc.collect()
+
+    stats = guard.stats()
+    assert stats.events == 200
+    assert sum(stats.buckets) == 200
+    assert len(guard._shards.shards()) < 10
+
+
+def test_percentile_no_events():
+    assert BeforeSendGuard(SCRUBBER).stats().percentile(99) == 0.0
+
+
+@pytest.mark.filterwarnings(
+    # Newer sentry_sdk versions deprecate send_default_pii which set_up_sentry
+    # sets
+    "ignore:The send_default_pii option is deprecated:DeprecationWarning"
+)
+def test_set_up_sentry_guard():
+    global_scope = sentry_sdk.Scope.get_global_scope()
+    previous_client = global_scope.client
+    try:
+        guard = set_up_sentry(
+            sentry_dsn="http://public@localhost/1",
+            release="1.0",
+            host_id="host",
+            before_send=SCRUBBER,
+            scrub_deadline_ms=50,
+            on_timeout="mask_all",
+        )
+        assert isinstance(guard, BeforeSendGuard)
+        assert guard.before_send is SCRUBBER
+        assert guard.deadline_ms == 50
+        assert sentry_sdk.get_client().options["before_send"] is guard
+        sentry_sdk.get_client().close()
+
+        # on_timeout defaults to drop
+        guard = set_up_sentry(
+            sentry_dsn="http://public@localhost/1",
+            release="1.0",
+            host_id="host",
+            before_send=SCRUBBER,
+            scrub_deadline_ms=50,
+        )
+        assert isinstance(guard, BeforeSendGuard)
+        assert guard.on_timeout == "drop"
+        sentry_sdk.get_client().close()
+
+        # With only on_timeout, before_send is guarded against exceptions and
+        # timed
+        guard = set_up_sentry(
+            sentry_dsn="http://public@localhost/1",
+            release="1.0",
+            host_id="host",
+            before_send=broken_scrubber,
+            on_timeout="drop",
+        )
+        assert isinstance(guard, BeforeSendGuard)
+        assert guard.deadline_ms is None
+        assert sentry_sdk.get_client().options["before_send"] is guard
+        assert guard(build_event(), {}) is None
+        assert guard.stats().errors == 1
+        sentry_sdk.get_client().close()
+
+        # Without either, before_send is passed as it is
+        guard = set_up_sentry(
+            sentry_dsn="http://public@localhost/1",
+            release="1.0",
+            host_id="host",
+            before_send=SCRUBBER,
+        )
+        assert guard is None
+        assert sentry_sdk.get_client().options["before_send"] is SCRUBBER
+        sentry_sdk.get_client().close()
+
+        # Without a before_send, there's nothing to guard
+        guard = set_up_sentry(
+            sentry_dsn="http://public@localhost/1", release="1.0", host_id="host"
+        )
+        assert guard is None
+        sentry_sdk.get_client().close()
+    finally:
+        global_scope.set_client(previous_client)
@@ -0,0 +1,301 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+
+import pytest
+
+from fillmore.pytest_plugin import assert_no_scrub_errors, record_scrub_errors
+from fillmore.scrubber import Rule, Scrubber
+
+
+pytest_plugins = ["pytester"]
+
+
+def broken_scrub(value):
+    raise ValueError("broken")
+
+
+def build_scrubber(error_handler=None):
+    return Scrubber(
+        rules=[Rule(path="request", keys=["data"], scrub=broken_scrub)],
+        error_handler=error_handler,
+    )
+
+
+def test_assert_no_scrub_errors():
+    scrubber = build_scrubber()
+    with assert_no_scrub_errors():
+        scrubber({"request": {}}, {})
+
+    with pytest.raises(AssertionError, match="1 scrubber errors"):
+        with assert_no_scrub_errors():
+            scrubber({"request": {"data": "abc"}}, {})
+
+
+def test_record_scrub_errors_error_handler(caplog):
+    handled = []
+    scrubber = build_scrubber(error_handler=handled.append)
+    with record_scrub_errors(scrubber) as recorder:
+        scrubber({"request": {"data": "abc"}}, {})
+
+    # The error is recorded once and the original error_handler is called
+    expected = "scrub fun error: broken_scrub, error: broken"
+    assert recorder.errors == [expected]
+    assert handled == [expected]
+    assert scrubber.error_handler == handled.append
+
+
+def test_record_scrub_errors_silenced_logger(caplog):
+    caplog.set_level(logging.CRITICAL, logger="fillmore")
+    scrubber = build_scrubber()
+    with record_scrub_errors(scrubber) as recorder:
+        scrubber({"request": {"data": "abc"}}, {})
+    assert recorder.errors == ["scrub fun error: broken_scrub, error: broken"]
+
+
+TEST_FILE = """
+from fillmore.scrubber import Rule, Scrubber
+
+
+def broken_scrub(value):
+    raise ValueError("broken")
+
+
+scrubber = Scrubber(rules=[Rule(path="request", keys=["data"], scrub=broken_scrub)])
+
+
+def test_ok(FIXTURE):
+    scrubber({"request": {}}, {})
+
+
+def test_error(FIXTURE):
+    scrubber({"request": {"data": "abc"}}, {})
+"""
+
+
+def test_no_scrub_errors_fixture(pytester):
+    pytester.makepyfile(TEST_FILE.replace("FIXTURE", "no_scrub_errors"))
+    result = pytester.runpytest()
+    result.assert_outcomes(passed=2, errors=1)
+    result.stdout.fnmatch_lines(["*1 scrubber errors:*", "*broken_scrub*"])
+
+
+def test_no_scrub_errors_ini(pytester):
+    pytester.makeini("[pytest]\nfillmore_no_scrub_errors = true\n")
+    pytester.makepyfile(TEST_FILE.replace("FIXTURE", ""))
+    result = pytester.runpytest()
+    result.assert_outcomes(passed=2, errors=1)
+
+
+PROFILE_TEST_FILE = """
+import time
+
+import pytest
+
+from fillmore.scrubber import Rule, Scrubber
+
+
+def slow_scrub(value):
+    time.sleep(0.02)
+    return "[Scrubbed]"
+
+
+scrubber = Scrubber(
+    rules=[
+        Rule(path="request", keys=["data"], scrub=slow_scrub),
+        Rule(path="request", keys=["headers"], scrub="scrub"),
+    ]
+)
+
+
+def test_scrubs():
+    for _ in range(3):
+        scrubber({"request": {"data": "abc", "headers": {}}}, {})
+
+
+def test_no_scrubs():
+    pass
+
+
+@pytest.mark.max_scrub_ms(1)
+def test_over_budget():
+    scrubber({"request": {"data": "abc"}}, {})
+
+
+@pytest.mark.max_scrub_ms(1000)
+def test_under_budget():
+    scrubber({"request": {"data": "abc"}}, {})
+"""
+
+
+def test_profile(pytester):
+    pytester.makepyfile(PROFILE_TEST_FILE)
+    result = pytester.runpytest("--fillmore-profile")
+    result.assert_outcomes(passed=3, failed=1)
+    result.stdout.fnmatch_lines(
+        [
+            "*scrubbing an event took * ms; max_scrub_ms is 1",
+            "*fillmore scrub profile*",
+            "5 scrubs in 3 tests took * ms; * event bytes",
+            "Slowest tests by total scrub time:",
+            "* ms       3 scrubs  test_profile.py::test_scrubs",
+            "Slowest scrubs:",
+            "Slowest rules by total time:",
+            # [ and ] are special in fnmatch patterns
+            "* ms       5 calls  request ?'data'?",
+            "* ms       5 calls  request ?'headers'?",
+        ]
+    )
+
+
+def test_max_scrub_ms_without_profile(pytester):
+    pytester.makepyfile(PROFILE_TEST_FILE)
+    result = pytester.runpytest()
+    result.assert_outcomes(passed=3, failed=1)
+    assert "fillmore scrub profile" not in result.stdout.str()
+
+
+UNSERIALIZABLE_TEST_FILE = """
+import pytest
+from fillmore.scrubber import Rule, Scrubber
+
+scrubber = Scrubber(rules=[Rule(path="request", keys=["data"], scrub="scrub")])
+
+
+@pytest.mark.max_scrub_ms(1000)
+def test_tuple_keys():
+    scrubber({"request": {"data": "abc"}, "extra": {(1, 2): "a"}}, {})
+"""
+
+
+@pytest.mark.parametrize("args", [[], ["--fillmore-profile"]])
+def test_profile_unserializable_event(pytester, args):
+    # Events that can't be serialized to JSON are still scrubbed and timed
+    pytester.makepyfile(UNSERIALIZABLE_TEST_FILE)
+    result = pytester.runpytest(*args)
+    result.assert_outcomes(passed=1)
+
+
+SESSION_CLIENT_TEST_FILE = """
+import pytest
+import sentry_sdk
+
+CLIENTS = []
+
+
+@pytest.fixture(scope="session")
+def sentry_client_options():
+    return {"release": "1.0"}
+
+
+def test_first(sentry_client):
+    CLIENTS.append(sentry_sdk.get_client())
+    sentry_sdk.set_tag("color", "red")
+    sentry_sdk.set_user({"id": "1"})
+    sentry_sdk.add_breadcrumb(message="crumb")
+    sentry_sdk.capture_message("first")
+
+    (event,) = sentry_client.events()
+    assert event["release"] == "1.0"
+    assert event["tags"] == {"color": "red"}
+    assert event["user"] == {"id": "1"}
+    assert len(event["breadcrumbs"]["values"]) == 1
+
+
+def test_second(sentry_client):
+    CLIENTS.append(sentry_sdk.get_client())
+    sentry_sdk.capture_message("second")
+
+    # Nothing from the first test is in the event
+    (event,) = sentry_client.events()
+    assert event["message"] == "second"
+    assert "tags" not in event
+    assert "user" not in event
+    assert event.get("breadcrumbs", {"values": []})["values"] == []
+
+    # Both tests used the same client
+    assert CLIENTS[0] is CLIENTS[1]
+"""
+
+
+def test_sentry_client(pytester):
+    pytester.makepyfile(SESSION_CLIENT_TEST_FILE)
+    result = pytester.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+SNAPSHOT_TEST_FILE = """
+import uuid
+
+from fillmore.scrubber import Rule, Scrubber
+
+scrubber = Scrubber(rules=[Rule(path="request", keys=["data"], scrub="scrub")])
+
+
+class Thing:
+    pass
+
+
+def make_event():
+    return {
+        "event_id": uuid.uuid4().hex,
+        "request": {"data": "secret", "url": "URL"},
+        "extra": {"thing": repr(Thing())},
+    }
+
+
+def test_scrubbed(snapshot):
+    snapshot.assert_match(make_event(), scrubber=scrubber)
+    snapshot.assert_match({"message": "named"}, name="named")
+    snapshot.assert_match({"message": "third"})
+
+
+class TestThings:
+    def test_scrubbed(self, snapshot):
+        snapshot.assert_match({"message": "in a class"})
+"""
+
+
+def test_snapshot(pytester):
+    pytester.makepyfile(test_snapshots=SNAPSHOT_TEST_FILE)
+
+    # Snapshots are missing until they're created
+    result = pytester.runpytest()
+    result.assert_outcomes(failed=2)
+    result.stdout.fnmatch_lines(["*no snapshot 'test_scrubbed' in *"])
+
+    result = pytester.runpytest("--update-snapshots")
+    result.assert_outcomes(passed=2)
+    snapshot_path = pytester.path / "__snapshots__" / "test_snapshots.jsonl"
+    lines = snapshot_path.read_text().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == [
+        "TestThings::test_scrubbed",
+        "named",
+        "test_scrubbed",
+        "test_scrubbed-1",
+    ]
+    assert json.loads(lines[2])["snapshot"] == {
+        "event_id": "<event_id>",
+        "request": {"data": "[Scrubbed]", "url": "URL"},
+        "extra": {"thing": "<test_snapshots.Thing object at 0x<address>>"},
+    }
+
+    # Volatile values like event_id and memory addresses don't break snapshots
+    result = pytester.runpytest()
+    result.assert_outcomes(passed=2)
+
+    # Changing the event fails the test
+    pytester.makepyfile(test_snapshots=SNAPSHOT_TEST_FILE.replace('"URL"', '"CHANGED"'))
+    result = pytester.runpytest()
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines(["*event doesn't match snapshot 'test_scrubbed':*"])
+
+    # Updating doesn't rewrite unchanged snapshots
+    mtime = snapshot_path.stat().st_mtime_ns
+    pytester.makepyfile(test_snapshots=SNAPSHOT_TEST_FILE)
+    result = pytester.runpytest("--update-snapshots")
+    result.assert_outcomes(passed=2)
+    assert snapshot_path.stat().st_mtime_ns == mtime
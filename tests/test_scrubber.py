@@ -2,16 +2,22 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import copy
+import gc
 import logging
+import pickle
+import threading
 
 import pytest
 
 from fillmore.scrubber import (
     build_scrub_cookies,
     build_scrub_query_string,
+    load_scrubber,
     _get_target_dicts,
     scrub,
     Scrubber,
+    ScrubberStats,
     Rule,
 )
 
@@ -95,6 +101,14 @@ def test_scrub_cookies(cookies, keys, expected):
     assert scrub_fun(cookies) == expected
 
 
+def test_scrub_cookies_params_frozen():
+    keys = ["code"]
+    scrub_fun = build_scrub_cookies(params=keys)
+    # Changing the list after building the scrub function has no effect
+    keys.append("state")
+    assert scrub_fun("code=abc; state=def") == "code=[Scrubbed]; state=def"
+
+
 @pytest.mark.parametrize(
     "qs, keys, expected",
     [
@@ -518,3 +532,148 @@ class TestScrubber:
             ),
             ("fillmore.scrubber", 40, "error in error_handler bad_error_handler"),
         ]
+
+    def test_rules_compiled(self):
+        rules = [Rule(path="foo", keys=["bar"], scrub=scrub)]
+        scrubber = Scrubber(rules=rules)
+
+        # Changing the rules after creating the Scrubber has no effect
+        rules.append(Rule(path="foo", keys=["baz"], scrub=scrub))
+        rules[0].keys.append("baz")
+
+        event = {"foo": {"bar": "a", "baz": "b"}}
+        assert scrubber(event, {}) == {"foo": {"bar": "[Scrubbed]", "baz": "b"}}
+
+    def test_set_rules(self):
+        rules = [Rule(path="foo", keys=["bar"], scrub=scrub)]
+        scrubber = Scrubber(rules=rules)
+        assert scrubber.rules == tuple(rules)
+        assert scrubber({"foo": {"bar": 1, "baz": 2}}, {}) == {
+            "foo": {"bar": "[Scrubbed]", "baz": 2}
+        }
+
+        # Setting the rules compiles them and resets the stats
+        scrubber.rules = [Rule(path="foo", keys=["baz"], scrub=scrub)]
+        assert scrubber.stats() == ScrubberStats(events=0, errors=0, rule_matches=(0,))
+        assert scrubber({"foo": {"bar": 1, "baz": 2}}, {}) == {
+            "foo": {"bar": 1, "baz": "[Scrubbed]"}
+        }
+
+        # Changing the rules in place would be ignored, so it's an error
+        with pytest.raises(AttributeError):
+            scrubber.rules.append(Rule(path="foo", keys=["bar"], scrub=scrub))
+
+    def test_copy_and_pickle(self):
+        scrubber = Scrubber(rules=[Rule(path="foo", keys=["bar"], scrub=scrub)])
+        scrubber({"foo": {"bar": 1}}, {})
+
+        copies = [
+            copy.copy(scrubber),
+            copy.deepcopy(scrubber),
+            pickle.loads(pickle.dumps(scrubber)),
+        ]
+        for scrubbed_copy in copies:
+            assert scrubbed_copy.rules == scrubber.rules
+            assert scrubbed_copy({"foo": {"bar": 1}}, {}) == {
+                "foo": {"bar": "[Scrubbed]"}
+            }
+            # Copies have their own stats
+            assert scrubbed_copy.stats().events == 1
+        assert scrubber.stats().events == 1
+
+    def test_stats(self, caplog):
+        def bad_scrub(value):
+            raise Exception("scruberror")
+
+        scrubber = Scrubber(
+            rules=[
+                Rule(path="frames.[].vars", keys=["code", "state"], scrub=scrub),
+                Rule(path="request", keys=["data"], scrub=bad_scrub),
+                Rule(path="request", keys=["cookies"], scrub=scrub),
+            ]
+        )
+        assert scrubber.stats() == ScrubberStats(
+            events=0, errors=0, rule_matches=(0, 0, 0)
+        )
+
+        scrubber(
+            {
+                "frames": [
+                    {"vars": {"code": "a", "state": "b"}},
+                    {"vars": {"code": 1}},
+                ],
+                "request": {"data": "abc"},
+            },
+            {},
+        )
+        scrubber({}, {})
+
+        assert scrubber.stats() == ScrubberStats(
+            events=2, errors=1, rule_matches=(3, 1, 0)
+        )
+
+    def test_threads(self):
+        scrubber = Scrubber(
+            rules=[Rule(path="frames.[].vars", keys=["code"], scrub=scrub)]
+        )
+        event = {"frames": [{"vars": {"code": "a"}}, {"vars": {"code": "b"}}]}
+        expected = {
+            "frames": [
+                {"vars": {"code": "[Scrubbed]"}},
+                {"vars": {"code": "[Scrubbed]"}},
+            ]
+        }
+        results = []
+
+        def scrub_events():
+            for _ in range(100):
+                results.append(scrubber(copy.deepcopy(event), {}) == expected)
+
+        threads = [threading.Thread(target=scrub_events) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [True] * 800
+        assert scrubber.stats() == ScrubberStats(
+            events=800, errors=0, rule_matches=(1600,)
+        )
+
+    def test_short_lived_threads(self):
+        # Shards of threads that exited are merged, so they don't pile up
+        scrubber = Scrubber(rules=[Rule(path="foo", keys=["bar"], scrub=scrub)])
+
+        for _ in range(20):
+            threads = [
+                threading.Thread(target=scrubber, args=({"foo": {"bar": 1}}, {}))
+                for _ in range(100)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            del threads
+        gc.collect()
+
+        assert scrubber.stats() == ScrubberStats(
+            events=2000, errors=0, rule_matches=(2000,)
+        )
+        assert len(scrubber._shards.shards()) < 200
+
+
+SPEC_SCRUBBER = Scrubber(rules=[])
+
+
+def test_load_scrubber():
+    assert load_scrubber("tests.test_scrubber:SPEC_SCRUBBER") is SPEC_SCRUBBER
+    assert load_scrubber("tests.test_scrubber.SPEC_SCRUBBER") is SPEC_SCRUBBER
+
+
+@pytest.mark.parametrize(
+    "spec",
+    ["nodots", "tests.not_a_module:scrubber", "tests.test_scrubber:load_scrubber"],
+)
+def test_load_scrubber_bad_spec(spec):
+    with pytest.raises(ValueError):
+        load_scrubber(spec)
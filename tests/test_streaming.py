@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import copy
+import io
+import json
+import logging
+import tracemalloc
+
+import pytest
+
+from fillmore.scrubber import (
+    build_scrub_cookies,
+    Rule,
+    scrub,
+    Scrubber,
+)
+from fillmore.streaming import scrub_json_bytes, scrub_json_stream, StreamError
+
+
+EVENT = {
+    "request": {
+        "cookies": "code=abc; other=1",
+        "data": {"password": "secret", "nested": {"a": [1, 2.5, None, True]}},
+        "headers": {"Auth-Token": 'tok"en\\', "Host": "example.com"},
+    },
+    "exception": {
+        "values": [
+            {
+                "stacktrace": {
+                    "frames": [
+                        {"vars": {"username": "bob", "unicode": "☃ \\u"}},
+                        {"vars": {}},
+                        {"function": "nope"},
+                        {"vars": {"username": {"deep": ["x"]}}},
+                    ]
+                }
+            }
+        ]
+    },
+    "extra": {"list": [], "empty": {}},
+}
+
+
+RULES = [
+    Rule(path="request", keys=["cookies"], scrub=build_scrub_cookies(["code"])),
+    Rule(path="request.headers", keys=["Auth-Token"], scrub=scrub),
+    # Rule that scrubs a value and rule that scrubs inside that value
+    Rule(path="request.data", keys=["password"], scrub=scrub),
+    Rule(path="request", keys=["data"], scrub=lambda value: dict(value, extra=1)),
+    Rule(
+        path="exception.values.[].stacktrace.frames.[].vars",
+        keys=["username"],
+        scrub=scrub,
+    ),
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64 * 1024])
+def test_same_as_scrubber(chunk_size):
+    scrubber = Scrubber(rules=RULES)
+    expected = scrubber(copy.deepcopy(EVENT), {})
+
+    outfp = io.BytesIO()
+    data = json.dumps(EVENT, indent=2).encode("utf-8")
+    scrub_json_stream(scrubber, io.BytesIO(data), outfp, chunk_size=chunk_size)
+
+    assert json.loads(outfp.getvalue()) == expected
+
+
+def test_unchanged():
+    data = json.dumps(EVENT).encode("utf-8")
+    assert json.loads(scrub_json_bytes(Scrubber(rules=[]), data)) == EVENT
+
+
+def test_text_streams():
+    scrubber = Scrubber(rules=[Rule(path="foo", keys=["bar"], scrub=scrub)])
+    outfp = io.StringIO()
+    scrub_json_stream(scrubber, io.StringIO('{"foo": {"bar": "baz"}}'), outfp)
+    assert outfp.getvalue() == '{"foo":{"bar":"[Scrubbed]"}}\n'
+
+
+def test_multiple_events():
+    scrubber = Scrubber(rules=[Rule(path="foo", keys=["bar"], scrub=scrub)])
+    data = b'{"foo": {"bar": 1}}\n{"foo": {"baz": 2}}\n{"foo": {"bar": 3}}\n'
+    assert scrub_json_bytes(scrubber, data).splitlines() == [
+        b'{"foo":{"bar":"[Scrubbed]"}}',
+        b'{"foo":{"baz":2}}',
+        b'{"foo":{"bar":"[Scrubbed]"}}',
+    ]
+
+
+def test_scrub_error(caplog):
+    def bad_scrub(value):
+        raise Exception("scruberror")
+
+    scrubber = Scrubber(rules=[Rule(path="request", keys=["data"], scrub=bad_scrub)])
+    data = b'{"request": {"data": {"foo": "bar"}}}'
+    assert json.loads(scrub_json_bytes(scrubber, data)) == {
+        "request": {"data": "ERROR WHEN SCRUBBING"}
+    }
+    assert caplog.record_tuples == [
+        (
+            "fillmore.scrubber",
+            logging.ERROR,
+            "scrub fun error: bad_scrub, error: scruberror",
+        )
+    ]
+
+
+def test_path_error(caplog):
+    errors = []
+    scrubber = Scrubber(
+        rules=[Rule(path="request.[].data", keys=["foo"], scrub="scrub")],
+        error_handler=errors.append,
+    )
+    data = b'{"request": {"data": {"foo": "bar"}}}'
+    assert json.loads(scrub_json_bytes(scrubber, data)) == {
+        "request": {"data": {"foo": "bar"}}
+    }
+    msg = "scrubber error: error: path 'request.[]' doesn't match event structure"
+    assert errors == [msg]
+    assert caplog.record_tuples == [("fillmore.scrubber", logging.ERROR, msg)]
+
+
+def test_path_error_in_earlier_event(caplog):
+    # A path error in one event doesn't stop the rule for later events
+    scrubber = Scrubber(
+        rules=[Rule(path="exception.values.[].vars", keys=["password"], scrub=scrub)]
+    )
+    events = [
+        {"exception": {"values": None}},
+        {"exception": {"values": [{"vars": {"password": "hunter2"}}]}},
+    ]
+    data = "\n".join(json.dumps(event) for event in events).encode("utf-8")
+    scrubbed = [
+        json.loads(line) for line in scrub_json_bytes(scrubber, data).splitlines()
+    ]
+    assert scrubbed == [scrubber(copy.deepcopy(event), {}) for event in events]
+    assert scrubbed[1]["exception"]["values"][0]["vars"]["password"] == "[Scrubbed]"
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b'{"foo": ',
+        b'{"foo" 1}',
+        b'{"foo": "bar}',
+        b'{"foo": }',
+        b"[1, 2",
+        # Missing commas and colons
+        b"[1 2]",
+        b'{"a": 1 "b": 2}',
+        b'{"a" 1}',
+        # Trailing commas
+        b"[1, 2,]",
+        b'{"a": 1,}',
+        # Bad bare values
+        b"tru",
+        b'{"a": [nul]}',
+        b"[01]",
+        # Bad strings
+        b'["\\q"]',
+        b'["a\nb"]',
+        b'"\\u12',
+    ],
+)
+def test_invalid_json(data):
+    with pytest.raises(StreamError):
+        scrub_json_bytes(Scrubber(rules=[]), data)
+
+
+@pytest.mark.parametrize("chunk_size", [5, 64 * 1024])
+def test_large_values(chunk_size):
+    scrubber = Scrubber(rules=[Rule(path="request", keys=["data"], scrub=scrub)])
+    event = {
+        "request": {"data": "\u2603" * 10_000, "body": 'a"\\\n\u2603' * 10_000},
+        "extra": [1.5e10, -0, True, None],
+    }
+    outfp = io.BytesIO()
+    data = json.dumps(event).encode("utf-8")
+    scrub_json_stream(scrubber, io.BytesIO(data), outfp, chunk_size=chunk_size)
+    assert json.loads(outfp.getvalue()) == {
+        "request": {"data": "[Scrubbed]", "body": event["request"]["body"]},
+        "extra": event["extra"],
+    }
+
+
+def test_nan():
+    # json.dumps writes NaN and Infinity by default
+    data = b'{"a": [NaN, Infinity, -Infinity]}'
+    assert scrub_json_bytes(Scrubber(rules=[]), data) == (
+        b'{"a":[NaN,Infinity,-Infinity]}\n'
+    )
+
+
+def test_unscrubbed_values_not_held(tmp_path):
+    # Values that aren't scrubbed are copied through as they're read, so
+    # memory use doesn't depend on their size
+    scrubber = Scrubber(rules=[Rule(path="request", keys=["data"], scrub=scrub)])
+    path = tmp_path / "event.json"
+    path.write_text(json.dumps({"request": {"data": "x", "body": "y" * 8_000_000}}))
+
+    tracemalloc.start()
+    try:
+        with open(path, "rb") as infp, open(tmp_path / "out.json", "wb") as outfp:
+            scrub_json_stream(scrubber, infp, outfp)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak < 1_000_000
+    assert json.loads((tmp_path / "out.json").read_text())["request"]["data"] == (
+        "[Scrubbed]"
+    )
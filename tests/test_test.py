@@ -2,18 +2,49 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import asyncio
+import contextvars
+import gc
+import gzip
+import threading
 from unittest.mock import ANY
+import urllib.request
+import weakref
 
 import json
 import pytest
 import sentry_sdk
+from sentry_sdk.envelope import Envelope, Item, PayloadRef
 from sentry_sdk.integrations.stdlib import StdlibIntegration
 
-from fillmore.scrubber import Scrubber, Rule
+from fillmore.corpus import CorpusIndex, is_compression_available, iter_events
+from fillmore.scrubber import (
+    build_scrub_cookies,
+    build_scrub_query_string,
+    Scrubber,
+    Rule,
+    SCRUB_RULES_DEFAULT,
+)
 from fillmore.test import (
+    compare_scrubbers,
+    compile_expected,
+    ConfigurationError,
     diff_structure,
+    EventGenerator,
+    FakeSentryServer,
     get_sentry_base_url,
+    JSONLSink,
+    ListOf,
+    loadtest,
+    Matcher,
+    measure_scrub,
+    normalize_event,
+    OfType,
+    OptionalKey,
+    Regex,
     SaveEvents,
+    SCRUBBED,
+    scrubbed_paths,
     SentryTestHelper,
 )
 
@@ -59,6 +90,259 @@ def test_helper_capture_envelopes():
         assert payload2["exception"]["values"][0]["value"] == "another intentional"
 
 
+def test_helper_queries():
+    helper = SentryTestHelper()
+    with helper.init(traces_sample_rate=1.0) as sentry_client:
+        event_id = sentry_sdk.capture_message("message")
+        with sentry_sdk.start_transaction(name="txn"):
+            pass
+
+        (event,) = sentry_client.events()
+        assert event["message"] == "message"
+        assert sentry_client.events(type="event") == [event]
+
+        (transaction,) = sentry_client.transactions()
+        assert transaction["transaction"] == "txn"
+
+        assert sentry_client.find(event_id) is event
+        assert sentry_client.find(transaction["event_id"]) is transaction
+        assert sentry_client.find("nonexistent") is None
+
+        # Returned lists are copies
+        sentry_client.envelope_payloads.clear()
+        assert len(sentry_client.envelope_payloads) == 2
+
+        sentry_client.reset()
+        assert sentry_client.envelope_payloads == []
+        assert sentry_client.events() == []
+        assert sentry_client.find(event_id) is None
+
+
+def test_helper_wait_for():
+    helper = SentryTestHelper()
+    with helper.init() as sentry_client:
+        with pytest.raises(TimeoutError):
+            sentry_client.wait_for(count=1, timeout=0.01)
+
+        sentry_sdk.capture_message("message")
+        assert len(sentry_client.wait_for(count=1, timeout=0)) == 1
+
+        # Envelopes captured in another thread wake up the waiter
+        thread = threading.Thread(
+            target=lambda: [sentry_sdk.capture_message(str(i)) for i in range(2)]
+        )
+        thread.start()
+        assert len(sentry_client.wait_for(count=3, timeout=5)) == 3
+        thread.join()
+
+
+def test_helper_ainit():
+    async def run():
+        helper = SentryTestHelper()
+        async with helper.ainit() as sentry_client:
+            with pytest.raises(TimeoutError):
+                await sentry_client.wait_for_events(1, timeout=0.01)
+
+            # Captures in another thread wake up the waiter without blocking the
+            # event loop; the thread runs in a copy of the task's context so it
+            # uses the task's client
+            context = contextvars.copy_context()
+            thread = threading.Thread(
+                target=context.run, args=(sentry_sdk.capture_message, "message")
+            )
+            thread.start()
+            (event,) = await sentry_client.wait_for_events(1, timeout=5)
+            assert event["message"] == "message"
+            thread.join()
+
+            assert sentry_sdk.get_client().transport is helper._transport
+
+        # The client was only set for the block
+        assert sentry_sdk.get_client().transport is not helper._transport
+
+    asyncio.run(run())
+
+
+def test_helper_ainit_concurrent_tasks():
+    previous_client = sentry_sdk.Scope.get_global_scope().client
+
+    async def task(name):
+        helper = SentryTestHelper()
+        async with helper.ainit() as sentry_client:
+            sentry_sdk.set_tag("task", name)
+            for i in range(3):
+                sentry_sdk.capture_message(f"{name} {i}")
+                await asyncio.sleep(0)
+            events = await sentry_client.wait_for_events(3, timeout=5)
+        return events
+
+    async def run():
+        return await asyncio.gather(task("a"), task("b"))
+
+    events_a, events_b = asyncio.run(run())
+
+    # Each task only saw its own events and scope data
+    assert [event["message"] for event in events_a] == ["a 0", "a 1", "a 2"]
+    assert [event["message"] for event in events_b] == ["b 0", "b 1", "b 2"]
+    assert {event["tags"]["task"] for event in events_a} == {"a"}
+    assert {event["tags"]["task"] for event in events_b} == {"b"}
+
+    # The global client wasn't touched
+    assert sentry_sdk.Scope.get_global_scope().client is previous_client
+
+
+class TestFakeSentryServer:
+    def test_real_transport(self):
+        with FakeSentryServer() as server:
+            assert server.base_url == f"http://127.0.0.1:{server.port}/"
+
+            client = sentry_sdk.Client(dsn=server.dsn, default_integrations=False)
+            with sentry_sdk.new_scope() as scope:
+                scope.set_client(client)
+                event_ids = [
+                    sentry_sdk.capture_message(f"message {i}") for i in range(3)
+                ]
+            client.flush(timeout=5)
+
+            server.wait_for(count=3, timeout=5)
+            assert sorted(event["message"] for event in server.events()) == [
+                "message 0",
+                "message 1",
+                "message 2",
+            ]
+            assert server.find(event_ids[0])["message"] == "message 0"
+            assert server.find("nonexistent") is None
+
+            server.reset()
+            assert server.envelopes == []
+            client.close()
+
+    def _post(self, server, body, headers):
+        request = urllib.request.Request(
+            f"{server.base_url}api/1/envelope/", data=body, headers=headers
+        )
+        with urllib.request.urlopen(request) as resp:
+            assert resp.status == 200
+
+    def test_gzip(self):
+        body = b'{}\n{"type":"event"}\n{"event_id":"abc","message":"hi"}\n'
+        with FakeSentryServer() as server:
+            self._post(server, gzip.compress(body), {"Content-Encoding": "gzip"})
+            self._post(server, body, {})
+            server.wait_for(count=2, timeout=5)
+            assert server.request_count == 2
+            assert server.events() == [
+                {"event_id": "abc", "message": "hi"},
+                {"event_id": "abc", "message": "hi"},
+            ]
+
+    def test_unsupported_encoding(self):
+        body = b'{}\n{"type":"event"}\n{"event_id":"abc","message":"hi"}\n'
+        with FakeSentryServer() as server:
+            self._post(server, b"abc", {"Content-Encoding": "lzma"})
+            self._post(server, body, {})
+            server.wait_for(count=2, timeout=5)
+
+            # The bad request is recorded and doesn't hide the others
+            assert server.events() == [{"event_id": "abc", "message": "hi"}]
+            assert len(server.envelopes) == 1
+            (error,) = server.decode_errors
+            assert error.startswith("request 1: ValueError: ")
+
+            server.reset()
+            assert server.decode_errors == []
+
+    def test_sessions(self):
+        body = b'{}\n{"type":"session"}\n{"sid":"abc","status":"ok"}\n'
+        with FakeSentryServer() as server:
+            self._post(server, body, {})
+            server.wait_for(count=1, timeout=5)
+            assert server.events(type="session") == [{"sid": "abc", "status": "ok"}]
+            assert server.events() == []
+
+    def test_wait_for_timeout(self):
+        with FakeSentryServer() as server:
+            with pytest.raises(TimeoutError):
+                server.wait_for(count=1, timeout=0.01)
+
+
+def test_helper_use_client():
+    client = sentry_sdk.Client()
+    previous_client = sentry_sdk.Scope.get_global_scope().client
+
+    helper = SentryTestHelper()
+    with helper.use_client(client) as sentry_client:
+        assert sentry_sdk.get_client() is client
+        sentry_sdk.set_tag("color", "red")
+        sentry_sdk.capture_message("first")
+        assert sentry_client.events()[0]["tags"] == {"color": "red"}
+
+    assert sentry_sdk.Scope.get_global_scope().client is previous_client
+
+    with helper.use_client(client) as sentry_client:
+        sentry_sdk.capture_message("second")
+        (event,) = sentry_client.events()
+        assert "tags" not in event
+
+
+def test_helper_payload_bytes_not_kept():
+    helper = SentryTestHelper()
+    with helper.init() as sentry_client:
+        sentry_sdk.capture_message("message")
+        (envelope,) = sentry_client.envelopes
+        # Sizes are counted without keeping serialized copies of payloads
+        assert [item.payload.bytes for item in envelope.items] == [None]
+        assert sentry_client.stats().bytes == len(envelope.items[0].payload.get_bytes())
+
+
+def test_helper_find_after_drop():
+    helper = SentryTestHelper(max_envelopes=2)
+    with helper.init() as sentry_client:
+        transport = sentry_client._transport
+        for i in range(3):
+            transport.capture_envelope(
+                Envelope(
+                    items=[Item(payload=PayloadRef(json={"event_id": "a", "i": i}))]
+                )
+            )
+
+        # The first payload with the id was dropped, but later ones are kept
+        assert sentry_client.find("a") == {"event_id": "a", "i": 1}
+
+
+@pytest.mark.parametrize("max_envelopes", [0, -1])
+def test_helper_bad_max_envelopes(max_envelopes):
+    with pytest.raises(ValueError):
+        SentryTestHelper(max_envelopes=max_envelopes)
+
+
+def test_helper_max_envelopes():
+    helper = SentryTestHelper(max_envelopes=2)
+    with helper.init(traces_sample_rate=1.0) as sentry_client:
+        event_ids = [sentry_sdk.capture_message(f"message {i}") for i in range(3)]
+        with sentry_sdk.start_transaction(name="txn"):
+            pass
+
+        # Only the most recent envelopes are kept
+        assert len(sentry_client.envelopes) == 2
+        assert [event["message"] for event in sentry_client.events()] == ["message 2"]
+        assert len(sentry_client.transactions()) == 1
+        assert len(sentry_client.envelope_payloads) == 2
+        assert sentry_client.find(event_ids[0]) is None
+        assert sentry_client.find(event_ids[2])["message"] == "message 2"
+
+        # Counts include dropped envelopes
+        stats = sentry_client.stats()
+        assert stats.envelopes == 4
+        assert stats.dropped_envelopes == 2
+        assert stats.items_by_type == {"event": 3, "transaction": 1}
+        assert stats.bytes == sum(stats.bytes_by_type.values()) > 0
+        sentry_client.wait_for(count=4, timeout=0)
+
+        sentry_client.reset()
+        assert sentry_client.stats().envelopes == 0
+
+
 def test_helper_capture_exceptions_without_stack():
     scrubber = Scrubber(
         rules=[
@@ -385,6 +669,180 @@ class Test_diff_structure:
             },
         ]
 
+    def test_max_differences(self):
+        a = {"a": 1, "b": [1, 2, 3], "c": "x"}
+        b = {"a": 2, "b": [4, 5, 6], "c": "y"}
+        assert len(diff_structure(a, b)) == 5
+        differences = diff_structure(a, b, max_differences=2)
+        assert [difference["path"] for difference in differences] == [".a", ".b.[0]"]
+
+    def test_compact(self):
+        a = {"stack": {"frames": list(range(100))}, "value": "a" * 100}
+        b = {"stack": None, "value": "b" * 100}
+        differences = diff_structure(a, b, compact=True)
+        assert differences[0] == {
+            "msg": "different types a:<class 'dict'> b:<class 'NoneType'>",
+            "path": ".stack",
+            "a": "dict: {'frames': [0, 1, 2, 3, ...]}",
+            "b": "NoneType: None",
+        }
+        # Long strings are truncated
+        assert differences[1]["path"] == ".value"
+        assert differences[1]["a"].startswith("str: 'aaa")
+        assert "..." in differences[1]["a"]
+        assert len(differences[1]["a"]) < 100
+        assert len(differences[1]["msg"]) < 200
+
+    def test_deep_nesting(self):
+        # Deeper than the recursion limit
+        a = b = None
+        for _ in range(5000):
+            a = {"child": a}
+            b = {"child": b}
+        b_leaf = b
+        while b_leaf["child"] is not None:
+            b_leaf = b_leaf["child"]
+        b_leaf["child"] = 5
+
+        differences = diff_structure(a, b, compact=True)
+        assert len(differences) == 1
+        assert differences[0]["path"] == ".child" * 5000
+
+    def test_non_string_keys(self):
+        assert diff_structure({1: "a"}, {1: "b"})[0]["path"] == ".1"
+
+
+class Test_compile_expected:
+    @pytest.mark.parametrize(
+        "payload, template",
+        [
+            ({"a": 1, "b": [1, 2]}, {"a": 1, "b": [1, 2]}),
+            ({"a": 1, "b": [1, 2, 3]}, {"a": 2, "b": [1, ANY]}),
+            ({"a": {"b": "x"}, "c": 1}, {"a": None, "d": 1}),
+            ([1, 2], (1, 2)),
+            ("abc", "abd"),
+        ],
+    )
+    def test_same_as_diff_structure(self, payload, template):
+        expected = compile_expected(template)
+        assert expected.diff(payload) == diff_structure(payload, template)
+        # Checking again gives the same results
+        assert expected.diff(payload) == diff_structure(payload, template)
+
+    def test_matchers(self):
+        expected = compile_expected(
+            {
+                "level": Regex("error|fatal"),
+                "count": OfType(int, float),
+                "headers": {"Auth-Token": SCRUBBED},
+            }
+        )
+        assert expected.matches(
+            {"level": "error", "count": 5.5, "headers": {"Auth-Token": "[Scrubbed]"}}
+        )
+
+        differences = expected.diff(
+            {"level": "errors", "count": "5", "headers": {"Auth-Token": "abc"}}
+        )
+        assert [(diff["path"], diff["msg"]) for diff in differences] == [
+            (".count", "<class 'str'> is not one of (<class 'int'>, <class 'float'>)"),
+            (".headers.Auth-Token", "'abc' is not scrubbed"),
+            (".level", "'errors' does not match 'error|fatal'"),
+        ]
+
+    def test_optional_key(self):
+        expected = compile_expected({"a": 1, "user": OptionalKey({"id": OfType(str)})})
+        assert expected.matches({"a": 1})
+        assert expected.matches({"a": 1, "user": {"id": "abc"}})
+        assert expected.diff({"a": 1, "user": {"id": 5}})[0]["path"] == ".user.id"
+        assert expected.diff({"user": {"id": "abc"}})[0]["msg"] == "a in b, not in a"
+
+    def test_optional_key_outside_dict(self):
+        with pytest.raises(ConfigurationError):
+            compile_expected([OptionalKey(1)])
+
+    def test_list_of(self):
+        expected = compile_expected(
+            {"values": ListOf({"message": OfType(str)}, min_length=1, max_length=3)}
+        )
+        assert expected.matches({"values": [{"message": "a"}, {"message": "b"}]})
+        assert (
+            expected.diff({"values": [{"message": "a"}, {"message": 5}]})[0]["path"]
+            == ".values.[1].message"
+        )
+        assert expected.diff({"values": []})[0]["msg"] == (
+            "length 0 is not between 1 and 3"
+        )
+        assert expected.diff({"values": "abc"})[0]["msg"] == (
+            "different types a:<class 'str'> b:<class 'list'>"
+        )
+
+    def test_custom_matcher(self):
+        class IsEven(Matcher):
+            def match(self, value):
+                if isinstance(value, int) and value % 2 == 0:
+                    return None
+                return f"{value!r} is not even"
+
+        expected = compile_expected({"a": IsEven()})
+        assert expected.matches({"a": 2})
+        assert expected.diff({"a": 3})[0]["msg"] == "3 is not even"
+
+    def test_matcher_without_match(self):
+        class Incomplete(Matcher):
+            pass
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+    def test_max_differences_and_compact(self):
+        expected = compile_expected({"a": 1, "b": 2, "c": 3})
+        differences = expected.diff(
+            {"a": "x" * 100, "b": 0, "c": 0}, max_differences=1, compact=True
+        )
+        assert len(differences) == 1
+        assert differences[0]["b"] == "int: 1"
+        assert len(differences[0]["a"]) < 100
+
+    def test_assert_matches(self):
+        expected = compile_expected({"a": 1})
+        expected.assert_matches({"a": 1})
+        with pytest.raises(AssertionError, match=r"\.a: 2 != 1"):
+            expected.assert_matches({"a": 2})
+
+    def test_many_payloads(self):
+        expected = compile_expected(
+            {
+                "request": {
+                    "headers": {"Auth-Token": SCRUBBED, "Authorization": SCRUBBED},
+                    "data": {"password": SCRUBBED},
+                }
+            }
+        )
+        scrubber = Scrubber(
+            rules=[
+                Rule(
+                    path="request.headers",
+                    keys=["Auth-Token", "Authorization"],
+                    scrub="scrub",
+                ),
+                Rule(path="request.data", keys=["password"], scrub="scrub"),
+            ]
+        )
+        for generated in EventGenerator().iter_events(count=20):
+            event = scrubber(generated.event, {})
+            request = event["request"]
+            payload = {
+                "request": {
+                    "headers": {
+                        key: request["headers"][key]
+                        for key in ("Auth-Token", "Authorization")
+                    },
+                    "data": {"password": request["data"]["password"]},
+                }
+            }
+            expected.assert_matches(payload)
+
 
 def test_save_events(tmp_path):
     event_data = {"request": "data"}
@@ -402,3 +860,643 @@ def test_save_events(tmp_path):
         data = json.load(fp)
 
     assert data == event_data
+
+
+def test_save_events_background(tmp_path):
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(rules=[]), outputdir=str(tmp_path), background=True
+    )
+    for i in range(5):
+        scrubber({"index": i}, {})
+    scrubber.flush()
+
+    files = list(tmp_path.glob("*.json"))
+    assert sorted(json.loads(path.read_text())["index"] for path in files) == [
+        0,
+        1,
+        2,
+        3,
+        4,
+    ]
+
+    scrubber.close()
+    assert not scrubber._writer.is_alive()
+
+
+@pytest.mark.parametrize(
+    "drop_policy, expected",
+    [
+        # Event 0 is being written; event 1 is queued; the rest are dropped
+        ("drop_newest", [0, 1]),
+        # Event 0 is being written; events 1-3 are dropped to make room for 4
+        ("drop_oldest", [0, 4]),
+    ],
+)
+def test_save_events_drop_policy(tmp_path, drop_policy, expected):
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(rules=[]),
+        outputdir=str(tmp_path),
+        background=True,
+        queue_size=1,
+        drop_policy=drop_policy,
+    )
+
+    # Block the writer so the queue fills up
+    write = scrubber._write
+    writing = threading.Event()
+    unblock = threading.Event()
+
+    def blocked_write(data):
+        writing.set()
+        unblock.wait()
+        write(data)
+
+    scrubber._write = blocked_write
+
+    scrubber({"index": 0}, {})
+    writing.wait()
+    for i in range(1, 5):
+        scrubber({"index": i}, {})
+    unblock.set()
+    scrubber.close()
+
+    files = list(tmp_path.glob("*.json"))
+    assert sorted(json.loads(path.read_text())["index"] for path in files) == expected
+    assert scrubber.dropped == 3
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_save_events_after_close(tmp_path, caplog, background):
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(
+            rules=[Rule(path="request", keys=["data"], scrub="scrub")]
+        ),
+        outputdir=str(tmp_path),
+        background=background,
+        queue_size=1,
+        drop_policy="block",
+    )
+    scrubber.close()
+
+    # Events are still scrubbed, but not saved, and this doesn't block
+    for _ in range(3):
+        event = scrubber({"request": {"data": "secret"}}, {})
+        assert event == {"request": {"data": "[Scrubbed]"}}
+    assert list(tmp_path.glob("*.json")) == []
+    assert scrubber.dropped == 3
+    # The warning is logged once
+    assert [record.levelname for record in caplog.records] == ["WARNING"]
+
+
+def test_save_events_garbage_collected(tmp_path):
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(rules=[]),
+        sink=JSONLSink(tmp_path, compression=None),
+    )
+    scrubber({"index": 0}, {})
+    ref = weakref.ref(scrubber)
+
+    del scrubber
+    gc.collect()
+    assert ref() is None
+    # The sink was closed, so the file is finished
+    (path,) = tmp_path.glob("*.jsonl")
+    assert json.loads(path.read_text()) == {"index": 0}
+
+
+def test_save_events_drop_oldest_keeps_stop(tmp_path):
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(rules=[]),
+        outputdir=str(tmp_path),
+        background=True,
+        queue_size=1,
+        drop_policy="drop_oldest",
+    )
+
+    # Block the writer so the queue fills up
+    write = scrubber._write
+    writing = threading.Event()
+    unblock = threading.Event()
+
+    def blocked_write(data):
+        writing.set()
+        unblock.wait()
+        write(data)
+
+    scrubber._write = blocked_write
+    scrubber({"index": 0}, {})
+    writing.wait()
+
+    # close() puts the stop on the queue and then an event comes in before
+    # it's marked closed
+    scrubber._queue.put(None)
+    scrubber({"index": 1}, {})
+    assert scrubber.dropped == 1
+
+    # The writer still stops
+    unblock.set()
+    scrubber._writer.join(timeout=5)
+    assert not scrubber._writer.is_alive()
+    scrubber.close()
+
+
+def test_save_events_bad_drop_policy(tmp_path):
+    with pytest.raises(ConfigurationError):
+        SaveEvents(
+            wrapped_scrubber=Scrubber(rules=[]),
+            outputdir=str(tmp_path),
+            drop_policy="bad",
+        )
+
+
+def test_save_events_outputdir_or_sink(tmp_path):
+    with pytest.raises(ConfigurationError):
+        SaveEvents(wrapped_scrubber=Scrubber(rules=[]))
+    with pytest.raises(ConfigurationError):
+        SaveEvents(
+            wrapped_scrubber=Scrubber(rules=[]),
+            outputdir=str(tmp_path),
+            sink=JSONLSink(tmp_path),
+        )
+
+
+def test_save_events_sample_rate(tmp_path):
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(rules=[]), outputdir=str(tmp_path), sample_rate=0.0
+    )
+    for i in range(5):
+        scrubber({"index": i}, {})
+    assert list(tmp_path.glob("*.json")) == []
+    assert scrubber.skipped == 5
+
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(rules=[]), outputdir=str(tmp_path), sample_rate=0.5
+    )
+    scrubber._random.seed(0)
+    for i in range(100):
+        scrubber({"index": i}, {})
+    assert 30 < len(list(tmp_path.glob("*.json"))) < 70
+    assert scrubber.skipped + len(list(tmp_path.glob("*.json"))) == 100
+
+
+@pytest.mark.parametrize("sample_rate", [-0.1, 1.5])
+def test_save_events_bad_sample_rate(tmp_path, sample_rate):
+    with pytest.raises(ConfigurationError):
+        SaveEvents(
+            wrapped_scrubber=Scrubber(rules=[]),
+            outputdir=str(tmp_path),
+            sample_rate=sample_rate,
+        )
+
+
+@pytest.mark.parametrize("max_shapes", [0, -1])
+def test_save_events_bad_max_shapes(tmp_path, max_shapes):
+    with pytest.raises(ConfigurationError):
+        SaveEvents(
+            wrapped_scrubber=Scrubber(rules=[]),
+            outputdir=str(tmp_path),
+            distinct_shapes=True,
+            max_shapes=max_shapes,
+        )
+
+
+def test_save_events_distinct_shapes(tmp_path):
+    scrubber = SaveEvents(
+        wrapped_scrubber=Scrubber(rules=[]),
+        outputdir=str(tmp_path),
+        distinct_shapes=True,
+        max_shapes=2,
+    )
+    # Same shape with different values
+    scrubber({"request": {"data": "a"}}, {})
+    scrubber({"request": {"data": "b"}}, {})
+    assert len(list(tmp_path.glob("*.json"))) == 1
+    assert scrubber.skipped == 1
+
+    # New shapes get saved
+    scrubber({"request": {"data": "a", "password": "b"}}, {})
+    scrubber({"frames": [{"vars": {}}]}, {})
+    assert len(list(tmp_path.glob("*.json"))) == 3
+
+    # The first shape was forgotten when the third was seen
+    scrubber({"request": {"data": "c"}}, {})
+    assert len(list(tmp_path.glob("*.json"))) == 4
+
+
+class TestJSONLSink:
+    @pytest.mark.parametrize(
+        "compression, suffix",
+        [
+            (None, ".jsonl"),
+            ("gzip", ".jsonl.gz"),
+            pytest.param(
+                "zstd",
+                ".jsonl.zst",
+                marks=pytest.mark.skipif(
+                    not is_compression_available("zstd"), reason="zstd unavailable"
+                ),
+            ),
+        ],
+    )
+    def test_compression(self, tmp_path, compression, suffix):
+        sink = JSONLSink(tmp_path, compression=compression)
+        scrubber = SaveEvents(wrapped_scrubber=Scrubber(rules=[]), sink=sink)
+        for i in range(3):
+            scrubber({"index": i}, {})
+
+        # The file is partial until it's closed
+        assert [path.name.endswith(".partial") for path in tmp_path.iterdir()] == [True]
+        scrubber.close()
+
+        files = list(tmp_path.iterdir())
+        assert len(files) == 1
+        assert files[0].name.startswith("events-")
+        assert files[0].name.endswith(suffix)
+        assert list(iter_events(tmp_path)) == [{"index": 0}, {"index": 1}, {"index": 2}]
+
+    def test_rotate_max_bytes(self, tmp_path):
+        # Each event line is 13 bytes, so files get 2 events
+        sink = JSONLSink(tmp_path, compression=None, max_bytes=20)
+        for i in range(5):
+            sink.write(json.dumps({"index": i}))
+        sink.close()
+
+        files = sorted(tmp_path.iterdir())
+        assert len(files) == 3
+        assert sorted(event["index"] for event in iter_events(tmp_path)) == [
+            0,
+            1,
+            2,
+            3,
+            4,
+        ]
+
+    def test_rotate_max_seconds(self, tmp_path):
+        sink = JSONLSink(tmp_path, compression=None, max_seconds=0)
+        for i in range(3):
+            sink.write(json.dumps({"index": i}))
+        sink.close()
+        assert len(list(tmp_path.iterdir())) == 3
+
+    def test_background(self, tmp_path):
+        scrubber = SaveEvents(
+            wrapped_scrubber=Scrubber(rules=[]),
+            sink=JSONLSink(tmp_path),
+            background=True,
+        )
+        for i in range(5):
+            scrubber({"index": i}, {})
+        scrubber.close()
+        assert [event["index"] for event in iter_events(tmp_path)] == [0, 1, 2, 3, 4]
+
+    def test_index(self, tmp_path):
+        with CorpusIndex(tmp_path) as index:
+            sink = JSONLSink(tmp_path, max_bytes=1, index=index)
+            sink.write(json.dumps({"a": 1}))
+            sink.write(json.dumps({"b": 1}))
+            # The first file was rotated and indexed
+            assert len(index.find("a")) == 1
+            assert index.find("b") == []
+
+            sink.close()
+            assert len(index.find("b")) == 1
+
+    def test_bad_compression(self, tmp_path):
+        with pytest.raises(ConfigurationError):
+            JSONLSink(tmp_path, compression="lzma")
+
+    def test_bad_outputdir(self, tmp_path):
+        with pytest.raises(ConfigurationError):
+            JSONLSink(tmp_path / "missing")
+
+
+class TestEventGenerator:
+    def test_deterministic(self):
+        events = EventGenerator(seed=1).generate_events(count=3)
+        assert events == EventGenerator(seed=1).generate_events(count=3)
+        assert events != EventGenerator(seed=2).generate_events(count=3)
+        # Events are different from one another
+        assert events[0].event != events[1].event
+
+    def test_shape(self):
+        generator = EventGenerator(
+            frames=7, vars_per_frame=3, headers=4, cookies=2, breadcrumbs=5
+        )
+        event = generator.generate(0).event
+
+        frames = event["exception"]["values"][0]["stacktrace"]["frames"]
+        assert len(frames) == 7
+        assert all(len(frame["vars"]) >= 3 for frame in frames)
+        # 4 headers plus 2 with secrets
+        assert len(event["request"]["headers"]) == 6
+        # 2 cookies plus 2 with secrets
+        assert event["request"]["cookies"].count("=") == 4
+        assert len(event["breadcrumbs"]["values"]) == 5
+
+        # Events serialize as JSON
+        json.dumps(event)
+
+    def test_iter_events(self):
+        generator = EventGenerator()
+        events = generator.iter_events()
+        assert next(events) == generator.generate(0)
+        assert next(events) == generator.generate(1)
+
+    def test_leaks(self):
+        generated = EventGenerator(secret_frame_rate=1.0, frames=2).generate(0)
+        assert len(generated.secrets) == 11
+        assert generated.leaks() == [path for path, _ in generated.secrets]
+
+        scrubber = Scrubber(
+            rules=[
+                Rule(
+                    path="request.headers",
+                    keys=["Auth-Token", "Authorization"],
+                    scrub="scrub",
+                ),
+                Rule(
+                    path="request",
+                    keys=["cookies"],
+                    scrub=build_scrub_cookies(params=["sessionid", "csrftoken"]),
+                ),
+                Rule(
+                    path="request",
+                    keys=["query_string"],
+                    scrub=build_scrub_query_string(params=["code", "state"]),
+                ),
+                Rule(path="request.data", keys=["password"], scrub="scrub"),
+                Rule(
+                    path="exception.values.[].stacktrace.frames.[].vars",
+                    keys=["password"],
+                    scrub="scrub",
+                ),
+            ]
+        )
+        scrubber(generated.event, {})
+        assert generated.leaks() == [
+            ("exception", "values", 0, "stacktrace", "frames", 0, "vars", "token"),
+            ("exception", "values", 0, "stacktrace", "frames", 1, "vars", "token"),
+        ]
+
+
+def copy_value(value):
+    return value * 1000
+
+
+def test_measure_scrub():
+    scrubber = Scrubber(
+        rules=[
+            Rule(path="request", keys=["data"], scrub=copy_value),
+            Rule(path="request", keys=["headers"], scrub="scrub"),
+            Rule(path="request", keys=["cookies"], scrub="scrub"),
+        ]
+    )
+    events = [
+        {"request": {"data": "x" * 100, "headers": "abc", "cookies": "def"}},
+        {"request": {"data": "y" * 100}},
+    ]
+
+    measurements = measure_scrub(scrubber, events)
+
+    # The events aren't changed
+    assert events[0]["request"]["data"] == "x" * 100
+
+    assert measurements.events == 2
+    assert [measurement.name for measurement in measurements.rules] == [
+        "rule 0: request ['data']",
+        "rule 1: request ['headers']",
+        "rule 2: request ['cookies']",
+    ]
+    assert [measurement.name for measurement in measurements.scrub_functions] == [
+        "tests.test_test.copy_value",
+        "fillmore.scrubber.scrub",
+    ]
+
+    # copy_value makes a 100,000 character string for each event
+    copy_rule = measurements.rules[0]
+    assert copy_rule.retained_bytes >= 100_000
+    assert copy_rule.peak_bytes >= 100_000
+    assert measurements.scrub_functions[0].retained_bytes >= 100_000
+
+    # scrub doesn't allocate much
+    assert measurements.rules[1].peak_bytes < 10_000
+    assert measurements.total.retained_bytes >= copy_rule.retained_bytes
+
+    assert "copy_value" in measurements.summary()
+
+
+def copy_and_discard(value):
+    _ = value * 1000
+    return value
+
+
+def test_measure_scrub_temporary_copies():
+    scrubber = Scrubber(
+        rules=[Rule(path="request", keys=["data"], scrub=copy_and_discard)]
+    )
+    events = [{"request": {"data": "x" * 100}}]
+
+    measurements = measure_scrub(scrubber, events)
+
+    # The copy is freed, but it's still in the peak
+    rule = measurements.rules[0]
+    assert rule.peak_bytes >= 100_000
+    assert rule.retained_bytes < 10_000
+
+
+def test_normalize_event():
+    event = {
+        "event_id": "abc",
+        "timestamp": "2024-01-01T00:00:00",
+        "sdk": {
+            "name": "sentry.python",
+            "version": "2.0.0",
+            "packages": [{"name": "pypi:sentry-sdk", "version": "2.0.0"}],
+        },
+        "contexts": {
+            "runtime": {"name": "CPython", "version": "3.12.0"},
+            "trace": {"trace_id": "def", "parent_span_id": None},
+        },
+        "breadcrumbs": {"values": [{"timestamp": "2024-01-01T00:00:00"}]},
+        "extra": {"obj": "<Thing object at 0x7f3a2b1c4d50>", "version": "1.0"},
+    }
+    assert normalize_event(event) == {
+        "event_id": "<event_id>",
+        "timestamp": "<timestamp>",
+        "sdk": {
+            "name": "sentry.python",
+            "version": "<version>",
+            "packages": [{"name": "pypi:sentry-sdk", "version": "<version>"}],
+        },
+        "contexts": {
+            "runtime": {"name": "CPython", "version": "<version>"},
+            "trace": {"trace_id": "<trace_id>", "parent_span_id": None},
+        },
+        "breadcrumbs": {"values": [{"timestamp": "<timestamp>"}]},
+        # Versions outside sdk and runtime are kept
+        "extra": {"obj": "<Thing object at 0x<address>>", "version": "1.0"},
+    }
+    # The event isn't changed
+    assert event["event_id"] == "abc"
+
+
+def test_scrubbed_paths():
+    original = {
+        "request": {"headers": {"Auth": "a", "Host": "b"}, "data": {"x": 1}},
+        "frames": [{"vars": {"password": "c"}}, {"vars": {}}],
+        "extra": {"removed": "d"},
+    }
+    scrubbed = {
+        "request": {"headers": {"Auth": "[Scrubbed]", "Host": "b"}, "data": "x"},
+        "frames": [{"vars": {"password": None}}],
+        "extra": {"added": "e"},
+    }
+    assert scrubbed_paths(original, scrubbed) == {
+        "request.headers.Auth",
+        "request.data",
+        "frames.[0].vars.password",
+        "frames.[1]",
+        "extra.removed",
+    }
+    assert scrubbed_paths(original, original) == set()
+
+
+def test_compare_scrubbers(tmp_path):
+    events = [
+        {"request": {"headers": {"Auth": "a"}, "cookies": "b"}},
+        {"request": {"cookies": "c"}},
+        {"request": {"data": "d"}},
+    ]
+    (tmp_path / "events.jsonl").write_text(
+        "\n".join(json.dumps(event) for event in events)
+    )
+    old = Scrubber(rules=[Rule(path="request", keys=["headers"], scrub="scrub")])
+    new = Scrubber(rules=[Rule(path="request", keys=["cookies"], scrub="scrub")])
+
+    differences = list(compare_scrubbers(old, new, tmp_path))
+    assert [
+        (difference.path.name, difference.position, difference.unmasked)
+        for difference in differences
+    ] == [("events.jsonl", 0, ["request.headers"]), ("events.jsonl", 1, [])]
+    assert [difference.newly_masked for difference in differences] == [
+        ["request.cookies"],
+        ["request.cookies"],
+    ]
+
+
+def test_compare_scrubbers_same_path(tmp_path):
+    # Both scrubbers change request.cookies, but the new one leaks code
+    (tmp_path / "event.json").write_text(
+        json.dumps({"request": {"cookies": "code=SECRET; state=abc; other=1"}})
+    )
+    old = Scrubber(
+        rules=[
+            Rule(path="request", keys=["cookies"], scrub=build_scrub_cookies(["code"]))
+        ]
+    )
+    new = Scrubber(
+        rules=[
+            Rule(path="request", keys=["cookies"], scrub=build_scrub_cookies(["state"]))
+        ]
+    )
+
+    (difference,) = compare_scrubbers(old, new, tmp_path)
+    assert difference.unmasked == ["request.cookies"]
+    assert difference.newly_masked == ["request.cookies"]
+
+    # Scrubbing the same cookies isn't a difference
+    assert list(compare_scrubbers(old, old, tmp_path)) == []
+
+
+def test_compare_scrubbers_interleaved(tmp_path):
+    # Generators comparing different scrubbers don't share state
+    (tmp_path / "events.jsonl").write_text(
+        json.dumps({"x": {"a": "1", "b": "2"}})
+        + "\n"
+        + json.dumps({"x": {"a": "3", "b": "4"}})
+    )
+    scrub_a = Scrubber(rules=[Rule(path="x", keys=["a"], scrub="scrub")])
+    scrub_b = Scrubber(rules=[Rule(path="x", keys=["b"], scrub="scrub")])
+    nothing = Scrubber(rules=[])
+
+    a_differences = compare_scrubbers(scrub_a, nothing, tmp_path)
+    b_differences = compare_scrubbers(scrub_b, nothing, tmp_path)
+    assert next(a_differences).unmasked == ["x.a"]
+    assert next(b_differences).unmasked == ["x.b"]
+    assert next(a_differences).unmasked == ["x.a"]
+    assert next(b_differences).unmasked == ["x.b"]
+
+
+SCRUB_A = Scrubber(rules=[Rule(path="x", keys=["a"], scrub="scrub")])
+SCRUB_NOTHING = Scrubber(rules=[])
+
+
+def test_compare_scrubbers_workers(tmp_path, monkeypatch):
+    # Use small batches so several are in flight
+    monkeypatch.setattr("fillmore.test.COMPARE_BATCH_SIZE", 2)
+    (tmp_path / "events.jsonl").write_text(
+        "\n".join(json.dumps({"x": {"a": str(i)}}) for i in range(15))
+    )
+    differences = compare_scrubbers(
+        "tests.test_test:SCRUB_A", "tests.test_test:SCRUB_NOTHING", tmp_path, workers=2
+    )
+    assert [
+        (difference.position, difference.unmasked) for difference in differences
+    ] == [(i, ["x.a"]) for i in range(15)]
+
+
+def test_compare_scrubbers_workers_need_specs(tmp_path):
+    scrubber = Scrubber(rules=[])
+    with pytest.raises(ValueError):
+        list(compare_scrubbers(scrubber, scrubber, tmp_path, workers=2))
+
+
+# Newer sentry_sdk versions deprecate send_default_pii which set_up_sentry sets
+IGNORE_SEND_DEFAULT_PII = pytest.mark.filterwarnings(
+    "ignore:The send_default_pii option is deprecated:DeprecationWarning"
+)
+
+
+@IGNORE_SEND_DEFAULT_PII
+def test_loadtest():
+    scrubber = Scrubber(rules=SCRUB_RULES_DEFAULT)
+    previous_client = sentry_sdk.Scope.get_global_scope().client
+    events = [{"message": "hi", "request": {"cookies": "sessionid=secret"}}]
+
+    result = loadtest(scrubber, events, threads=2, duration=5, max_events=50)
+
+    assert result.threads == 2
+    assert result.events == 50
+    assert result.sent == 50
+    assert result.events_per_second > 0
+    assert 0 < result.latency_p50 <= result.latency_p99 <= result.latency_p999
+    assert result.latency_p999 <= result.latency_max
+    assert "50 events" in result.summary()
+
+    # The events aren't changed and the global client is restored
+    assert events[0]["request"]["cookies"] == "sessionid=secret"
+    assert sentry_sdk.Scope.get_global_scope().client is previous_client
+
+
+@IGNORE_SEND_DEFAULT_PII
+def test_loadtest_server():
+    scrubber = Scrubber(rules=SCRUB_RULES_DEFAULT)
+    result = loadtest(
+        scrubber,
+        EventGenerator(frames=2),
+        threads=2,
+        duration=5,
+        max_events=20,
+        server=True,
+        pool_size=5,
+    )
+    assert result.events == 20
+    assert 0 < result.sent <= 20
+
+
+@IGNORE_SEND_DEFAULT_PII
+def test_loadtest_duration():
+    scrubber = Scrubber(rules=SCRUB_RULES_DEFAULT)
+    result = loadtest(scrubber, [{"message": "hi"}], threads=1, duration=0.1)
+    assert result.events > 0
+    assert result.seconds < 5